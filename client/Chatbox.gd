@@ -27,7 +27,6 @@ func add_message(text: String):
 func _on_line_edit_text_submitted(new_text):
 	if len(new_text) > 0:
 		input_field.clear()
-		add_message(new_text)
 		chat_sent.emit(new_text)
 
 func _on_button_disconnect_pressed():
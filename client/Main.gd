@@ -5,6 +5,11 @@ const Packets = preload("res://packets.gd")
 
 var state: Callable = ENTRY
 
+# The token the server gave us to resume our session with, and how long it asked us to wait before 
+# reconnecting when it last disconnected us, if it did
+var _session_token: String = ""
+var _reconnect_after_ms: int = 0
+
 @onready var _network_client: Node = $NetworkClient
 @onready var _chatbox: Control = $Chatbox
 @onready var _entry: Control = $Entry
@@ -30,35 +35,96 @@ func LOGIN(packet: Packets.Packet):
 	if packet.has_deny():
 		var reason: String = packet.get_deny().get_reason()
 		_chatbox.add_message("[color=#FFD943]%s[/color]" % [reason])
+		# A session that could not be resumed leaves us back at the entry screen
+		_session_token = ""
+		if _entry.get_parent() == null:
+			_chatbox.disable_chat()
+			add_child(_entry)
 		state = ENTRY
 		
 	elif packet.has_ok():
 		var message: String = packet.get_ok().get_msg()
 		_chatbox.add_message("[color=#43FFD9]%s[/color]" % [message])
 		_chatbox.enable_chat()
-		remove_child(_entry)
+		if _entry.get_parent() == self:
+			remove_child(_entry)
 		state = PLAY
 		
 func PLAY(packet: Packets.Packet):
 	if packet.has_chat():
 		var message: String = packet.get_chat().get_msg()
 		_chatbox.add_message(message)
+	
+	elif packet.has_chat_batch():
+		# Everything said in a channel during a server tick arrives together, our own messages included
+		for chat in packet.get_chat_batch().get_messages():
+			_chatbox.add_message(_format_chat(chat))
 		
 	elif packet.has_disconnect():
-		var reason: String = packet.get_disconnect().get_reason()
-		_chatbox.add_message("[color=#D943FF]%s[/color]" % [reason])
+		var disconnect_packet: Packets.DisconnectPacket = packet.get_disconnect()
+		_chatbox.add_message("[color=#D943FF]%s[/color]" % [disconnect_packet.get_reason()])
+		# Sent to us when the server is going away, e.g. to restart
+		if disconnect_packet.get_reconnect_after_ms() > 0:
+			_reconnect_after_ms = disconnect_packet.get_reconnect_after_ms()
+			_chatbox.add_message("[color=#D943FF]Reconnecting shortly...[/color]")
+
+func _format_chat(chat: Packets.ChatPacket) -> String:
+	match chat.get_channel():
+		Packets.ChatChannel.ZONE:
+			return "[color=#9CD943][Zone] %s:[/color] %s" % [chat.get_sender(), chat.get_msg()]
+		Packets.ChatChannel.PARTY:
+			return "[color=#43A6FF][Party] %s:[/color] %s" % [chat.get_sender(), chat.get_msg()]
+		Packets.ChatChannel.WHISPER:
+			return "[color=#FF7FD9]%s:[/color] %s" % [chat.get_sender(), chat.get_msg()]
+	return "%s: %s" % [chat.get_sender(), chat.get_msg()]
 
 func _on_chatbox_chat_sent(message: String):
 	var p: Packets.Packet = Packets.Packet.new()
+	# "/party name" joins a party, "/z", "/p" and "/w user" pick the channel, the rest is global chat
+	var words: PackedStringArray = message.split(" ", false, 2)
+	if words.is_empty():
+		return
+	match words[0]:
+		"/party":
+			if words.size() > 1:
+				p.new_party().set_name(message.substr(len("/party ")).strip_edges())
+				_network_client.send_packet(p)
+			return
+		"/z":
+			_send_chat(p, message.substr(len("/z ")), Packets.ChatChannel.ZONE)
+		"/p":
+			_send_chat(p, message.substr(len("/p ")), Packets.ChatChannel.PARTY)
+		"/w":
+			if words.size() > 2:
+				_send_chat(p, words[2], Packets.ChatChannel.WHISPER, words[1])
+		_:
+			_send_chat(p, message, Packets.ChatChannel.GLOBAL)
+
+func _send_chat(p: Packets.Packet, message: String, channel: int, target: String = ""):
 	var c: Packets.ChatPacket = p.new_chat()
 	c.set_msg(message)
+	c.set_channel(channel)
+	c.set_target(target)
 	_network_client.send_packet(p)
 
 func _on_network_client_connected():
 	print("Client connected to server!")
+	if _session_token != "":
+		# Resume our session instead of logging in again
+		state = LOGIN
+		var p: Packets.Packet = Packets.Packet.new()
+		var s: Packets.SessionPacket = p.new_session()
+		s.set_token(_session_token)
+		_network_client.send_packet(p)
 
 func _on_network_client_disconnected(code, reason):
 	printerr("Client disconnected from server with code %s and reason %s" % [code, reason])
+	if _reconnect_after_ms > 0 and _session_token != "":
+		_chatbox.disable_chat()
+		await get_tree().create_timer(_reconnect_after_ms / 1000.0).timeout
+		_reconnect_after_ms = 0
+		_network_client.connect_to_server()
+		return
 	get_tree().quit()
 
 func _on_network_client_error(code):
@@ -66,6 +132,10 @@ func _on_network_client_error(code):
 	get_tree().quit()
 
 func _on_network_client_received(packet):
+	# The server hands out a fresh session token whenever we log in, and before it goes away
+	if packet.has_session():
+		_session_token = packet.get_session().get_token()
+		return
 	state.call(packet)
 
 func _on_entry_login(username, password):
@@ -85,6 +155,7 @@ func _on_entry_register(username, password):
 	_network_client.send_packet(p)
 
 func _on_chatbox_disconnect():
+	_session_token = ""
 	_chatbox.disable_chat()
 	add_child(_entry)
 	state = ENTRY
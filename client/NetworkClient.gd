@@ -4,11 +4,18 @@ const Packets = preload("res://packets.gd")
 
 signal connected
 signal received(packet: Packets.Packet)
+signal snapshot_received(positions: Dictionary)
 signal disconnected(code: int, reason: String)
 signal error(code: int)
 
+# Snapshot positions are sent in 1/POSITION_SCALE world units
+const POSITION_SCALE: float = 16.0
+
 var _socket: WebSocketPeer = WebSocketPeer.new()
 
+# Entity positions in each snapshot not yet superseded by a newer baseline, keyed by sequence number
+var _snapshots: Dictionary = {}
+
 @export var hostname: String = "localhost"
 @export var port: int = 8081
 
@@ -17,6 +24,7 @@ func _ready() -> void:
 	connect_to_server()
 	
 func connect_to_server() -> void:
+	_snapshots.clear()
 	var url: String = "ws://%s:%d" % [hostname, port]
 	var options: TLSOptions = TLSOptions.client_unsafe()
 	var err: int = _socket.connect_to_url(url, options)
@@ -57,6 +65,10 @@ func _process(delta) -> void:
 				set_process(false)
 				emit_signal("error", result_code)
 
+			if packet.has_snapshot():
+				_apply_snapshot(packet.get_snapshot())
+				continue
+
 			received.emit(packet)
 			
 	elif state == WebSocketPeer.STATE_CLOSING:
@@ -70,6 +82,41 @@ func _process(delta) -> void:
 		set_process(false)
 		disconnected.emit(code, reason)
 
+# Rebuilds the full set of visible entities from a delta-compressed snapshot, acknowledges it, then 
+# emits the entities' positions keyed by entity ID.
+func _apply_snapshot(snapshot: Packets.SnapshotPacket) -> void:
+	var baseline_seq: int = snapshot.get_baseline()
+	var baseline: Dictionary = _snapshots.get(baseline_seq, {})
+	var state: Dictionary = baseline.duplicate()
+
+	for id in snapshot.get_removed():
+		state.erase(id)
+
+	var ids: Array = snapshot.get_ids()
+	var xs: Array = snapshot.get_xs()
+	var ys: Array = snapshot.get_ys()
+	for i in ids.size():
+		var position := Vector2i(xs[i], ys[i])
+		if baseline.has(ids[i]):
+			position += baseline[ids[i]]
+		state[ids[i]] = position
+
+	# Snapshots older than the baseline will never be built upon again
+	for seq in _snapshots.keys():
+		if seq < baseline_seq:
+			_snapshots.erase(seq)
+	_snapshots[snapshot.get_seq()] = state
+
+	var ack_packet: Packets.Packet = Packets.Packet.new()
+	var ack: Packets.AckPacket = ack_packet.new_ack()
+	ack.set_seq(snapshot.get_seq())
+	send_packet(ack_packet)
+
+	var positions: Dictionary = {}
+	for id in state:
+		positions[id] = Vector2(state[id]) / POSITION_SCALE
+	snapshot_received.emit(positions)
+
 func send_packet(packet: Packets.Packet) -> void:
 	var data: PackedByteArray = packet.to_bytes()
 	var err: int = _socket.send(data)
@@ -2,22 +2,111 @@
 This is the main entrypoint for the server. It creates a trio server that listens for websocket 
 connections. Each connection is handled by a GameProtocol instance.
 """
+import argparse
+import gc
 import logging
+import time
+from functools import partial
+from typing import Awaitable, Callable, Optional
+import numpy as np
 import trio
 from trio_websocket import serve_websocket, WebSocketConnection, WebSocketRequest  # type: ignore
+from server import metrics
+from server.auth import AuthWorker, UserCache
 from server.protocol import GameProtocol
+from server.protocol.chat import ChatRouter
+from server.protocol.game_protocol import MAX_INBOUND_MESSAGE_SIZE
+from server.protocol.outbound import OverflowPolicy
+from server.protocol.registry import ConnectionRegistry
+from server.protocol.snapshot import SnapshotTracker
+from server.protocol import trace
+from server.shard.relay import ShardRelay
+from server.shutdown import serve_until_signalled
+from server.world import PlayerStore, World
 from server.database import SessionMaker
-from server.database.engine import init_engine, get_session_factory
+from server.database.engine import DATABASE_URL, init_engine, get_session_factory
+
+# How many objects are allocated between collections of the garbage collector's youngest generation.
+# CPython's default is 700, which a busy tick allocates many times over.
+GC_THRESHOLD: int = 50_000
+
+
+def tune_gc() -> None:
+    """
+    Makes the garbage collector run less often. Each tick allocates tens of thousands of short-lived
+    objects, e.g. frames and batches, and with thousands of players connected every collection has
+    a cost of its own however little it frees, so at the default threshold collecting takes a large
+    share of the tick. Collecting after more allocations costs far less in total.
+    """
+    gc.set_threshold(GC_THRESHOLD, *gc.get_threshold()[1:])
+
 
 class GameServer:
     """
     Represents a websocket server that handles new connections for the game.
+
+    Args:
+        tick_rate (float): 
+            The number of seconds between each tick.
+        high_water_mark (int): 
+            The maximum number of frames that can be waiting to be sent to a single client.
+        overflow_policy (OverflowPolicy): 
+            What to do when a client's outgoing queue reaches its high-water mark.
+        max_packets_per_batch (int):
+            The maximum number of frames each client's sender task takes from its queue at once.
+        max_bytes_per_batch (int):
+            The maximum number of encoded bytes each client's sender task takes from its queue at
+            once.
+        backlog_report_interval (int): 
+            How many ticks to wait between each report of the outgoing packet backlog.
+        database_url (str): 
+            The URL of the user database. Defaults to the server's own SQLite database.
+        hash_rounds (int): 
+            The bcrypt cost factor new passwords are hashed with.
+        player_save_interval (int): 
+            How many ticks to wait between each save of the players who have moved.
+        relay (Optional[ShardRelay]): 
+            When the server is one shard of many, passes broadcasts to and from the other shards.
+        max_snapshots_per_tick (int):
+            Roughly how many players can be sent a snapshot each tick. With more players than this,
+            each is sent one every few ticks instead of every tick.
     """
-    def __init__(self, tick_rate: float) -> None:
-        self._db_session_factory: SessionMaker = get_session_factory(init_engine())
-        self._connected_protocols: list[GameProtocol] = []
+    def __init__(self, tick_rate: float, high_water_mark: int = 1024,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.MERGE,
+                 max_packets_per_batch: int = 256, max_bytes_per_batch: int = 64 * 1024,
+                 backlog_report_interval: int = 100, database_url: str = DATABASE_URL,
+                 hash_rounds: int = 12, player_save_interval: int = 100,
+                 relay: Optional[ShardRelay] = None, max_snapshots_per_tick: int = 800) -> None:
+        self._db_session_factory: SessionMaker = get_session_factory(init_engine(database_url))
+        self._auth: AuthWorker = AuthWorker(self._db_session_factory, hash_rounds=hash_rounds)
+        self._world: World = World()
+        self._players: PlayerStore = PlayerStore(self._db_session_factory, self._auth.database,
+                                                 self._auth.writes, player_save_interval)
+        self._registry: ConnectionRegistry = ConnectionRegistry()
+        self._relay: Optional[ShardRelay] = relay
+        self._chat: ChatRouter = ChatRouter(self._registry, self._world, relay)
+        self._snapshots: SnapshotTracker = SnapshotTracker(
+            self._world, max_per_tick=max_snapshots_per_tick)
         self._tick_rate: float = tick_rate
+        self._high_water_mark: int = high_water_mark
+        self._overflow_policy: OverflowPolicy = overflow_policy
+        self._max_packets_per_batch: int = max_packets_per_batch
+        self._max_bytes_per_batch: int = max_bytes_per_batch
+        self._backlog_report_interval: int = backlog_report_interval
         self._num_connections = 0
+        self._num_ticks = 0
+        self._accepting: trio.CancelScope = trio.CancelScope()
+        self._drain_reason: Optional[str] = None
+        self._reconnect_after: float = 0.0
+        self.backlog_total: int = 0
+        self.backlog_max: int = 0
+
+    @property
+    def auth(self) -> AuthWorker:
+        """
+        The worker that logs in and registers users for every protocol.
+        """
+        return self._auth
 
     async def handle_connection(self, request: WebSocketRequest):
         """
@@ -25,20 +114,166 @@ class GameServer:
         new connection is made. This function creates a new GameProtocol instance for the connection 
         and starts it.
         """
-        self._num_connections += 1
         logging.info("New connection")
-        connection: WebSocketConnection = await request.accept()
-        proto: GameProtocol = GameProtocol(connection, self._connected_protocols,
-                                           self._num_connections, self._db_session_factory)
-        self._connected_protocols.append(proto)
+        proto: GameProtocol = self.create_protocol(await request.accept())
         await proto.start()
 
+    def create_protocol(self, connection: WebSocketConnection) -> GameProtocol:
+        """
+        Creates a protocol for a connection that has been accepted, sharing the server's registry, 
+        auth worker and world. The protocol is not started.
+
+        Args:
+            connection (WebSocketConnection): 
+                The connection to the client, or anything that behaves like one.
+
+        Returns:
+            GameProtocol: The new protocol.
+        """
+        self._num_connections += 1
+        protocol: GameProtocol = GameProtocol(connection, self._registry, self._num_connections,
+                                              self._auth, self._world, self._high_water_mark,
+                                              self._overflow_policy,
+                                              max_packets_per_batch=self._max_packets_per_batch,
+                                              max_bytes_per_batch=self._max_bytes_per_batch,
+                                              players=self._players,
+                                              relay=self._relay, chat=self._chat,
+                                              snapshots=self._snapshots)
+        # Connections that were already being accepted when the server started draining
+        if self._drain_reason is not None:
+            protocol.drain(self._drain_reason, self._reconnect_after)
+        return protocol
+
     async def tick(self) -> None:
         """
-        Tells each connected protocol to tick.
+        Steps the world simulation, and queues a snapshot for every player whose view has changed
+        and the chat messages sent during the tick. The frames themselves are sent by each
+        protocol's own sender task. The tick's timings are recorded in `metrics.TICKS`, and every
+        `backlog_report_interval` ticks the depth of every protocol's outgoing queue is reported.
+        """
+        start: float = time.perf_counter()
+        dirty: np.ndarray = self._simulate()
+        simulated: float = time.perf_counter()
+        self._queue_snapshots(dirty)
+        self._chat.flush()
+        queued: float = time.perf_counter()
+        self._players.tick(self._world)
+
+        self._num_ticks += 1
+        elapsed: float = time.perf_counter() - start
+        metrics.TICKS.record(simulated - start, queued - simulated, elapsed,
+                             elapsed > self._tick_rate)
+
+        if self._num_ticks % self._backlog_report_interval == 0:
+            backlogs: list[int] = [protocol.backlog for protocol in self._registry]
+            self.backlog_total = sum(backlogs)
+            self.backlog_max = max(backlogs, default=0)
+            if self.backlog_total > 0:
+                logging.info("Outgoing packet backlog: %s total, %s max across %s clients",
+                             self.backlog_total, self.backlog_max, len(backlogs))
+            for lane in self._auth.lanes:
+                if lane.waiting > 0:
+                    logging.info("Auth %s", lane.summary())
+
+    def _simulate(self) -> np.ndarray:
+        world: World = self._world
+        changed: np.ndarray = world.step(self._tick_rate)
+        self._players.mark_dirty(changed)
+        self._chat.update_zones(changed)
+
+        # A player's view has changed if anything in it moved, or something came into or went out
+        # of it
+        return np.union1d(world.near_any(changed), world.drain_disturbed())
+
+    def _queue_snapshots(self, dirty: np.ndarray) -> None:
+        slots, frames = self._snapshots.build(dirty)
+        owners: list = self._world.owners
+        for slot, frame in zip(slots.tolist(), frames):
+            owners[slot].enqueue_frame(frame)
+
+    async def serve(self, host: str = 'localhost', port: int = 8081,
+                    metrics_port: Optional[int] = None,
+                    task_status=trio.TASK_STATUS_IGNORED) -> None:
+        """
+        Listens for websocket connections and runs the tick loop until cancelled, then saves every 
+        player's state.
+
+        Args:
+            host (str): The interface to listen on.
+            port (int): The port to listen on.
+            metrics_port (Optional[int]): If given, also serve metrics over HTTP on this port.
+        """
+        listen = partial(serve_websocket, self.handle_connection, host, port, None,
+                         max_message_size=MAX_INBOUND_MESSAGE_SIZE)
+        await self.serve_with(listen, metrics_port, task_status=task_status)
+
+    async def serve_with(self, listen: Callable[..., Awaitable[None]],
+                         metrics_port: Optional[int] = None,
+                         task_status=trio.TASK_STATUS_IGNORED) -> None:
+        """
+        Like `serve`, but accepts connections however `listen` does, e.g. over a Unix socket when 
+        the server is one shard of many.
+
+        Args:
+            listen (Callable[..., Awaitable[None]]): 
+                Started with `nursery.start` and a `handler_nursery`, which it should run its 
+                connection handlers in, so they outlive it when the server drains. Expected to
+                create and start a protocol for each connection with `create_protocol`.
+            metrics_port (Optional[int]): If given, also serve metrics over HTTP on this port.
+        """
+        metrics.TIMER.install()
+        tune_gc()
+        self._accepting = trio.CancelScope()
+        try:
+            async with trio.open_nursery() as nursery:
+                await nursery.start(self._listen, listen, nursery)
+                if metrics_port is not None:
+                    await nursery.start(metrics.serve_metrics, self.render_metrics, metrics_port)
+                if self._relay is not None:
+                    nursery.start_soon(self._relay.run, self._registry)
+                nursery.start_soon(self._players.run)
+                nursery.start_soon(self.run)
+                task_status.started()
+        finally:
+            # Every protocol has stopped by now, so this saves every player who was connected
+            with trio.CancelScope(shield=True):
+                await self._players.flush(self._world)
+                logging.info("Saved %s players", self._players.saves)
+
+    async def drain(self, timeout: float, reason: str = "Server restarting",
+                    reconnect_after: float = 5.0) -> None:
         """
-        for protocol in self._connected_protocols:
-            await protocol.tick()
+        Drains the server before it is stopped: stops accepting connections, then has every 
+        protocol send what it has queued, a fresh session token and a disconnect packet telling its 
+        client when to reconnect, before closing its connection. Cancel `serve` afterwards, which 
+        saves every player.
+
+        Args:
+            timeout (float): 
+                How many seconds to wait for every connection to close before giving up.
+            reason (str): 
+                The reason given to clients.
+            reconnect_after (float): 
+                How many seconds clients should wait before reconnecting, e.g. for the server to 
+                restart.
+        """
+        self._accepting.cancel()
+        self._drain_reason, self._reconnect_after = reason, reconnect_after
+        for protocol in self._registry:
+            protocol.drain(reason, reconnect_after)
+
+        with trio.move_on_after(timeout) as timeout_scope:
+            while len(self._registry):
+                await trio.sleep(0.05)
+        if timeout_scope.cancelled_caught:
+            logging.warning("Gave up draining %s connections", len(self._registry))
+        else:
+            logging.info("Drained every connection")
+
+    async def _listen(self, listen: Callable[..., Awaitable[None]], handler_nursery: trio.Nursery,
+                      task_status=trio.TASK_STATUS_IGNORED) -> None:
+        with self._accepting:
+            await listen(handler_nursery=handler_nursery, task_status=task_status)
 
     async def run(self) -> None:
         """
@@ -54,17 +289,131 @@ class GameServer:
             elif diff < 0:
                 logging.warning("Tick time budget exceeded by %s seconds", -diff)
 
+    def render_metrics(self) -> str:
+        """
+        Renders the server's metrics in the Prometheus text format.
+        """
+        writer: metrics.PrometheusWriter = metrics.PrometheusWriter()
+        ticks: metrics.TickProfiler = metrics.TICKS
+
+        writer.metric("game_ticks_total", "counter", "Ticks run", [({}, ticks.ticks)])
+        writer.metric("game_tick_overruns_total", "counter",
+                      "Ticks that exceeded their time budget", [({}, ticks.overruns)])
+        timings: list[tuple[dict[str, str], float]] = []
+        for phase, (p50, p99, maximum) in ticks.percentiles().items():
+            timings.append(({"phase": phase, "quantile": "0.5"}, p50))
+            timings.append(({"phase": phase, "quantile": "0.99"}, p99))
+            timings.append(({"phase": phase, "quantile": "1"}, maximum))
+        writer.metric("game_tick_phase_seconds", "summary",
+                      "Time spent in each phase of recent ticks", timings)
+
+        for direction, verb, counters in (("in", "received", metrics.INBOUND),
+                                          ("out", "sent", metrics.OUTBOUND)):
+            writer.metric(f"game_packets_{direction}_total", "counter", f"Packets {verb} by type",
+                          [({"type": name}, count) for name, count in counters.packets.items()])
+            writer.metric(f"game_bytes_{direction}_total", "counter",
+                          f"Bytes {verb} by packet type",
+                          [({"type": name}, count) for name, count in counters.bytes.items()])
+
+        protocols: list[GameProtocol] = list(self._registry)
+        writer.metric("game_connections", "gauge", "Connected clients", [({}, len(protocols))])
+        writer.metric("game_players", "gauge", "Players in the world", [({}, len(self._world))])
+        writer.metric("game_connection_queue_depth", "gauge",
+                      "Frames waiting in each connection's outgoing queue",
+                      [({"connection": str(p.ident)}, p.backlog) for p in protocols])
+        writer.metric("game_connection_bytes_in_total", "counter", "Bytes received per connection",
+                      [({"connection": str(p.ident)}, p.bytes_in) for p in protocols])
+        writer.metric("game_connection_bytes_out_total", "counter", "Bytes sent per connection",
+                      [({"connection": str(p.ident)}, p.bytes_out) for p in protocols])
+        writer.metric("game_connection_dropped_total", "counter",
+                      "Outgoing frames dropped or merged per connection",
+                      [({"connection": str(p.ident)}, p.dropped) for p in protocols])
 
-async def main() -> None:
+        writer.metric("game_auth_jobs_total", "counter", "Auth jobs completed per lane",
+                      [({"lane": lane.name}, lane.completed) for lane in self._auth.lanes])
+        writer.metric("game_auth_queue_seconds_total", "counter",
+                      "Seconds auth jobs spent waiting for a worker thread",
+                      [({"lane": lane.name}, lane.queue_time_total) for lane in self._auth.lanes])
+        writer.metric("game_auth_queue_seconds_max", "gauge",
+                      "Longest an auth job has waited for a worker thread",
+                      [({"lane": lane.name}, lane.queue_time_max) for lane in self._auth.lanes])
+        writer.metric("game_auth_run_seconds_total", "counter", "Seconds auth jobs spent running",
+                      [({"lane": lane.name}, lane.run_time_total) for lane in self._auth.lanes])
+        writer.metric("game_auth_waiting", "gauge", "Auth jobs waiting for a worker thread",
+                      [({"lane": lane.name}, lane.waiting) for lane in self._auth.lanes])
+        cache: UserCache = self._auth.users
+        writer.metric("game_user_cache_lookups_total", "counter", "User cache lookups by result",
+                      [({"result": "hit"}, cache.hits), ({"result": "absent"}, cache.absent_hits),
+                       ({"result": "miss"}, cache.misses)])
+        writer.metric("game_user_cache_entries", "gauge", "Users and absent usernames cached",
+                      [({}, len(cache))])
+        writer.metric("game_player_saves_total", "counter", "Player states saved",
+                      [({}, self._players.saves)])
+        writer.metric("game_player_saves_pending", "gauge", "Player states waiting to be saved",
+                      [({}, self._players.pending)])
+        writer.metric("game_db_write_batches_total", "counter",
+                      "Write-behind transactions committed", [({}, self._auth.writes.batches)])
+        writer.metric("game_db_writes_total", "counter",
+                      "Writes committed by the write-behind queue",
+                      [({}, self._auth.writes.writes)])
+        writer.metric("game_chat_messages_total", "counter", "Chat messages delivered",
+                      [({}, self._chat.messages)])
+        writer.metric("game_chat_frames_total", "counter", "Chat batch frames encoded",
+                      [({}, self._chat.frames)])
+        return writer.render()
+
+
+async def main(metrics_port: Optional[int] = None) -> None:
     """
-    Serves the websocket server and handles new connections.
+    Serves the websocket server and handles new connections until SIGTERM or SIGINT, then drains 
+    the server so clients can reconnect and resume their sessions once it is back.
+
+    Args:
+        metrics_port (Optional[int]): 
+            If given, also serve the server's metrics over HTTP on this port.
     """
     server: GameServer = GameServer(1/20)
-    async with trio.open_nursery() as nursery:
-        nursery.start_soon(serve_websocket, server.handle_connection, 'localhost', 8081, None)
-        nursery.start_soon(server.run)
+    await serve_until_signalled(partial(server.serve, 'localhost', 8081, metrics_port),
+                                server.drain)
 
 if __name__ == '__main__':
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Runs the game server.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics over HTTP on this port (off by default)")
+    parser.add_argument("--trace", action="store_true",
+                        help="Log every packet sent and received as text, at DEBUG level")
+    parser.add_argument("--trace-sample", type=float, default=1.0,
+                        help="Only trace this fraction of packets, e.g. 0.01 for 1 in 100")
+    parser.add_argument("--capture", default=None,
+                        help="Capture every raw frame sent and received to this file")
+    parser.add_argument("--capture-max-mb", type=int, default=64,
+                        help="Rotate the capture file once it reaches this size")
+    parser.add_argument("--capture-backups", type=int, default=5,
+                        help="How many rotated capture files to keep")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="Run this many worker processes behind a gateway. Each serves its "
+                             "metrics on --metrics-port plus its index. Cannot be combined with "
+                             "--trace or --capture.")
+    args: argparse.Namespace = parser.parse_args()
+    # The gateway never decodes packets, and the workers are not told to trace them
+    if args.shards is not None and (args.trace or args.capture is not None):
+        parser.error("--trace and --capture cannot be used with --shards")
+
     logging.basicConfig(level=logging.INFO)
+    if args.trace:
+        logging.getLogger(trace.__name__).setLevel(logging.DEBUG)
+    capture: Optional[trace.PacketCapture] = None
+    if args.capture is not None:
+        capture = trace.PacketCapture(args.capture, args.capture_max_mb * 1024 * 1024,
+                                      args.capture_backups)
+    trace.TRACER.configure(args.trace_sample, capture)
+
     logging.info("Server starting")
-    trio.run(main)
+    try:
+        if args.shards is not None:
+            from server.shard import gateway  # pylint: disable=import-outside-toplevel
+            trio.run(gateway.main, args.shards, 'localhost', 8081, args.metrics_port)
+        else:
+            trio.run(main, args.metrics_port)
+    finally:
+        trace.TRACER.close()
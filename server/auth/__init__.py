@@ -0,0 +1,9 @@
+"""
+This package contains the authentication subsystem. Password hashing and the database queries made 
+while logging in or registering are slow and blocking, so they are run on worker threads instead of 
+on the trio event loop, and the users looked up are cached in memory. Clients that were logged in
+can resume their session with a signed token instead, which is cheap to check, until they log out.
+"""
+from server.auth.cache import UserCache
+from server.auth.session import SessionTokens, load_session_secret
+from server.auth.worker import MAX_PASSWORD_BYTES, AuthWorker, WorkLane
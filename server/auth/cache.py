@@ -0,0 +1,122 @@
+"""
+This module contains the user cache, which keeps recently looked up users in memory so that logins
+and registrations do not all have to query the database.
+
+Usernames that were looked up and not found are cached too, separately and for less time. That way
+registrations can check whether a name is free without reaching the database, and a flood of
+logins for made-up names cannot push real users out of the cache.
+
+Example usage:
+    cache = UserCache()
+    found, user = cache.get("alice")
+    if not found:
+        user = query_user("alice")
+        cache.put("alice", user)
+"""
+import time
+from collections import OrderedDict
+from typing import Optional
+from server.models import User
+
+
+class UserCache:
+    """
+    A bounded cache of users keyed by username, evicting the least recently used entries once full
+    and expiring entries after a while, so changes made to the database by other processes are
+    eventually picked up.
+
+    Lookups that race with a change to the same user should not cache what they found, since it
+    may already be stale. Take a `version` before starting the lookup and pass it to `put`, which
+    ignores the result if anything has been invalidated since.
+
+    Args:
+        max_users (int): The maximum number of users to keep.
+        ttl (float): How many seconds a user is kept for.
+        max_absent (int): The maximum number of absent usernames to keep.
+        absent_ttl (float): How many seconds an absent username is kept for.
+
+    Attributes:
+        hits (int): The number of lookups answered with a user.
+        absent_hits (int): The number of lookups answered with a username being absent.
+        misses (int): The number of lookups the cache could not answer.
+        version (int): Increases every time an entry is invalidated.
+    """
+    def __init__(self, max_users: int = 10000, ttl: float = 300, max_absent: int = 10000,
+                 absent_ttl: float = 30) -> None:
+        self._users: OrderedDict[str, tuple[float, User]] = OrderedDict()
+        self._absent: OrderedDict[str, float] = OrderedDict()
+        self._max_users: int = max_users
+        self._ttl: float = ttl
+        self._max_absent: int = max_absent
+        self._absent_ttl: float = absent_ttl
+        self.hits: int = 0
+        self.absent_hits: int = 0
+        self.misses: int = 0
+        self.version: int = 0
+
+    def __len__(self) -> int:
+        return len(self._users) + len(self._absent)
+
+    def get(self, username: str) -> tuple[bool, Optional[User]]:
+        """
+        Looks up a user.
+
+        Returns:
+            tuple[bool, Optional[User]]:
+                Whether the cache knew the answer, and if so, the user, or None if there is no such
+                user.
+        """
+        now: float = time.monotonic()
+        entry: Optional[tuple[float, User]] = self._users.get(username)
+        if entry is not None:
+            if entry[0] > now:
+                self._users.move_to_end(username)
+                self.hits += 1
+                return True, entry[1]
+            del self._users[username]
+
+        expires: Optional[float] = self._absent.get(username)
+        if expires is not None:
+            if expires > now:
+                self.absent_hits += 1
+                return True, None
+            del self._absent[username]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, username: str, user: Optional[User], version: Optional[int] = None) -> None:
+        """
+        Caches the result of looking up a user.
+
+        Args:
+            username (str): The username that was looked up.
+            user (Optional[User]): The user, or None if there is no such user.
+            version (Optional[int]): The cache's `version` when the lookup started. If anything has
+                been invalidated since, the result is not cached.
+        """
+        if version is not None and version != self.version:
+            return
+
+        now: float = time.monotonic()
+        if user is None:
+            self._absent[username] = now + self._absent_ttl
+            self._absent.move_to_end(username)
+            if len(self._absent) > self._max_absent:
+                self._absent.popitem(last=False)
+            return
+
+        self._absent.pop(username, None)
+        self._users[username] = (now + self._ttl, user)
+        self._users.move_to_end(username)
+        if len(self._users) > self._max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        """
+        Forgets what is known about a user, e.g. because they have just registered or changed their
+        password.
+        """
+        self._users.pop(username, None)
+        self._absent.pop(username, None)
+        self.version += 1
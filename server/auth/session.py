@@ -0,0 +1,125 @@
+"""
+This module contains session tokens, which let a client that was logged in get straight back into
+the game after reconnecting, e.g. because the server restarted, without its password being checked
+again. Checking a token is a single HMAC, where checking a password is a deliberately slow bcrypt
+hash, so a restart does not leave every returning player queueing for the hashing lane.
+
+A token names the user and when it was issued, signed with a secret key, and is accepted for a
+while after that. Tokens are not stored anywhere, so any server process with the same key can check
+them. The key is read from the `GAME_SESSION_SECRET` environment variable if it is set, or else
+from a key file next to the database, which is created the first time it is needed.
+
+Tokens are revoked by storing when each user last logged out rather than the tokens themselves, see
+`AuthWorker.resume_session`, which turns away any token issued before then.
+
+Example usage:
+    tokens = SessionTokens(load_session_secret())
+    token = tokens.issue(user.id, user.username)
+    ...
+    session = tokens.verify(token)
+    if session is not None:
+        user_id, username, issued = session
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import time
+from typing import Optional
+from server.database import DB_PATH
+
+SESSION_KEY_PATH: str = os.path.join(DB_PATH, "session.key")
+
+
+def load_session_secret(path: str = SESSION_KEY_PATH) -> bytes:
+    """
+    Returns the key session tokens are signed with, from `GAME_SESSION_SECRET` if it is set, or
+    else from the key file at `path`, which is created with a random key if it does not exist.
+    Processes that start at the same time all end up with the same key.
+    """
+    secret: Optional[str] = os.environ.get("GAME_SESSION_SECRET")
+    if secret:
+        return secret.encode()
+
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+
+    # Write the key under a temporary name and link it into place, which fails if another process
+    # got there first, so nobody ever reads a half-written key
+    temp_path: str = f"{path}.{os.getpid()}"
+    fd: int = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(os.urandom(32))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(temp_path)
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+class SessionTokens:
+    """
+    Issues and checks signed session tokens.
+
+    Args:
+        secret (bytes): The key tokens are signed with.
+        ttl (float): How many seconds a token is valid for after it is issued.
+    """
+    def __init__(self, secret: bytes, ttl: float = 600) -> None:
+        if not secret:
+            raise ValueError("The session secret must not be empty")
+        self._secret: bytes = secret
+        self._ttl: float = ttl
+
+    def issue(self, user_id: int, username: str) -> str:
+        """
+        Returns a new token for a user.
+        """
+        # In milliseconds, so a token issued just after its user's sessions were revoked is not
+        # taken for one issued before
+        issued: int = int(time.time() * 1000)
+        payload: bytes = f"{user_id}:{issued}:{username}".encode()
+        return f"{_encode(payload)}.{_encode(self._sign(payload))}"
+
+    def verify(self, token: str) -> Optional[tuple[int, str, float]]:
+        """
+        Checks a token's signature and age. Whether the user's sessions have been revoked since it
+        was issued is not checked here.
+
+        Returns:
+            Optional[tuple[int, str, float]]: The ID and username of the user the token was issued
+            to, and when it was issued, or None if the token is malformed, forged or expired.
+        """
+        try:
+            encoded_payload, encoded_signature = token.split(".")
+            payload: bytes = _decode(encoded_payload)
+            signature: bytes = _decode(encoded_signature)
+        except (ValueError, binascii.Error):
+            return None
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+
+        user_id, issued_ms, username = payload.decode().split(":", 2)
+        issued: float = int(issued_ms) / 1000
+        if issued + self._ttl < time.time():
+            return None
+        return int(user_id), username, issued
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self._secret, payload, hashlib.sha256).digest()
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
@@ -0,0 +1,295 @@
+"""
+This module contains the auth worker, which runs password hashing and user database queries on 
+bounded pools of worker threads so they never block the trio event loop.
+
+bcrypt releases the GIL while it hashes, so hashing on threads scales across cores without needing 
+a process pool. Database work runs on its own lane. Lookups run side by side, which WAL mode allows 
+SQLite to do, while new users are written through a write-behind queue that commits concurrent 
+registrations in a single transaction.
+
+Example usage:
+    auth = AuthWorker(session_factory)
+    user = await auth.find_user("alice")
+    if user is not None and await auth.check_password("hunter2", user.password):
+        ...
+"""
+import os
+import time
+from functools import partial
+from typing import Callable, Optional, TypeVar
+import bcrypt
+import trio
+from sqlalchemy import Select, bindparam, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from server.auth.cache import UserCache
+from server.auth.session import SessionTokens, load_session_secret
+from server.database import SessionMaker
+from server.database.writer import WriteBehindQueue
+from server.models import SessionRevocation, User
+
+T = TypeVar('T')
+
+# bcrypt only looks at a password's first 72 bytes, and refuses longer ones outright
+MAX_PASSWORD_BYTES: int = 72
+
+# Built once, so SQLAlchemy compiles it once and the driver can reuse its prepared statement
+_FIND_USER: Select = select(User).where(User.username == bindparam("username"))
+
+
+class WorkLane:
+    """
+    A bounded pool of worker threads that blocking jobs can be awaited on, keeping track of how 
+    long jobs wait for a free thread and how long they take to run.
+
+    Args:
+        name (str): 
+            The name of the lane, used when reporting its metrics.
+        max_workers (int): 
+            The maximum number of jobs that can run at once. Further jobs wait their turn.
+
+    Attributes:
+        completed (int): The number of jobs that have finished, successfully or not.
+        queue_time_total (float): The total number of seconds jobs have spent waiting.
+        queue_time_max (float): The longest number of seconds a single job has spent waiting.
+        run_time_total (float): The total number of seconds jobs have spent running.
+    """
+    def __init__(self, name: str, max_workers: int) -> None:
+        self.name: str = name
+        self._limiter: trio.CapacityLimiter = trio.CapacityLimiter(max_workers)
+        self.completed: int = 0
+        self.queue_time_total: float = 0.0
+        self.queue_time_max: float = 0.0
+        self.run_time_total: float = 0.0
+
+    @property
+    def waiting(self) -> int:
+        """
+        The number of jobs waiting for a free thread.
+        """
+        return self._limiter.statistics().tasks_waiting
+
+    @property
+    def running(self) -> int:
+        """
+        The number of jobs currently running.
+        """
+        return self._limiter.borrowed_tokens
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """
+        Runs `func(*args)` on a worker thread once one is free, and waits for the result.
+
+        Returns:
+            T: Whatever `func` returns. Any exception it raises is re-raised here.
+        """
+        submitted: float = time.perf_counter()
+        started: Optional[float] = None
+
+        def job() -> T:
+            nonlocal started
+            started = time.perf_counter()
+            return func(*args)
+
+        try:
+            return await trio.to_thread.run_sync(job, limiter=self._limiter)
+        finally:
+            # Jobs cancelled before reaching a thread are not counted
+            if started is not None:
+                queue_time: float = started - submitted
+                self.completed += 1
+                self.queue_time_total += queue_time
+                self.queue_time_max = max(self.queue_time_max, queue_time)
+                self.run_time_total += time.perf_counter() - started
+
+    def summary(self) -> str:
+        """
+        Returns a one-line, human-readable summary of the lane's metrics, for logging.
+        """
+        mean_queue_ms: float = (1000 * self.queue_time_total / self.completed
+                                 if self.completed else 0)
+        mean_run_ms: float = 1000 * self.run_time_total / self.completed if self.completed else 0
+        return (f"{self.name}: {self.completed} done, {self.waiting} waiting, "
+                f"{self.running} running, "
+                f"queue {mean_queue_ms:.1f}ms mean/{1000 * self.queue_time_max:.1f}ms max, "
+                f"run {mean_run_ms:.1f}ms mean")
+
+
+class AuthWorker:
+    """
+    Runs the blocking work needed to log in and register users off the event loop.
+
+    Args:
+        session_factory (SessionMaker): 
+            The factory used to create database sessions.
+        max_hashers (Optional[int]): 
+            The maximum number of passwords hashed or checked at once. Defaults to one less than the 
+            number of CPUs, so the event loop keeps a core to itself.
+        max_db_workers (int): 
+            The maximum number of database jobs run at once. Only one batch of writes is ever 
+            committed at a time, so the rest of the workers serve lookups.
+        max_waiting (int): 
+            How many jobs can be waiting on either lane before the worker reports itself as busy.
+        hash_rounds (int): 
+            The bcrypt cost factor new passwords are hashed with. Existing hashes are checked with 
+            whatever cost they were made with.
+        user_cache (Optional[UserCache]): 
+            Caches the users looked up. Defaults to a cache with the default limits.
+        session_tokens (Optional[SessionTokens]): 
+            Issues and checks session tokens. Defaults to tokens signed with the key from 
+            `load_session_secret`.
+
+    Attributes:
+        hashing (WorkLane): The lane password hashing and checking runs on.
+        database (WorkLane): The lane database queries run on.
+        writes (WriteBehindQueue): Batches the inserts made by registrations.
+        users (UserCache): The users recently looked up, and the usernames known to be free.
+        sessions (SessionTokens): Issues and checks session tokens.
+    """
+    def __init__(self, session_factory: SessionMaker, max_hashers: Optional[int] = None,
+                 max_db_workers: int = 4, max_waiting: int = 64, hash_rounds: int = 12,
+                 user_cache: Optional[UserCache] = None,
+                 session_tokens: Optional[SessionTokens] = None) -> None:
+        if max_hashers is None:
+            max_hashers = max(1, (os.cpu_count() or 1) - 1)
+        self._session_factory: SessionMaker = session_factory
+        self.hashing: WorkLane = WorkLane("hashing", max_hashers)
+        self.database: WorkLane = WorkLane("database", max_db_workers)
+        self.writes: WriteBehindQueue = WriteBehindQueue(session_factory, self.database)
+        self.users: UserCache = user_cache if user_cache is not None else UserCache()
+        self.sessions: SessionTokens = (session_tokens if session_tokens is not None
+                                        else SessionTokens(load_session_secret()))
+        self._max_waiting: int = max_waiting
+        self._hash_rounds: int = hash_rounds
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether so many jobs are already waiting that new logins and registrations should be turned 
+        away rather than queued.
+        """
+        return max(self.hashing.waiting, self.database.waiting) >= self._max_waiting
+
+    @property
+    def lanes(self) -> tuple[WorkLane, ...]:
+        """
+        All of the worker's lanes, for reporting.
+        """
+        return (self.hashing, self.database)
+
+    async def hash_password(self, password: str) -> bytes:
+        """
+        Hashes a password with a fresh salt.
+
+        Raises:
+            ValueError: If the password is longer than `MAX_PASSWORD_BYTES` once encoded.
+        """
+        return await self.hashing.run(_hash_password, password, self._hash_rounds)
+
+    async def check_password(self, password: str, pw_hash: bytes) -> bool:
+        """
+        Checks whether a password matches a hash made by `hash_password`. Passwords too long to
+        have been hashed never match.
+        """
+        encoded: bytes = password.encode()
+        if len(encoded) > MAX_PASSWORD_BYTES:
+            return False
+        return await self.hashing.run(bcrypt.checkpw, encoded, pw_hash)
+
+    async def find_user(self, username: str) -> Optional[User]:
+        """
+        Looks up a user by username, from the user cache if possible.
+
+        Returns:
+            Optional[User]: The user, detached from its session, or None if there is no such user.
+
+        Raises:
+            SQLAlchemyError: If the query fails.
+        """
+        found, user = self.users.get(username)
+        if found:
+            return user
+
+        version: int = self.users.version
+        user = await self.database.run(self._find_user, username)
+        self.users.put(username, user, version)
+        return user
+
+    async def create_user(self, username: str, pw_hash: bytes) -> bool:
+        """
+        Creates a new user.
+
+        Returns:
+            bool: True if the user was created, or False if the username is already taken.
+
+        Raises:
+            SQLAlchemyError: If the insert fails for any other reason.
+        """
+        try:
+            await self.writes.write(partial(_insert_user, username, pw_hash))
+        except IntegrityError:
+            return False
+        finally:
+            # Whether it was just created or someone else beat us to it, the name is no longer free
+            self.users.invalidate(username)
+        return True
+
+    async def resume_session(self, token: str) -> Optional[tuple[int, str]]:
+        """
+        Checks a session token, including that its user's sessions have not been revoked since it
+        was issued.
+
+        Returns:
+            Optional[tuple[int, str]]: The ID and username of the user the token was issued to, or
+            None if the token is not valid.
+
+        Raises:
+            SQLAlchemyError: If the query fails.
+        """
+        verified: Optional[tuple[int, str, float]] = self.sessions.verify(token)
+        if verified is None:
+            return None
+        user_id, username, issued = verified
+        revoked_at: Optional[float] = await self.database.run(self._find_revocation, user_id)
+        if revoked_at is not None and issued <= revoked_at:
+            return None
+        return user_id, username
+
+    async def revoke_sessions(self, user_id: int) -> None:
+        """
+        Stops every session token issued to a user so far from being accepted. Call this when they
+        log out, or after changing their password.
+
+        Raises:
+            SQLAlchemyError: If the write fails.
+        """
+        await self.writes.write(partial(_revoke_sessions, user_id, time.time()))
+
+    def invalidate_user(self, username: str) -> None:
+        """
+        Drops a user from the cache. Call this after changing a user's row in the database, e.g. 
+        their password, so the old row is not used to log them in.
+        """
+        self.users.invalidate(username)
+
+    def _find_user(self, username: str) -> Optional[User]:
+        with self._session_factory() as session:
+            return session.execute(_FIND_USER, {"username": username}).scalar_one_or_none()
+
+    def _find_revocation(self, user_id: int) -> Optional[float]:
+        with self._session_factory() as session:
+            revocation: Optional[SessionRevocation] = session.get(SessionRevocation, user_id)
+            return revocation.revoked_at if revocation is not None else None
+
+
+def _insert_user(username: str, pw_hash: bytes, session: Session) -> None:
+    session.add(User(username=username, password=pw_hash))
+    session.flush()
+
+
+def _revoke_sessions(user_id: int, revoked_at: float, session: Session) -> None:
+    session.merge(SessionRevocation(user_id=user_id, revoked_at=revoked_at))
+
+
+def _hash_password(password: str, rounds: int) -> bytes:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds))
@@ -0,0 +1,4 @@
+"""
+This package contains benchmarks for the server. Each module can be run on its own, e.g.
+`python -m server.bench.broadcast`, and prints its results to the console.
+"""
@@ -0,0 +1,103 @@
+"""
+Benchmarks the cost of broadcasting a single chat message as the number of connected players grows.
+
+The protocols are driven without real sockets: each one writes to a connection that discards 
+everything sent to it, so the numbers only cover encoding, queueing and sending on the server side.
+The same broadcasts are also timed the way the server used to send them, with every recipient's
+copy of the packet serialized separately, through the same queues and sender tasks.
+
+Usage:
+    python -m server.bench.broadcast [--players 1 10 100 1000] [--messages 200]
+"""
+import argparse
+import time
+import trio
+import trio.testing
+import server.net as packets
+from server.protocol import GameProtocol
+from server.protocol.registry import ConnectionRegistry
+
+
+class NullConnection:
+    """
+    Stands in for a `WebSocketConnection`, discarding every message sent to it.
+    """
+    def __init__(self) -> None:
+        self.bytes_sent: int = 0
+        self.closed = None
+
+    async def send_message(self, message: bytes) -> None:
+        """
+        Discards the message, only counting its size.
+        """
+        self.bytes_sent += len(message)
+
+    async def get_message(self) -> bytes:
+        """
+        Never returns, as if the client never sends anything.
+        """
+        await trio.sleep_forever()
+
+    async def aclose(self, code: int = 1000, reason: str = None) -> None:
+        """
+        Marks the connection as closed.
+        """
+        self.closed = (code, reason)
+
+
+async def bench_broadcast(num_players: int, num_messages: int,
+                          per_recipient: bool = False) -> float:
+    """
+    Broadcasts `num_messages` chat messages from the first protocol, waiting each time until every 
+    protocol's sender task has written the message out.
+
+    Args:
+        num_players (int): How many protocols are connected.
+        num_messages (int): How many messages to broadcast.
+        per_recipient (bool):
+            Whether to serialize the packet for each recipient, as the server used to, rather than
+            once for all of them.
+
+    Returns:
+        float: The average number of seconds spent per message.
+    """
+    registry: ConnectionRegistry = ConnectionRegistry()
+    async with trio.open_nursery() as nursery:
+        for ident in range(num_players):
+            protocol: GameProtocol = GameProtocol(NullConnection(), registry, ident, None, None)
+            nursery.start_soon(protocol.start)
+        await trio.testing.wait_all_tasks_blocked()
+
+        sender: GameProtocol = registry.get(0)
+        start: float = time.perf_counter()
+        for i in range(num_messages):
+            packet: packets.Packet = packets.chat(f"Message number {i}")
+            if per_recipient:
+                for recipient in registry:
+                    recipient.queue_outbound_packet(recipient, packets.Frame(packet))
+            else:
+                sender.broadcast_packet(packet, include_self=True)
+            await trio.testing.wait_all_tasks_blocked()
+        elapsed: float = time.perf_counter() - start
+        nursery.cancel_scope.cancel()
+    return elapsed / num_messages
+
+
+async def main(player_counts: list[int], num_messages: int) -> None:
+    """
+    Runs the benchmark for each player count and prints a table of the results.
+    """
+    print(f"{'players':>8} {'us/message':>12} {'us/recipient':>14} {'us/message (old)':>18}")
+    for num_players in player_counts:
+        per_message: float = await bench_broadcast(num_players, num_messages)
+        old: float = await bench_broadcast(num_players, num_messages, per_recipient=True)
+        print(f"{num_players:>8} {per_message * 1e6:>12.1f} "
+              f"{per_message * 1e6 / num_players:>14.3f} {old * 1e6:>18.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('--players', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+    trio.run(main, args.players, args.messages)
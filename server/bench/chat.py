@@ -0,0 +1,124 @@
+"""
+Benchmarks busy chat with many players connected, comparing broadcasting each message to everyone
+as soon as it arrives, as the server used to, against the chat router, which batches every message
+sent to a channel during a tick into one frame.
+
+Every player is a protocol in the play state, spread over the world's chat zones, writing to a
+connection that discards everything sent to it. Each tick, a number of random players each send a
+message, most to global chat and the rest to their zone.
+
+Usage:
+    python -m server.bench.chat [--players 1000] [--messages-per-tick 50] [--ticks 100]
+"""
+import argparse
+import random
+import time
+import trio
+import trio.testing
+import server.net as packets
+from server.bench.broadcast import NullConnection
+from server.models import PlayerState
+from server.net import ChatChannel
+from server.protocol import GameProtocol, states
+from server.protocol.chat import ChatRouter, ZONE_SIZE
+from server.protocol.ratelimit import RateLimiter
+from server.protocol.registry import ConnectionRegistry
+from server.world import World
+
+
+class CountingConnection(NullConnection):
+    """
+    Discards every message sent to it, counting them and their size.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.frames_sent: int = 0
+
+    async def send_message(self, message: bytes) -> None:
+        """
+        Discards the message, only counting it.
+        """
+        self.frames_sent += 1
+        self.bytes_sent += len(message)
+
+
+async def bench_chat(num_players: int, messages_per_tick: int, num_ticks: int, batched: bool,
+                     zone_share: float, seed: int) -> dict[str, float]:
+    """
+    Runs `num_ticks` ticks of chat, waiting after each until every frame has been written out.
+
+    Returns:
+        dict[str, float]: The time per tick and the frames and bytes sent per tick.
+    """
+    rng: random.Random = random.Random(seed)
+    registry: ConnectionRegistry = ConnectionRegistry()
+    world: World = World()
+    router: ChatRouter = ChatRouter(registry, world)
+    connections: list[CountingConnection] = []
+    protocols: list[GameProtocol] = []
+    zones_across: int = 4
+
+    async with trio.open_nursery() as nursery:
+        for ident in range(1, num_players + 1):
+            connection: CountingConnection = CountingConnection()
+            protocol: GameProtocol = GameProtocol(connection, registry, ident, None, world,
+                                                  chat=router if batched else None)
+            protocol.rate_limiter = RateLimiter(enabled=False)
+            protocol.username = f"player{ident}"
+            registry.set_username(protocol, protocol.username)
+            protocol.saved_state = PlayerState(x=rng.uniform(0, zones_across * ZONE_SIZE),
+                                               y=rng.uniform(0, zones_across * ZONE_SIZE))
+            protocol.set_state(states.PlayState)
+            connections.append(connection)
+            protocols.append(protocol)
+            nursery.start_soon(protocol.start)
+        await trio.testing.wait_all_tasks_blocked()
+        frames_before: int = sum(connection.frames_sent for connection in connections)
+        bytes_before: int = sum(connection.bytes_sent for connection in connections)
+
+        elapsed: float = 0.0
+        for tick in range(num_ticks):
+            messages: list[tuple[GameProtocol, packets.Packet]] = []
+            for i in range(messages_per_tick):
+                channel: int = ChatChannel.ZONE if rng.random() < zone_share else ChatChannel.GLOBAL
+                messages.append((rng.choice(protocols),
+                                 packets.chat(f"Message {i} of tick {tick}", channel).chat))
+
+            start: float = time.perf_counter()
+            for sender, message in messages:
+                await sender.state.handle_chat_packet(message)
+            if batched:
+                router.flush()
+            await trio.testing.wait_all_tasks_blocked()
+            elapsed += time.perf_counter() - start
+        nursery.cancel_scope.cancel()
+
+    frames: int = sum(connection.frames_sent for connection in connections) - frames_before
+    num_bytes: int = sum(connection.bytes_sent for connection in connections) - bytes_before
+    return {"ms_per_tick": 1000 * elapsed / num_ticks, "frames_per_tick": frames / num_ticks,
+            "kb_per_tick": num_bytes / num_ticks / 1024}
+
+
+async def main(num_players: int, messages_per_tick: int, num_ticks: int, zone_share: float) -> None:
+    """
+    Runs the benchmark both ways and prints a table of the results.
+    """
+    print(f"{num_players} players, {messages_per_tick} messages per tick, "
+          f"{zone_share:.0%} of them to zone chat")
+    print(f"{'mode':<12}{'ms/tick':>10}{'frames/tick':>14}{'KiB/tick':>11}")
+    for batched in (False, True):
+        results: dict[str, float] = await bench_chat(num_players, messages_per_tick, num_ticks,
+                                                     batched, zone_share, seed=1)
+        print(f"{'batched' if batched else 'immediate':<12}{results['ms_per_tick']:>10.2f}"
+              f"{results['frames_per_tick']:>14.0f}{results['kb_per_tick']:>11.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--messages-per-tick', type=int, default=50)
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--zone-share', type=float, default=0.2,
+                        help="The fraction of messages sent to zone chat rather than global chat")
+    args = parser.parse_args()
+    trio.run(main, args.players, args.messages_per_tick, args.ticks, args.zone_share)
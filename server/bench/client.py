@@ -0,0 +1,139 @@
+"""
+This module contains a headless client that speaks the game protocol over a real websocket, for
+driving a server under load.
+
+Example usage:
+    async with trio.open_nursery() as nursery:
+        client = HeadlessClient("alice")
+        await client.connect(nursery, "ws://localhost:8081")
+        await client.register("hunter2")
+        reply = await client.login("hunter2")
+        if reply.WhichOneof("type") == "ok":
+            await client.chat("Hello!")
+"""
+from typing import Callable, Optional
+import trio
+from trio_websocket import WebSocketConnection, ConnectionClosed, connect_websocket_url
+import server.net as packets
+
+
+class HeadlessClient:
+    """
+    A simulated player. Once connected, a background task reads everything the server sends:
+    snapshots are acknowledged straight away, replies to requests are handed back to whoever is
+    awaiting them, and chat messages are passed to `on_chat`. Ok and deny packets that arrive while
+    no request is waiting for a reply, e.g. being told to slow down, are only counted.
+
+    Args:
+        username (str):
+            The name to register and log in with.
+        on_chat (Optional[Callable[[str, float], None]]):
+            Called with the message and the time it arrived whenever a chat message is received.
+            Times are from `trio.current_time()`.
+
+    Attributes:
+        received (dict[str, int]): The number of packets received of each type.
+        bytes_received (int): The number of bytes received.
+        closed (bool): Whether the connection has been closed, by either side.
+    """
+    def __init__(self, username: str,
+                 on_chat: Optional[Callable[[str, float], None]] = None) -> None:
+        self.username: str = username
+        self._on_chat: Optional[Callable[[str, float], None]] = on_chat
+        self._connection: Optional[WebSocketConnection] = None
+        self._replies_in, self._replies_out = trio.open_memory_channel(16)
+        self._replies_owed: int = 0
+        self.received: dict[str, int] = {}
+        self.bytes_received: int = 0
+        self.closed: bool = False
+
+    async def connect(self, nursery: trio.Nursery, url: str) -> None:
+        """
+        Opens the websocket connection and starts reading from it in the background.
+
+        Args:
+            nursery (trio.Nursery): The nursery the connection's background tasks run in.
+            url (str): The server's websocket URL, e.g. "ws://localhost:8081".
+        """
+        self._connection = await connect_websocket_url(nursery, url)
+        nursery.start_soon(self._receive_loop)
+
+    async def register(self, password: str) -> packets.Packet:
+        """
+        Registers the client's username.
+
+        Returns:
+            packets.Packet: The server's ok or deny reply.
+        """
+        return await self._request(packets.register(self.username, password))
+
+    async def login(self, password: str) -> packets.Packet:
+        """
+        Logs in with the client's username.
+
+        Returns:
+            packets.Packet: The server's ok or deny reply.
+        """
+        return await self._request(packets.login(self.username, password))
+
+    async def chat(self, msg: str) -> None:
+        """
+        Sends a chat message.
+        """
+        await self._send(packets.chat(msg))
+
+    async def direction(self, dx: float, dy: float) -> None:
+        """
+        Sets the direction the client's player is moving in.
+        """
+        await self._send(packets.direction(dx, dy))
+
+    async def close(self) -> None:
+        """
+        Closes the connection.
+        """
+        self.closed = True
+        if self._connection is not None:
+            await self._connection.aclose()
+
+    async def _request(self, packet: packets.Packet) -> packets.Packet:
+        self._replies_owed += 1
+        await self._send(packet)
+        try:
+            return await self._replies_out.receive()
+        except trio.EndOfChannel:
+            return packets.deny("Connection closed")
+
+    async def _send(self, packet: packets.Packet) -> None:
+        try:
+            await self._connection.send_message(packet.SerializeToString())
+        except ConnectionClosed:
+            self.closed = True
+
+    async def _receive_loop(self) -> None:
+        async with self._replies_in:
+            while True:
+                try:
+                    data: bytes = await self._connection.get_message()
+                except ConnectionClosed:
+                    self.closed = True
+                    return
+
+                self.bytes_received += len(data)
+                packet: packets.Packet = packets.Packet.FromString(data)
+                packet_type: str = packet.WhichOneof("type")
+                self.received[packet_type] = self.received.get(packet_type, 0) + 1
+
+                if packet_type == "snapshot":
+                    await self._send(packets.ack(packet.snapshot.seq))
+                elif packet_type == "chat":
+                    if self._on_chat is not None:
+                        self._on_chat(packet.chat.msg, trio.current_time())
+                elif packet_type == "chat_batch":
+                    if self._on_chat is not None:
+                        arrived: float = trio.current_time()
+                        for message in packet.chat_batch.messages:
+                            self._on_chat(message.msg, arrived)
+                elif packet_type in ("ok", "deny") and self._replies_owed > 0:
+                    self._replies_owed -= 1
+                    await self._replies_in.send(packet)
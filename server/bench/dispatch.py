@@ -0,0 +1,67 @@
+"""
+Benchmarks how many inbound messages per second a single connection can decode and dispatch to its
+protocol state's handler, comparing the state's dispatch table against looking the handler up by
+name for every message, as the server used to. Both ways decode the same messages and run the same
+handler, so the only difference between them is how the handler is found.
+
+Finding the handler is a small part of handling a message, most of which is decoding it and running
+the handler, so the table is only a few percent faster. It is there so every packet type is checked
+to have a handler when the server starts, rather than for speed.
+
+Usage:
+    python -m server.bench.dispatch [--messages 100000] [--rounds 5]
+"""
+import argparse
+import time
+import trio
+import server.net as packets
+from server.bench.broadcast import NullConnection
+from server.protocol import GameProtocol, states
+from server.protocol.registry import ConnectionRegistry
+from server.world import World
+
+
+async def _dispatch_by_name(state: states.ProtocolState, data: bytes) -> None:
+    packet: packets.Packet = packets.Packet.FromString(data)
+    packet_type: str = packet.WhichOneof("type")
+    handler = getattr(state, f"handle_{packet_type}_packet")
+    await handler(getattr(packet, packet_type))
+
+
+async def _dispatch_by_table(state: states.ProtocolState, data: bytes) -> None:
+    packet: packets.Packet = packets.Packet.FromString(data)
+    field, message = packet.ListFields()[0]
+    await state.handlers[field.number](message)
+
+
+async def main(num_messages: int, num_rounds: int) -> None:
+    """
+    Dispatches `num_messages` direction packets to a protocol in the play state each way, in
+    `num_rounds` rounds, and prints the throughput of the best round of each.
+    """
+    protocol: GameProtocol = GameProtocol(NullConnection(), ConnectionRegistry(), 1, None, World())
+    protocol.set_state(states.PlayState)
+    messages: list[bytes] = [packets.direction(i % 3 - 1, i % 5 - 2).SerializeToString()
+                             for i in range(num_messages)]
+
+    # Alternate between the two and keep the best round of each, so neither is favoured by running
+    # first or by the machine being busy at the time
+    best: dict[str, float] = {"by name (old)": float('inf'), "table": float('inf')}
+    for _ in range(num_rounds):
+        for name, dispatch in (("by name (old)", _dispatch_by_name), ("table", _dispatch_by_table)):
+            start: float = time.perf_counter()
+            for data in messages:
+                await dispatch(protocol.state, data)
+            best[name] = min(best[name], time.perf_counter() - start)
+
+    print(f"{'dispatch':>16} {'messages/s':>12} {'us/message':>12}")
+    for name, elapsed in best.items():
+        print(f"{name:>16} {num_messages / elapsed:>12,.0f} {elapsed * 1e6 / num_messages:>12.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    trio.run(main, args.messages, args.rounds)
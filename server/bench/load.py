@@ -0,0 +1,277 @@
+"""
+Load-tests the websocket server with simulated players. Every player connects, registers and logs
+in, then wanders around for a while, and a fraction of them chat. Unless a URL is given, a
+`GameServer` is started in the same process on loopback, with a throwaway database, so its tick
+timings can be reported too. The clients share the server's CPU, so treat the numbers as relative:
+compare runs made on the same machine, not against a target.
+
+The results are printed and written to a JSON file, so runs can be compared across commits.
+
+Usage:
+    python -m server.bench.load [--players 200] [--duration 10] [--chatters 0.1] [--chat-rate 1]
+                                [--output bench-load.json] [--url ws://host:port]
+"""
+import argparse
+import logging
+import os
+import random
+import subprocess
+import time
+from typing import Any, Optional
+import numpy as np
+import trio
+from server import metrics
+from server.bench.client import HeadlessClient
+from server.bench.results import run_in_workdir, save_results, tick_phase_ms
+
+PASSWORD: str = "password"
+
+
+def _percentiles(samples: list[float]) -> dict[str, float]:
+    """
+    Summarizes a list of durations in seconds as milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    values: np.ndarray = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+    return {"count": len(samples), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+            "max_ms": float(values.max())}
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadTest:
+    """
+    Drives a number of headless clients against a server and collects their timings.
+
+    Args:
+        url (str): The server's websocket URL.
+        num_players (int): How many players to simulate.
+        connect_concurrency (int): How many connections can be being opened at once.
+        login_concurrency (int): How many players can be registering or logging in at once.
+    """
+    def __init__(self, url: str, num_players: int, connect_concurrency: int,
+                 login_concurrency: int) -> None:
+        self._url: str = url
+        run_id: str = f"{random.randrange(36 ** 6):06x}"
+        self.clients: list[HeadlessClient] = [
+            HeadlessClient(f"bench{run_id}_{i}", on_chat=self._on_chat) for i in range(num_players)]
+        self._connect_limiter: trio.CapacityLimiter = trio.CapacityLimiter(connect_concurrency)
+        self._login_limiter: trio.CapacityLimiter = trio.CapacityLimiter(login_concurrency)
+        self.logged_in: list[HeadlessClient] = []
+        self.login_retries: int = 0
+        self.login_failures: int = 0
+        self._chat_sent: dict[str, float] = {}
+        self._chat_received: dict[str, list[float]] = {}
+
+    async def connect_all(self, nursery: trio.Nursery) -> dict[str, Any]:
+        """
+        Opens every client's connection.
+        """
+        durations: list[float] = []
+
+        async def connect(client: HeadlessClient) -> None:
+            async with self._connect_limiter:
+                start: float = trio.current_time()
+                await client.connect(nursery, self._url)
+                durations.append(trio.current_time() - start)
+
+        start: float = trio.current_time()
+        async with trio.open_nursery() as connecting:
+            for client in self.clients:
+                connecting.start_soon(connect, client)
+        elapsed: float = trio.current_time() - start
+        return {"seconds": elapsed, "per_second": len(durations) / elapsed,
+                "latency": _percentiles(durations)}
+
+    async def login_all(self) -> dict[str, Any]:
+        """
+        Registers and logs in every client, backing off and retrying whenever the server is too
+        busy to take the request. Logins are limited per connection, so a client only retries a 
+        couple of times before giving up.
+        """
+        durations: list[float] = []
+
+        async def request(client: HeadlessClient, action) -> bool:
+            for attempt in range(3):
+                reply = await action(PASSWORD)
+                if reply.WhichOneof("type") == "ok":
+                    return True
+                if "busy" not in reply.deny.reason:
+                    logging.warning("%s denied: %s", client.username, reply.deny.reason)
+                    return False
+                self.login_retries += 1
+                await trio.sleep(random.uniform(1, 2) * 2 ** attempt)
+            return False
+
+        async def login(client: HeadlessClient) -> None:
+            async with self._login_limiter:
+                start: float = trio.current_time()
+                if await request(client, client.register) and await request(client, client.login):
+                    durations.append(trio.current_time() - start)
+                    self.logged_in.append(client)
+                else:
+                    self.login_failures += 1
+
+        start: float = trio.current_time()
+        async with trio.open_nursery() as logging_in:
+            for client in self.clients:
+                logging_in.start_soon(login, client)
+        elapsed: float = trio.current_time() - start
+        return {"seconds": elapsed, "per_second": len(durations) / elapsed,
+                "retries": self.login_retries, "failures": self.login_failures,
+                "latency": _percentiles(durations)}
+
+    async def play(self, duration: float, chatters: float, chat_rate: float) -> dict[str, Any]:
+        """
+        Has every logged in client change direction about once a second, and a fraction of them
+        chat at a steady rate, for a while. Chat messages are tagged so each delivery can be timed
+        against when the message was sent.
+        """
+        async def wander(client: HeadlessClient) -> None:
+            while not client.closed:
+                await client.direction(random.uniform(-1, 1), random.uniform(-1, 1))
+                await trio.sleep(random.uniform(0.5, 1.5))
+
+        async def chat(client: HeadlessClient) -> None:
+            await trio.sleep(random.uniform(0, 1 / chat_rate))
+            seq: int = 0
+            while not client.closed:
+                msg: str = f"{client.username}:{seq}"
+                self._chat_sent[msg] = trio.current_time()
+                await client.chat(msg)
+                seq += 1
+                await trio.sleep(1 / chat_rate)
+
+        num_chatters: int = round(len(self.logged_in) * chatters)
+        with trio.move_on_after(duration):
+            async with trio.open_nursery() as playing:
+                for i, client in enumerate(self.logged_in):
+                    playing.start_soon(wander, client)
+                    if i < num_chatters:
+                        playing.start_soon(chat, client)
+        # Let the last messages arrive
+        await trio.sleep(1)
+
+        latencies: list[float] = []
+        spreads: list[float] = []
+        for msg, received in self._chat_received.items():
+            sent: float = self._chat_sent[msg]
+            latencies.extend(arrived - sent for arrived in received)
+            spreads.append(max(received) - min(received))
+        deliveries: int = len(latencies)
+        return {"chatters": num_chatters, "messages": len(self._chat_sent),
+                "deliveries": deliveries,
+                "fan_out": deliveries / len(self._chat_sent) if self._chat_sent else 0,
+                "latency": _percentiles(latencies), "fan_out_spread": _percentiles(spreads)}
+
+    def _on_chat(self, msg: str, arrived: float) -> None:
+        if msg in self._chat_sent:
+            self._chat_received.setdefault(msg, []).append(arrived)
+
+
+def _server_counters() -> dict[str, float]:
+    return {"ticks": metrics.TICKS.ticks, "overruns": metrics.TICKS.overruns,
+            "outbound_seconds": metrics.TICKS.totals[metrics.PHASES.index("outbound")],
+            "frames_sent": sum(metrics.OUTBOUND.packets.values()),
+            "chat_frames_sent": (metrics.OUTBOUND.packets["chat"]
+                                 + metrics.OUTBOUND.packets["chat_batch"])}
+
+
+async def run_load_test(args: argparse.Namespace) -> dict[str, Any]:
+    """
+    Runs the load test, starting a server first unless a URL was given.
+
+    Returns:
+        dict[str, Any]: The results.
+    """
+    results: dict[str, Any] = {"commit": _commit(), "time": time.time(), "config": vars(args)}
+    async with trio.open_nursery() as nursery:
+        url: str = args.url
+        if url is None:
+            # Imported here so load testing a remote server does not need the database dependencies
+            from server.__main__ import GameServer  # pylint: disable=import-outside-toplevel
+            database_url: str = f"sqlite:///{os.path.join(args.workdir, 'bench.db')}"
+            server: GameServer = GameServer(1/20, database_url=database_url,
+                                            hash_rounds=args.hash_rounds)
+            await nursery.start(server.serve, '127.0.0.1', args.port)
+            url = f"ws://127.0.0.1:{args.port}"
+
+        test: LoadTest = LoadTest(url, args.players, args.connect_concurrency,
+                                  args.login_concurrency)
+        async with trio.open_nursery() as connections:
+            results["connect"] = await test.connect_all(connections)
+            results["login"] = await test.login_all()
+            before: dict[str, float] = _server_counters()
+            results["play"] = await test.play(args.duration, args.chatters, args.chat_rate)
+            after: dict[str, float] = _server_counters()
+            connections.cancel_scope.cancel()
+
+        if args.url is None:
+            frames_sent: float = after["frames_sent"] - before["frames_sent"]
+            outbound_seconds: float = after["outbound_seconds"] - before["outbound_seconds"]
+            results["server"] = {
+                "ticks": after["ticks"] - before["ticks"],
+                "overruns": after["overruns"] - before["overruns"],
+                "frames_sent": frames_sent,
+                "chat_frames_sent": after["chat_frames_sent"] - before["chat_frames_sent"],
+                "outbound_us_per_frame": 1e6 * outbound_seconds / frames_sent if frames_sent else 0,
+                "tick_phase_ms": tick_phase_ms(),
+            }
+        nursery.cancel_scope.cancel()
+    return results
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Runs the load test, then prints the results and saves them to `args.output`.
+    """
+    results: dict[str, Any] = run_in_workdir(run_load_test, args)
+    del results["config"]["workdir"]
+    _print_results(results)
+    save_results(results, args.output)
+
+
+def _print_results(results: dict[str, Any]) -> None:
+    connect, login, play = results["connect"], results["login"], results["play"]
+    print(f"connect: {connect['per_second']:.0f}/s, "
+          f"p99 {connect['latency'].get('p99_ms', 0):.1f}ms")
+    print(f"login:   {login['per_second']:.1f}/s, p99 {login['latency'].get('p99_ms', 0):.1f}ms, "
+          f"{login['retries']} retries, {login['failures']} failures")
+    print(f"chat:    {play['messages']} sent, {play['fan_out']:.1f} recipients each, latency "
+          f"p50 {play['latency'].get('p50_ms', 0):.1f}ms / "
+          f"p99 {play['latency'].get('p99_ms', 0):.1f}ms, "
+          f"spread p99 {play['fan_out_spread'].get('p99_ms', 0):.1f}ms")
+    if "server" in results:
+        server: dict[str, Any] = results["server"]
+        total: dict[str, float] = server["tick_phase_ms"]["total"]
+        print(f"server:  {server['ticks']} ticks, {server['overruns']} overruns, "
+              f"tick p50 {total['p50']:.2f}ms / p99 {total['p99']:.2f}ms, "
+              f"{server['outbound_us_per_frame']:.1f}us per frame sent")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('--players', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to play for")
+    parser.add_argument('--chatters', type=float, default=0.1,
+                        help="The fraction of players that chat")
+    parser.add_argument('--chat-rate', type=float, default=1,
+                        help="Messages per second per chatter")
+    parser.add_argument('--connect-concurrency', type=int, default=100)
+    parser.add_argument('--login-concurrency', type=int, default=32)
+    parser.add_argument('--url', default=None,
+                        help="Test a running server instead of starting one")
+    parser.add_argument('--port', type=int, default=18081)
+    parser.add_argument('--hash-rounds', type=int, default=4,
+                        help="The bcrypt cost for the in-process server, kept low so logging in "
+                             "thousands of players does not take minutes")
+    parser.add_argument('--output', default='bench-load.json')
+    main(parser.parse_args())
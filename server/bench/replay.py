@@ -0,0 +1,229 @@
+"""
+Replays the inbound frames from a packet capture (see `server.protocol.trace`) against a fresh
+`GameServer`, without any sockets. Each captured connection gets its own `GameProtocol`, fed
+through a stand-in connection that discards everything sent to it.
+
+Frames are replayed either at their recorded pace (scaled by `--speed`), with the tick loop running
+in real time, or with `--fast`, as fast as possible. In fast mode, ticks are run whenever the
+recorded clock passes a tick boundary, and every frame is handled to completion, including any
+password hashing it waits on, before the next one is fed in. Fast runs are therefore
+deterministic, which makes them suitable for performance regression runs and for profiling. Rate 
+limits are measured against the wall clock, so they are switched off for fast runs.
+
+Captured logins for users the capture never registered are registered up front, so the replay does
+not depend on the database the capture was recorded against.
+
+Usage:
+    python -m server.bench.replay packets.cap [--fast | --speed 1.0] [--output bench-replay.json]
+"""
+import argparse
+import os
+import time
+from typing import Any, Optional
+import trio
+import trio.testing
+from trio_websocket import CloseReason, ConnectionClosed
+import server.net as packets
+from server import metrics
+from server.__main__ import GameServer
+from server.bench.results import run_in_workdir, save_results, tick_phase_ms
+from server.protocol import GameProtocol, trace
+from server.protocol.ratelimit import RateLimiter
+
+TICK_RATE: float = 1 / 20
+
+
+class ReplayConnection:
+    """
+    Stands in for a `WebSocketConnection`, handing the protocol the frames it is fed and discarding
+    everything sent to it.
+    """
+    def __init__(self) -> None:
+        self._send_channel, self._receive_channel = trio.open_memory_channel(float('inf'))
+        self.bytes_sent: int = 0
+        self.closed: Optional[CloseReason] = None
+
+    def feed(self, data: bytes) -> None:
+        """
+        Queues a frame for the protocol to read. Frames fed after the connection is closed, e.g. 
+        because the protocol kicked its client, are dropped.
+        """
+        if self.closed is None:
+            self._send_channel.send_nowait(data)
+
+    async def get_message(self) -> bytes:
+        """
+        Returns the next frame fed in, or raises `ConnectionClosed` once the connection is closed
+        and every frame has been read.
+        """
+        try:
+            return await self._receive_channel.receive()
+        except trio.EndOfChannel:
+            raise ConnectionClosed(self.closed) from None
+
+    async def send_message(self, message: bytes) -> None:
+        """
+        Discards the message, only counting its size.
+        """
+        self.bytes_sent += len(message)
+
+    async def aclose(self, code: int = 1000, reason: Optional[str] = None) -> None:
+        """
+        Marks the connection as closed. The protocol sees this once it has read every frame.
+        """
+        if self.closed is None:
+            self.closed = CloseReason(code, reason)
+            await self._send_channel.aclose()
+
+
+def load_inbound(path: str) -> list[trace.CaptureRecord]:
+    """
+    Reads the inbound frames of a capture and any files it was rotated into, oldest first.
+    """
+    records: list[trace.CaptureRecord] = []
+    for file in trace.capture_files(path):
+        records.extend(record for record in trace.read_capture(file)
+                       if record.direction == trace.INBOUND)
+    if not records:
+        raise ValueError(f"No inbound frames captured in {path}")
+    return records
+
+
+async def register_missing_users(server: GameServer, records: list[trace.CaptureRecord]) -> int:
+    """
+    Registers every user who logs in during the capture without registering in it first, with the
+    password they logged in with.
+
+    Returns:
+        int: The number of users registered.
+    """
+    registered: set[str] = set()
+    missing: dict[str, str] = {}
+    for record in records:
+        try:
+            packet: packets.Packet = packets.Packet.FromString(record.data)
+        except Exception:  # pylint: disable=broad-except
+            continue
+        packet_type: Optional[str] = packet.WhichOneof("type")
+        if packet_type == "register":
+            registered.add(packet.register.username)
+        elif packet_type == "login" and packet.login.username not in registered:
+            missing.setdefault(packet.login.username, packet.login.password)
+
+    for username, password in missing.items():
+        await server.auth.create_user(username, await server.auth.hash_password(password))
+    return len(missing)
+
+
+async def _settle(server: GameServer) -> None:
+    # Wait until every handler has finished, including any waiting on a worker thread
+    while True:
+        await trio.testing.wait_all_tasks_blocked()
+        if not any(lane.running or lane.waiting for lane in server.auth.lanes):
+            return
+        await trio.sleep(0.001)
+
+
+async def replay(server: GameServer, records: list[trace.CaptureRecord], fast: bool,
+                 speed: float) -> dict[str, Any]:
+    """
+    Feeds the captured frames to the server, creating a protocol for each captured connection.
+
+    Returns:
+        dict[str, Any]: How long the replay took and how much it sent.
+    """
+    connections: dict[int, ReplayConnection] = {}
+    last_frame: dict[int, int] = {}
+    for i, record in enumerate(records):
+        last_frame[record.ident] = i
+    first_time: float = records[0].time
+    next_tick: float = 0.0
+    num_ticks: int = 0
+
+    start: float = time.perf_counter()
+    async with trio.open_nursery() as nursery:
+        if not fast:
+            nursery.start_soon(server.run)
+        replay_start: float = trio.current_time()
+        for i, record in enumerate(records):
+            offset: float = record.time - first_time
+            if fast:
+                while next_tick <= offset:
+                    await server.tick()
+                    await _settle(server)
+                    next_tick += TICK_RATE
+                    num_ticks += 1
+            else:
+                await trio.sleep_until(replay_start + offset / speed)
+
+            connection: Optional[ReplayConnection] = connections.get(record.ident)
+            if connection is None:
+                connection = connections[record.ident] = ReplayConnection()
+                protocol: GameProtocol = server.create_protocol(connection)
+                if fast:
+                    protocol.rate_limiter = RateLimiter(enabled=False)
+                nursery.start_soon(protocol.start)
+            connection.feed(record.data)
+            if last_frame[record.ident] == i:
+                await connection.aclose()
+            if fast:
+                await _settle(server)
+
+        # Let the last frames be handled before stopping the tick loop
+        await _settle(server)
+        nursery.cancel_scope.cancel()
+    elapsed: float = time.perf_counter() - start
+
+    return {"frames": len(records), "connections": len(connections), "seconds": elapsed,
+            "frames_per_second": len(records) / elapsed,
+            "recorded_seconds": records[-1].time - first_time,
+            "ticks": num_ticks if fast else metrics.TICKS.ticks,
+            "bytes_sent": sum(connection.bytes_sent for connection in connections.values())}
+
+
+async def run_replay(args: argparse.Namespace) -> dict[str, Any]:
+    """
+    Loads the capture, sets up a server with a throwaway database, and replays the capture.
+
+    Returns:
+        dict[str, Any]: The results.
+    """
+    records: list[trace.CaptureRecord] = load_inbound(args.capture)
+    database_url: str = f"sqlite:///{os.path.join(args.workdir, 'replay.db')}"
+    server: GameServer = GameServer(TICK_RATE, database_url=database_url,
+                                    hash_rounds=args.hash_rounds)
+    metrics.TIMER.install()
+
+    results: dict[str, Any] = {"capture": args.capture, "fast": args.fast, "speed": args.speed}
+    results["registered"] = await register_missing_users(server, records)
+    results.update(await replay(server, records, args.fast, args.speed))
+
+    results["overruns"] = metrics.TICKS.overruns
+    results["tick_phase_ms"] = tick_phase_ms()
+    return results
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Replays the capture, then prints a summary and saves the results to `args.output`.
+    """
+    results: dict[str, Any] = run_in_workdir(run_replay, args)
+    total: dict[str, float] = results["tick_phase_ms"]["total"]
+    print(f"Replayed {results['frames']} frames from {results['connections']} connections in "
+          f"{results['seconds']:.2f}s ({results['frames_per_second']:.0f} frames/s), "
+          f"{results['ticks']} ticks, {results['overruns']} overruns, "
+          f"tick p50 {total['p50']:.2f}ms / p99 {total['p99']:.2f}ms")
+    save_results(results, args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('capture', help="The capture file written by `python -m server --capture`")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument('--fast', action='store_true', help="Replay as fast as possible")
+    pace.add_argument('--speed', type=float, default=1.0,
+                      help="How many times faster than recorded to replay")
+    parser.add_argument('--hash-rounds', type=int, default=4,
+                        help="The bcrypt cost for users registered during the replay")
+    parser.add_argument('--output', default='bench-replay.json')
+    main(parser.parse_args())
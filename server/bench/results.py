@@ -0,0 +1,49 @@
+"""
+This module contains what the benchmarks that save their results have in common: running with a
+scratch directory for the server's database, summarizing the server's tick timings, and writing the
+results to a JSON file so runs can be compared across commits.
+
+Example usage:
+    results = run_in_workdir(main, args)
+    save_results(results, args.output)
+"""
+import argparse
+import json
+import logging
+import tempfile
+from typing import Any, Awaitable, Callable
+import trio
+from server import metrics
+
+
+def run_in_workdir(main: Callable[[argparse.Namespace], Awaitable[dict[str, Any]]],
+                   args: argparse.Namespace) -> dict[str, Any]:
+    """
+    Runs a benchmark's `main` under trio, with `args.workdir` set to a temporary directory that is
+    removed afterwards. Only warnings and errors are logged.
+
+    Returns:
+        dict[str, Any]: The results returned by `main`.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        return trio.run(main, args)
+
+
+def tick_phase_ms() -> dict[str, dict[str, float]]:
+    """
+    Returns the median, 99th percentile and longest duration of each tick phase recorded in
+    `metrics.TICKS`, in milliseconds.
+    """
+    return {phase: {"p50": 1000 * p50, "p99": 1000 * p99, "max": 1000 * top}
+            for phase, (p50, p99, top) in metrics.TICKS.percentiles().items()}
+
+
+def save_results(results: dict[str, Any], path: str) -> None:
+    """
+    Writes a benchmark's results to a JSON file.
+    """
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {path}")
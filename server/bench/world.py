@@ -0,0 +1,172 @@
+"""
+Benchmarks whole server ticks with a world full of players: the vectorized world step, and then
+fanning snapshots out to every player whose view changed, through the same `GameServer.tick` the
+real server runs.
+
+Every player is a protocol in the play state, spread over a square and set moving in a random
+direction. Each writes to a connection that discards what is sent to it, but acknowledges every
+snapshot straight away, as a client would. After each tick, every sender task is left to write out
+what was queued before the next tick runs.
+
+The tick phases are taken from `metrics.TICKS`: simulation is stepping the world and working out
+whose view changed, outbound is queueing snapshots plus the sender tasks writing them out, and total
+is all of them, which is what has to fit in the tick budget on the server's one thread. Snapshots
+are acknowledged from the sender tasks, so handling the acknowledgements counts as outbound too.
+
+Usage:
+    python -m server.bench.world [--entities 5000] [--ticks 100] [--moving 1.0] [--spread 10000]
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+import trio
+import trio.testing
+from trio_websocket import CloseReason, ConnectionClosed
+import server.net as packets
+from server import metrics
+from server.__main__ import GameServer, tune_gc
+from server.bench.broadcast import NullConnection
+from server.models import PlayerState
+from server.protocol import GameProtocol, states
+from server.protocol.ratelimit import RateLimiter
+from server.world import World
+
+TICK_RATE: float = 1 / 20
+
+
+class AckingConnection(NullConnection):
+    """
+    Discards every message sent to it, but acknowledges snapshots, as a client would.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.protocol: GameProtocol = None
+        self.frames_sent: int = 0
+        self._closed: trio.Event = trio.Event()
+
+    async def send_message(self, message: bytes) -> None:
+        """
+        Counts the message, and acknowledges it if it is a snapshot.
+        """
+        self.frames_sent += 1
+        self.bytes_sent += len(message)
+        packet: packets.Packet = packets.Packet.FromString(message)
+        if packet.WhichOneof("type") == "snapshot":
+            await self.protocol.state.handle_ack_packet(packets.ack(packet.snapshot.seq).ack)
+
+    async def get_message(self) -> bytes:
+        """
+        Waits until the connection is closed, as if the client only ever sent acknowledgements.
+        """
+        await self._closed.wait()
+        raise ConnectionClosed(CloseReason(*self.closed))
+
+    async def aclose(self, code: int = 1000, reason: str = None) -> None:
+        """
+        Marks the connection as closed.
+        """
+        self.closed = (code, reason)
+        self._closed.set()
+
+
+def bench_step(num_entities: int, num_ticks: int, moving_fraction: float, spread: float) -> float:
+    """
+    Steps a world with no players attached, to time the world simulation on its own.
+
+    Returns:
+        float: The average seconds per step.
+    """
+    rng: np.random.Generator = np.random.default_rng(0)
+    world: World = World()
+    for slot in range(num_entities):
+        world.spawn(slot, slot + 1, None, *rng.uniform(-spread, spread, 2))
+        if rng.random() < moving_fraction:
+            world.set_direction(slot, *rng.uniform(-1, 1, 2))
+    start: float = time.perf_counter()
+    for _ in range(num_ticks):
+        world.step(TICK_RATE)
+    return (time.perf_counter() - start) / num_ticks
+
+
+async def bench_ticks(num_entities: int, num_ticks: int, moving_fraction: float, spread: float,
+                      max_snapshots: int, workdir: str) -> dict[str, float]:
+    """
+    Runs `num_ticks` server ticks with `num_entities` players connected.
+
+    Returns:
+        dict[str, float]: The tick phase timings, and the frames and bytes sent per tick.
+    """
+    rng: np.random.Generator = np.random.default_rng(0)
+    server: GameServer = GameServer(TICK_RATE, database_url=f"sqlite:///{workdir}/world.db",
+                                    max_snapshots_per_tick=max_snapshots)
+    connections: list[AckingConnection] = []
+    metrics.TIMER.install()
+    tune_gc()
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(num_entities):
+            connection: AckingConnection = AckingConnection()
+            protocol: GameProtocol = server.create_protocol(connection)
+            connection.protocol = protocol
+            protocol.rate_limiter = RateLimiter(enabled=False)
+            protocol.saved_state = PlayerState(x=rng.uniform(-spread, spread),
+                                               y=rng.uniform(-spread, spread))
+            protocol.set_state(states.PlayState)
+            if rng.random() < moving_fraction:
+                protocol.world.set_direction(protocol.slot, *rng.uniform(-1, 1, 2))
+            connections.append(connection)
+            nursery.start_soon(protocol.start)
+        # Send everyone their first snapshot before measuring. Recording an empty tick afterwards
+        # moves the time the sender and reader tasks spent on it out of the measured ticks.
+        await server.tick()
+        await trio.testing.wait_all_tasks_blocked()
+        metrics.TICKS.record(0.0, 0.0, 0.0, False)
+        totals_before: list[float] = list(metrics.TICKS.totals)
+        frames_before: int = sum(connection.frames_sent for connection in connections)
+        bytes_before: int = sum(connection.bytes_sent for connection in connections)
+
+        for _ in range(num_ticks):
+            await server.tick()
+            await trio.testing.wait_all_tasks_blocked()
+        metrics.TICKS.record(0.0, 0.0, 0.0, False)
+        frames: int = sum(connection.frames_sent for connection in connections) - frames_before
+        num_bytes: int = sum(connection.bytes_sent for connection in connections) - bytes_before
+        await server.drain(timeout=60)
+
+    results: dict[str, float] = {
+        f"{phase}_ms": 1000 * (after - before) / num_ticks
+        for phase, before, after in zip(metrics.PHASES, totals_before, metrics.TICKS.totals)}
+    results["frames_per_tick"] = frames / num_ticks
+    results["kib_per_tick"] = num_bytes / num_ticks / 1024
+    return results
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Times the world step on its own, then whole ticks with players connected, and prints both.
+    """
+    step: float = bench_step(args.entities, args.ticks, args.moving, args.spread)
+    with tempfile.TemporaryDirectory() as workdir:
+        results: dict[str, float] = trio.run(bench_ticks, args.entities, args.ticks, args.moving,
+                                             args.spread, args.max_snapshots, workdir)
+    print(f"{args.entities} players, {args.moving:.0%} moving, over {args.ticks} ticks:")
+    print(f"  world step alone: {step * 1000:8.3f} ms/tick")
+    for phase in metrics.PHASES:
+        print(f"  {phase + ':':<17} {results[phase + '_ms']:8.3f} ms/tick")
+    print(f"  sent:             {results['frames_per_tick']:8.0f} frames/tick "
+          f"({results['kib_per_tick']:.1f} KiB/tick)")
+    print(f"  tick budget:      {TICK_RATE * 1000:8.3f} ms/tick")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('--entities', type=int, default=5000)
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--moving', type=float, default=1.0,
+                        help="The fraction of entities that are moving")
+    parser.add_argument('--spread', type=float, default=10000,
+                        help="How far from the origin entities are spawned, in world units")
+    parser.add_argument('--max-snapshots', type=int, default=800,
+                        help="Roughly how many players the server sends a snapshot each tick")
+    main(parser.parse_args())
@@ -5,31 +5,80 @@ The database engine is responsible for connecting to the database and managing t
 connection. The session factory is used to create database sessions, which are used to interact
 with the database.
 
+The database URL can be set with the `GAME_DATABASE_URL` environment variable, e.g. to point the
+server at a local Postgres instead of the bundled SQLite database. SQLite databases are switched to
+WAL mode, so readers never wait on the writer, and tuned for a server that owns its database.
+
 Example usage:
     binding_engine = init_engine()
     session_factory = get_session_factory(binding_engine)
     session = session_factory()
 """
+import logging
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.pool import StaticPool
 from server.database import SessionMaker, Engine, create_engine, DB_PATH
 from server.models import Base
 
-DATABASE_URL: str = f"sqlite:///{DB_PATH}/database.db"
+DATABASE_URL: str = os.environ.get("GAME_DATABASE_URL", f"sqlite:///{DB_PATH}/database.db")
+
+# Applied to every new SQLite connection. NORMAL is durable in WAL mode, except that the last few
+# transactions can be lost on power failure.
+SQLITE_PRAGMAS: dict[str, str] = {
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "temp_store": "MEMORY",
+    "cache_size": "-16000",
+}
+
+# Execution option for sessions that are going to write, so SQLite takes the write lock as soon as
+# their transaction begins, e.g. `session.connection(execution_options={IMMEDIATE: True})`. Ignored
+# by other databases.
+IMMEDIATE: str = "sqlite_begin_immediate"
 
-def init_engine() -> Engine:
+def init_engine(database_url: str = DATABASE_URL, pool_size: int = 5, max_overflow: int = 5,
+                busy_timeout: float = 5.0) -> Engine:
     """
-    Initializes the database engine.
+    Initializes the database engine, creating any missing tables.
+
+    Args:
+        database_url (str): The URL of the database to connect to. Defaults to `GAME_DATABASE_URL`
+            if it is set, or the server's own SQLite database if not.
+        pool_size (int): The number of connections kept open in the pool.
+        max_overflow (int): How many more connections can be opened when the pool is empty.
+        busy_timeout (float): How many seconds to wait for a lock held by another connection before
+            failing.
 
     Returns:
         The initialized database engine.
     """
-    print(DATABASE_URL)
-    binding_engine: Engine = create_engine(DATABASE_URL)
+    url: URL = make_url(database_url)
+    logging.info("Connecting to database %s", url.render_as_string(hide_password=True))
+
+    if url.get_backend_name() != "sqlite":
+        binding_engine: Engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                                               pool_pre_ping=True)
+    elif url.database in (None, "", ":memory:"):
+        # Every connection to an in-memory database would get its own empty database
+        binding_engine = create_engine(url, connect_args={"check_same_thread": False},
+                                       poolclass=StaticPool)
+        _tune_sqlite(binding_engine, busy_timeout, wal=False)
+    else:
+        binding_engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                                       connect_args={"check_same_thread": False,
+                                                     "timeout": busy_timeout})
+        _tune_sqlite(binding_engine, busy_timeout, wal=True)
+
     Base.metadata.create_all(binding_engine)
     return binding_engine
 
 def get_session_factory(binding_engine: Engine) -> SessionMaker:
     """
-    Returns a session factory for creating database sessions.
+    Returns a session factory for creating database sessions. Objects loaded by its sessions stay
+    usable after the session is committed or closed, so they can be handed back to the event loop
+    from a worker thread.
 
     Args:
         binding_engine (engine): The database engine to bind the session to.
@@ -38,4 +87,27 @@ def get_session_factory(binding_engine: Engine) -> SessionMaker:
         sessionmaker: A session factory object.
 
     """
-    return SessionMaker(bind=binding_engine)
+    return SessionMaker(bind=binding_engine, expire_on_commit=False)
+
+def _tune_sqlite(binding_engine: Engine, busy_timeout: float, wal: bool) -> None:
+    @event.listens_for(binding_engine, "connect")
+    def on_connect(dbapi_connection, _connection_record) -> None:
+        # Stop the sqlite3 module managing transactions itself, so SQLAlchemy's BEGIN below is the
+        # only one and savepoints work as expected
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+    @event.listens_for(binding_engine, "begin")
+    def on_begin(connection) -> None:
+        # Writers take the write lock up front. Upgrading a read transaction to a write fails
+        # straight away, without waiting out the busy timeout, if another process wrote first.
+        if connection.get_execution_options().get(IMMEDIATE):
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            connection.exec_driver_sql("BEGIN")
@@ -0,0 +1,156 @@
+"""
+This module contains the write-behind queue, which batches database writes made at around the same
+time into a single transaction.
+
+Committing is the expensive part of a write: with SQLite it means syncing the write-ahead log to
+disk. While one batch is being committed, further writes queue up, and the next batch commits them
+all at once. Each write runs in its own savepoint, so one failing write, e.g. a registration for a
+name that was taken in the meantime, does not fail the rest of its batch.
+
+Example usage:
+    writer = WriteBehindQueue(session_factory, lane)
+    created = await writer.write(lambda session: session.add(User(...)))
+"""
+from __future__ import annotations
+from typing import Any, Callable, Generic, Optional, TypeVar, TYPE_CHECKING
+import trio
+from server.database import SessionMaker
+from server.database.engine import IMMEDIATE
+
+if TYPE_CHECKING:
+    from server.auth.worker import WorkLane
+
+T = TypeVar('T')
+
+
+class _Write(Generic[T]):
+    """
+    A write waiting to be committed, and its outcome once it has been.
+    """
+    __slots__ = ('op', 'ready', 'finished', 'cancelled', 'result', 'error')
+
+    def __init__(self, op: Callable[[Any], T]) -> None:
+        self.op: Callable[[Any], T] = op
+        self.ready: trio.Event = trio.Event()
+        self.finished: bool = False
+        self.cancelled: bool = False
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+
+
+class WriteBehindQueue:
+    """
+    Batches writes into shared transactions, run on a work lane so they never block the event loop.
+
+    There is no background task. Whoever queues a write while no batch is being committed commits
+    the batch, and when it is done, hands the job on to the oldest write still waiting.
+
+    Args:
+        session_factory (SessionMaker):
+            The factory used to create database sessions.
+        lane (WorkLane):
+            The lane the transactions run on.
+        max_batch (int):
+            The maximum number of writes committed in a single transaction.
+
+    Attributes:
+        batches (int): The number of transactions committed.
+        writes (int): The number of writes committed.
+    """
+    def __init__(self, session_factory: SessionMaker, lane: WorkLane, max_batch: int = 256) -> None:
+        self._session_factory: SessionMaker = session_factory
+        self._lane: WorkLane = lane
+        self._max_batch: int = max_batch
+        self._pending: list[_Write] = []
+        self._committing: bool = False
+        self.batches: int = 0
+        self.writes: int = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def write(self, op: Callable[[Any], T]) -> T:
+        """
+        Queues a write and waits for it to be committed.
+
+        Args:
+            op (Callable[[Session], T]):
+                Called on a worker thread with the batch's session to make the write. It should not
+                commit or roll back the session itself.
+
+        Returns:
+            T: Whatever `op` returns.
+
+        Raises:
+            Exception: Whatever `op` raised, or the error that failed its batch's commit.
+        """
+        job: _Write[T] = _Write(op)
+        self._pending.append(job)
+        if self._committing:
+            try:
+                await job.ready.wait()
+            except trio.Cancelled:
+                self._abandon(job)
+                raise
+        if not job.finished:
+            await self._commit_pending(job)
+
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    async def _commit_pending(self, leader: _Write) -> None:
+        self._committing = True
+        batch: list[_Write] = self._pending[:self._max_batch]
+        del self._pending[:self._max_batch]
+        try:
+            await self._lane.run(self._commit, batch)
+        except trio.Cancelled:
+            # Cancelled before reaching a thread, so nothing was written. The rest of the batch
+            # goes back to the front of the queue, less any writes that were cancelled meanwhile.
+            self._pending[:0] = [job for job in batch if job is not leader and not job.cancelled]
+            self._hand_on()
+            raise
+
+        for job in batch:
+            job.finished = True
+            job.ready.set()
+        self._hand_on()
+
+    def _hand_on(self) -> None:
+        if self._pending:
+            self._pending[0].ready.set()
+        else:
+            self._committing = False
+
+    def _abandon(self, job: _Write) -> None:
+        # A cancelled write is dropped, unless it has already been handed the job of committing,
+        # in which case the job passes on to the next write. A write already in a batch being
+        # committed is left to it, and only dropped if the batch goes back to the queue.
+        if job.finished:
+            return
+        job.cancelled = True
+        if job not in self._pending:
+            return
+        self._pending.remove(job)
+        if job.ready.is_set():
+            self._hand_on()
+
+    def _commit(self, batch: list[_Write]) -> None:
+        with self._session_factory() as session:
+            try:
+                session.connection(execution_options={IMMEDIATE: True})
+                for job in batch:
+                    try:
+                        with session.begin_nested():
+                            job.result = job.op(session)
+                    except Exception as exc:  # pylint: disable=broad-except
+                        job.error = exc
+                session.commit()
+            except Exception as exc:  # pylint: disable=broad-except
+                for job in batch:
+                    if job.error is None:
+                        job.error = exc
+                return
+        self.batches += 1
+        self.writes += len(batch)
@@ -0,0 +1,24 @@
+"""
+This package contains the server's built-in instrumentation: per-tick phase timings, packet and byte 
+counters, and an optional HTTP endpoint that serves them in the Prometheus text format.
+
+Everything on the hot path is a preallocated counter that is only ever incremented, so the 
+instrumentation can be left on in production. Anything more expensive, like percentiles, is only 
+computed when the metrics are scraped.
+
+The counters are module-level, like loggers, so any part of the server can update them without 
+having them passed around:
+    from server import metrics
+    metrics.INBOUND.record("chat", len(data))
+
+Phase timings for the reader and sender tasks are only collected once `TIMER.install()` has been 
+called from inside the trio run.
+"""
+from server.metrics.counters import PacketCounters
+from server.metrics.http import PrometheusWriter, serve_metrics
+from server.metrics.profiler import PHASES, TaskTimer, TickProfiler
+
+INBOUND: PacketCounters = PacketCounters()
+OUTBOUND: PacketCounters = PacketCounters()
+TICKS: TickProfiler = TickProfiler()
+TIMER: TaskTimer = TaskTimer(TICKS)
@@ -0,0 +1,27 @@
+"""
+This module contains the packet counters, which count packets and bytes per packet type.
+"""
+from server.net import PACKET_FIELDS
+
+PACKET_TYPES: tuple[str, ...] = tuple(PACKET_FIELDS.values())
+
+
+class PacketCounters:
+    """
+    Counts packets and bytes per packet type. A counter for every packet type is allocated up front, 
+    so recording is just two dictionary increments.
+
+    Attributes:
+        packets (dict[str, int]): The number of packets of each type.
+        bytes (dict[str, int]): The number of encoded bytes of each type.
+    """
+    def __init__(self) -> None:
+        self.packets: dict[str, int] = dict.fromkeys(PACKET_TYPES, 0)
+        self.bytes: dict[str, int] = dict.fromkeys(PACKET_TYPES, 0)
+
+    def record(self, packet_type: str, num_bytes: int) -> None:
+        """
+        Counts a packet of the given type and size.
+        """
+        self.packets[packet_type] += 1
+        self.bytes[packet_type] += num_bytes
@@ -0,0 +1,98 @@
+"""
+This module contains a minimal HTTP server for exposing metrics in the Prometheus text format. It 
+only ever answers `GET /metrics`, and is meant to be bound to a local interface for a scraper.
+"""
+import logging
+from typing import Callable, Optional
+import trio
+
+_MAX_REQUEST_SIZE: int = 8192
+
+
+class PrometheusWriter:
+    """
+    Builds a page of metrics in the Prometheus text exposition format.
+
+    Example usage:
+        writer = PrometheusWriter()
+        writer.metric("game_ticks_total", "counter", "Ticks run", [({}, 42)])
+        text = writer.render()
+    """
+    def __init__(self) -> None:
+        self._lines: list[str] = []
+
+    def metric(self, name: str, kind: str, description: str,
+               samples: list[tuple[dict[str, str], float]]) -> None:
+        """
+        Adds a metric and its samples.
+
+        Args:
+            name (str): The metric's name.
+            kind (str): The metric's type, e.g. "counter" or "gauge".
+            description (str): A description of the metric.
+            samples (list[tuple[dict[str, str], float]]): Each sample's labels and value.
+        """
+        self._lines.append(f"# HELP {name} {description}")
+        self._lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if labels:
+                label_text: str = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                self._lines.append(f"{name}{{{label_text}}} {value}")
+            else:
+                self._lines.append(f"{name} {value}")
+
+    def render(self) -> str:
+        """
+        Returns the page of metrics.
+        """
+        return "\n".join(self._lines) + "\n"
+
+
+async def serve_metrics(render: Callable[[], str], port: int, host: str = '127.0.0.1',
+                        task_status=trio.TASK_STATUS_IGNORED) -> None:
+    """
+    Serves metrics over HTTP until cancelled.
+
+    Args:
+        render (Callable[[], str]): Called on each scrape to render the metrics page.
+        port (int): The port to listen on.
+        host (str): The interface to listen on. Defaults to localhost only.
+    """
+    async def handle(stream: trio.SocketStream) -> None:
+        try:
+            await _answer(stream, render)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            # The scraper hung up, e.g. by resetting the connection, which is no concern of the
+            # server's
+            pass
+        finally:
+            await stream.aclose()
+
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    await trio.serve_tcp(handle, port, host=host, task_status=task_status)
+
+
+async def _answer(stream: trio.SocketStream, render: Callable[[], str]) -> None:
+    request: bytearray = bytearray()
+    with trio.move_on_after(5):
+        while b"\r\n\r\n" not in request and len(request) < _MAX_REQUEST_SIZE:
+            data: bytes = await stream.receive_some(4096)
+            if not data:
+                break
+            request += data
+
+    request_line: list[str] = request.split(b"\r\n", 1)[0].decode(errors='replace').split()
+    status: str = "200 OK"
+    body: Optional[str] = None
+    if len(request_line) < 2 or request_line[0] != "GET":
+        status = "405 Method Not Allowed"
+    elif request_line[1].split("?", 1)[0] != "/metrics":
+        status = "404 Not Found"
+    else:
+        body = render()
+
+    payload: bytes = (body or status).encode()
+    content_type: str = "text/plain; version=0.0.4" if body else "text/plain"
+    header: str = (f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                   f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n")
+    await stream.send_all(header.encode() + payload)
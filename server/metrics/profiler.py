@@ -0,0 +1,117 @@
+"""
+This module contains the tick profiler, which keeps a rolling history of how long each phase of the 
+server's tick took.
+
+Not all of a tick's work happens inside the tick loop. Inbound packets are dispatched by each 
+connection's reader task, and frames are written by each connection's sender task, whenever they 
+are ready. To account for them, those tasks are tagged with their phase and a trio instrument, 
+`TaskTimer`, adds up how long each of their steps takes on the event loop. Time spent waiting, 
+e.g. for a worker thread to hash a password, is not counted.
+"""
+from typing import Optional
+import time
+import numpy as np
+import trio
+
+PHASES: tuple[str, ...] = ("inbound", "simulation", "outbound", "total")
+INBOUND, SIMULATION, OUTBOUND, TOTAL = range(len(PHASES))
+
+
+class TickProfiler:
+    """
+    Keeps the phase timings of the most recent ticks in a preallocated ring buffer.
+
+    Args:
+        history (int): How many ticks to keep timings for.
+
+    Attributes:
+        ticks (int): The number of ticks recorded.
+        overruns (int): The number of ticks that went over their time budget.
+        totals (list[float]): The total seconds spent in each phase over every recorded tick.
+        busy (list[float]): 
+            Seconds spent on the event loop by tagged tasks since the last tick, for each phase.
+    """
+    def __init__(self, history: int = 1200) -> None:
+        self._samples: np.ndarray = np.zeros((history, len(PHASES)))
+        self.ticks: int = 0
+        self.overruns: int = 0
+        self.totals: list[float] = [0.0] * len(PHASES)
+        self.busy: list[float] = [0.0] * len(PHASES)
+
+    def record(self, simulation: float, outbound: float, total: float, overrun: bool) -> None:
+        """
+        Records a tick's timings, along with the time tagged tasks have spent since the last tick.
+
+        Args:
+            simulation (float): Seconds the tick spent stepping the world.
+            outbound (float): Seconds the tick spent queueing snapshots.
+            total (float): Seconds the tick took in total.
+            overrun (bool): Whether the tick went over its time budget.
+        """
+        busy: list[float] = self.busy
+        row: np.ndarray = self._samples[self.ticks % len(self._samples)]
+        row[INBOUND] = busy[INBOUND]
+        row[SIMULATION] = simulation
+        row[OUTBOUND] = outbound + busy[OUTBOUND]
+        row[TOTAL] = total + busy[INBOUND] + busy[OUTBOUND]
+        busy[INBOUND] = busy[OUTBOUND] = 0.0
+        for phase, seconds in enumerate(row.tolist()):
+            self.totals[phase] += seconds
+        self.ticks += 1
+        self.overruns += overrun
+
+    def percentiles(self, quantiles: tuple[float, ...] = (0.5, 0.99)) -> dict[str, list[float]]:
+        """
+        Summarizes the recorded history.
+
+        Returns:
+            dict[str, list[float]]: 
+                For each phase, its duration in seconds at each of the given quantiles, followed by 
+                its maximum duration. All zeroes if nothing has been recorded yet.
+        """
+        samples: np.ndarray = self._samples[:min(self.ticks, len(self._samples))]
+        if samples.size == 0:
+            return {phase: [0.0] * (len(quantiles) + 1) for phase in PHASES}
+        values: np.ndarray = np.quantile(samples, quantiles, axis=0)
+        maxima: np.ndarray = samples.max(axis=0)
+        return {phase: [*values[:, i].tolist(), float(maxima[i])] for i, phase in enumerate(PHASES)}
+
+
+class TaskTimer(trio.abc.Instrument):
+    """
+    A trio instrument that adds the time each step of a tagged task takes to its phase's running 
+    total in a `TickProfiler`. Untagged tasks cost one dictionary lookup per step.
+
+    Args:
+        profiler (TickProfiler): The profiler to add the times to.
+    """
+    def __init__(self, profiler: TickProfiler) -> None:
+        self._profiler: TickProfiler = profiler
+        self._phases: dict[trio.lowlevel.Task, int] = {}
+        self._step_started: float = 0.0
+        self._installed: bool = False
+
+    def install(self) -> None:
+        """
+        Adds the instrument to the current trio run. Until then, tagging tasks does nothing.
+        """
+        trio.lowlevel.add_instrument(self)
+        self._installed = True
+
+    def tag_current_task(self, phase: str) -> None:
+        """
+        Tags the calling task so its time counts towards a phase, until it exits.
+        """
+        if self._installed:
+            self._phases[trio.lowlevel.current_task()] = PHASES.index(phase)
+
+    def before_task_step(self, task: trio.lowlevel.Task) -> None:
+        self._step_started = time.perf_counter()
+
+    def after_task_step(self, task: trio.lowlevel.Task) -> None:
+        phase: Optional[int] = self._phases.get(task)
+        if phase is not None:
+            self._profiler.busy[phase] += time.perf_counter() - self._step_started
+
+    def task_exited(self, task: trio.lowlevel.Task) -> None:
+        self._phases.pop(task, None)
@@ -1,7 +1,7 @@
 """
 This file contains the SQLAlchemy models for the database.
 """
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Float, ForeignKey, Integer, String
 from sqlalchemy.orm import DeclarativeBase
 
 #pylint: disable=too-few-public-methods
@@ -19,3 +19,23 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     username = Column(String, unique=True, nullable=False)
     password = Column(String, nullable=False)
+
+class PlayerState(Base):
+    """
+    PlayerState model. Contains the part of a user's player that outlives their connection, such as 
+    where they were in the world when it was last saved.
+    """
+    __tablename__ = 'player_states'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    x = Column(Float, nullable=False, default=0.0)
+    y = Column(Float, nullable=False, default=0.0)
+    saved_at = Column(Float, nullable=False)
+
+class SessionRevocation(Base):
+    """
+    SessionRevocation model. Contains when a user last logged out, so the session tokens they were
+    issued before then are no longer accepted.
+    """
+    __tablename__ = 'session_revocations'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    revoked_at = Column(Float, nullable=False)
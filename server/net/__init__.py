@@ -3,43 +3,221 @@ This module contains all network packet-related logic. Top level functions are u
 to create packets from the protobuf definitions. E.g. to create a deny packet, use the 
 `deny("Not allowed")`, etc. You can of course create the packets manually if you want to, but 
 keeping this module up to date with the protobuf definitions is recommended.
+
+Every helper can also produce a pre-encoded `Frame` directly, e.g. `chat.frame("Hello")`, which is 
+what should be used when the same packet is going out to more than one client. Packets that are 
+always the same, e.g. `deny.cached("Slow down")`, can be encoded once and the frame reused. The
+snapshots for a whole tick are encoded together by `encode_snapshots`, and wrapped with
+`Frame.encoded`.
 """
+import functools
+from typing import Callable, Iterable, Optional
 # pylint: disable=no-name-in-module
-from server.net.packets_pb2 import Packet, ChatPacket, DenyPacket, DirectionPacket, \
-    DisconnectPacket, LoginPacket, OkPacket, PositionPacket, RegisterPacket
+from server.net.packets_pb2 import Packet, AckPacket, ChatBatchPacket, ChatChannel, ChatPacket, \
+    DenyPacket, DirectionPacket, DisconnectPacket, LoginPacket, OkPacket, PartyPacket, \
+    PositionPacket, RegisterPacket, SessionPacket, SnapshotPacket
+from server.net.snapshots import encode_snapshots
 
-def _create_packet(packet_type: Packet, **kwargs) -> Packet:
-    p: Packet = Packet()
-    specific_packet: Packet = packet_type(**kwargs)
-    attr_name: str = packet_type.DESCRIPTOR.name.lower().replace("packet", "")
-    getattr(p, attr_name).CopyFrom(specific_packet)
-    return p
+class Frame:
+    """
+    A packet that has been serialized once, ready to be written to any number of clients. Frames 
+    must not be mutated, and neither must their `packet`: the same instance is shared between
+    every recipient's queue, and a cached frame between every caller of `cached`.
+
+    Attributes:
+        data (bytes): The serialized packet.
+        type (str): The name of the packet's `type` oneof field, e.g. "chat".
+    """
+    __slots__ = ('_packet', 'data', 'type')
+
+    def __init__(self, packet: Packet) -> None:
+        self._packet: Optional[Packet] = packet
+        self.data: bytes = packet.SerializeToString()
+        self.type: str = packet.WhichOneof("type")
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'Frame':
+        """
+        Wraps a packet that has already been serialized, e.g. by another process, without 
+        serializing it again.
+
+        Raises:
+            DecodeError: If the data is not a valid packet.
+        """
+        frame: Frame = cls.__new__(cls)
+        frame._packet = Packet.FromString(data)
+        frame.data = data
+        frame.type = frame._packet.WhichOneof("type")
+        return frame
+
+    @classmethod
+    def encoded(cls, data: bytes, packet_type: str) -> 'Frame':
+        """
+        Wraps a packet that was serialized without building a `Packet`, e.g. by `encode_snapshots`.
+        The data is trusted to be a valid packet of the given type, and only decoded if `packet`
+        is used.
+        """
+        frame: Frame = cls.__new__(cls)
+        frame._packet = None
+        frame.data = data
+        frame.type = packet_type
+        return frame
+
+    @property
+    def packet(self) -> Packet:
+        """
+        The packet this frame was encoded from, decoded from `data` the first time it is needed.
+        It is shared by everyone holding the frame, so it must not be modified.
+        """
+        if self._packet is None:
+            self._packet = Packet.FromString(self.data)
+        return self._packet
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"Frame({self.type}, {len(self.data)} bytes)"
+
+
+class _PacketBuilder:
+    """
+    Wraps a packet creation function so it can be called as normal to get a `Packet`, via 
+    `.frame(...)` to get a pre-encoded `Frame`, or via `.cached(...)` to get a `Frame` that is 
+    encoded once and then shared by every call with the same arguments. The cache is meant for 
+    packets that are sent over and over with the same contents, e.g. `deny.cached("Slow down")`, 
+    not for anything built from user input. Cached frames only keep the encoded bytes, not the
+    `Packet` they were built from.
+    """
+    def __init__(self, create: Callable[..., Packet]) -> None:
+        self._create: Callable[..., Packet] = create
+        self.cached: Callable[..., Frame] = functools.lru_cache(maxsize=CACHED_FRAMES)(
+            self._frame_bytes)
+        functools.update_wrapper(self, create)
+
+    def __call__(self, *args, **kwargs) -> Packet:
+        return self._create(*args, **kwargs)
+
+    def frame(self, *args, **kwargs) -> Frame:
+        """
+        Creates the packet and encodes it into a `Frame`.
+        """
+        return Frame(self._create(*args, **kwargs))
+
+    def _frame_bytes(self, *args, **kwargs) -> Frame:
+        frame: Frame = self.frame(*args, **kwargs)
+        return Frame.encoded(frame.data, frame.type)
+
+
+# The maximum number of distinct frames each builder's `cached` keeps
+CACHED_FRAMES: int = 64
+
+# The name of the `type` oneof field for each packet message, e.g. "ChatPacket" -> "chat"
+PACKET_FIELDS: dict[str, str] = {field.message_type.name: field.name
+                                  for field in Packet.DESCRIPTOR.oneofs_by_name["type"].fields}
 
 # Maintain all packet creation methods in alphabetical order. These are used for convenience to
-# quickly create packets from the protobuf definitions.
+# quickly create packets from the protobuf definitions. Each sets its fields directly on the oneof
+# field of a new `Packet`, rather than building the inner packet and copying it in.
 
 # pylint: disable=missing-function-docstring
-def chat(message: str) -> Packet:
-    return _create_packet(ChatPacket, msg=message)
+@_PacketBuilder
+def ack(seq: int) -> Packet:
+    p: Packet = Packet()
+    p.ack.seq = seq
+    return p
+
+@_PacketBuilder
+def chat(message: str, channel: int = ChatChannel.GLOBAL, target: str = "",
+         sender: str = "") -> Packet:
+    p: Packet = Packet()
+    inner: ChatPacket = p.chat
+    inner.msg = message
+    inner.channel = channel
+    inner.target = target
+    inner.sender = sender
+    return p
+
+@_PacketBuilder
+def chat_batch(messages: Iterable[tuple[int, str, str]]) -> Packet:
+    # Each message is its channel, sender and text
+    p: Packet = Packet()
+    add = p.chat_batch.messages.add
+    for channel, sender, message in messages:
+        add(channel=channel, sender=sender, msg=message)
+    return p
 
+@_PacketBuilder
 def deny(reason: str) -> Packet:
-    return _create_packet(DenyPacket, reason=reason)
+    p: Packet = Packet()
+    p.deny.reason = reason
+    return p
 
+@_PacketBuilder
 def direction(dx: float, dy: float) -> Packet:
-    return _create_packet(DirectionPacket, dx=dx, dy=dy)
+    p: Packet = Packet()
+    p.direction.dx = dx
+    p.direction.dy = dy
+    return p
 
-def disconnect(reason: str) -> Packet:
-    return _create_packet(DisconnectPacket, reason=reason)
+@_PacketBuilder
+def disconnect(reason: str, reconnect_after_ms: int = 0) -> Packet:
+    p: Packet = Packet()
+    p.disconnect.reason = reason
+    p.disconnect.reconnect_after_ms = reconnect_after_ms
+    return p
 
+@_PacketBuilder
 def login(username: str, password: str) -> Packet:
-    return _create_packet(LoginPacket, username=username, password=password)
+    p: Packet = Packet()
+    p.login.username = username
+    p.login.password = password
+    return p
 
+@_PacketBuilder
 def ok(message: str) -> Packet:
-    return _create_packet(OkPacket, msg=message)
+    p: Packet = Packet()
+    p.ok.msg = message
+    return p
 
-def position(x: float, y: float) -> Packet:
-    return _create_packet(PositionPacket, x=x, y=y)
+@_PacketBuilder
+def party(name: str) -> Packet:
+    p: Packet = Packet()
+    p.party.name = name
+    return p
+
+@_PacketBuilder
+def position(entity_id: int, x: float, y: float) -> Packet:
+    p: Packet = Packet()
+    inner: PositionPacket = p.position
+    inner.id = entity_id
+    inner.x = x
+    inner.y = y
+    return p
 
+@_PacketBuilder
 def register(username: str, password: str) -> Packet:
-    return _create_packet(RegisterPacket, username=username, password=password)
+    p: Packet = Packet()
+    p.register.username = username
+    p.register.password = password
+    return p
+
+@_PacketBuilder
+def session(token: str) -> Packet:
+    p: Packet = Packet()
+    p.session.token = token
+    return p
+
+@_PacketBuilder
+def snapshot(seq: int, baseline: int, ids: list[int], xs: list[int], ys: list[int],
+             removed: list[int]) -> Packet:
+    p: Packet = Packet()
+    inner: SnapshotPacket = p.snapshot
+    inner.seq = seq
+    inner.baseline = baseline
+    inner.ids.extend(ids)
+    inner.xs.extend(xs)
+    inner.ys.extend(ys)
+    inner.removed.extend(removed)
+    return p
 # pylint: enable=missing-function-docstring
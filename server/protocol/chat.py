@@ -0,0 +1,244 @@
+"""
+This module contains the chat router, which delivers chat messages to the players in their channel,
+batched once per tick.
+
+A message is not sent the moment it arrives. It is queued on its channel, and at the end of the
+tick, every message queued on a channel is packed into a single `ChatBatchPacket`, encoded once and
+queued for every member of the channel. However busy chat gets, each player receives at most one
+chat frame per channel per tick, unless the channel's messages would not fit in one frame the
+client can take, in which case they are split over several.
+
+There are four kinds of channel:
+    - Global: everyone connected. With shards, global chat is passed on to the other shards too.
+    - Zone: everyone in the same square zone of the world. Players change zone as they move.
+    - Party: everyone who has joined the same named party.
+    - Whisper: one player, by username, who must be connected to the same shard.
+
+Example usage:
+    router = ChatRouter(registry, world)
+    router.enter(protocol)
+    error = router.post(protocol, packet)
+    ...
+    router.update_zones(world.step(dt))
+    router.flush()
+"""
+from __future__ import annotations
+from typing import Optional, TYPE_CHECKING
+import numpy as np
+import server.net as packets
+from server.net import ChatChannel, ChatPacket
+
+if TYPE_CHECKING:
+    from server.protocol import GameProtocol
+    from server.protocol.registry import ConnectionRegistry
+    from server.shard.relay import ShardRelay
+    from server.world import World
+
+# A queued message's channel, sender and text
+Message = tuple[int, str, str]
+
+# The side length of a chat zone, in world units
+ZONE_SIZE: float = 2000.0
+
+# Godot's websocket peer drops any message bigger than its inbound buffer, which is 64 KiB by
+# default, so batches are kept under that with room to spare
+MAX_BATCH_BYTES: int = 60 * 1024
+
+# More than a message's fields take to encode, besides its sender and text: the tags and lengths
+# of the message and its fields, and the channel
+_MESSAGE_OVERHEAD: int = 16
+
+# The key global chat is queued under, which is not a registry channel since it goes to everyone
+_GLOBAL: str = "global"
+
+
+class ChatRouter:
+    """
+    Tracks which zone and party each player's protocol is in, and delivers the chat messages posted
+    to each channel once per tick, as one frame per channel.
+
+    Args:
+        registry (ConnectionRegistry):
+            The connected protocols. Zones and parties are kept as channels in it.
+        world (World):
+            The world, used to work out which zone each player is in.
+        relay (Optional[ShardRelay]):
+            If given, global chat is also passed on to the other shards.
+        zone_size (float):
+            The side length of a zone, in world units.
+        max_batch (int):
+            The most messages packed into a single frame. Busier channels are sent as several.
+        max_batch_bytes (int):
+            Roughly the largest frame messages are packed into. Channels with more to send are sent
+            as several frames.
+
+    Attributes:
+        messages (int): The number of messages delivered.
+        frames (int): The number of batch frames encoded.
+    """
+    def __init__(self, registry: ConnectionRegistry, world: World,
+                 relay: Optional[ShardRelay] = None, zone_size: float = ZONE_SIZE,
+                 max_batch: int = 256, max_batch_bytes: int = MAX_BATCH_BYTES) -> None:
+        self._registry: ConnectionRegistry = registry
+        self._world: World = world
+        self._relay: Optional[ShardRelay] = relay
+        self._zone_size: float = zone_size
+        self._max_batch: int = max_batch
+        self._max_batch_bytes: int = max_batch_bytes
+        self._pending: dict[str, list[Message]] = {}
+        self._whispers: dict[GameProtocol, list[Message]] = {}
+        self._zone_of: dict[int, str] = {}
+        self._zone_x: np.ndarray = np.zeros(0, dtype=np.int64)
+        self._zone_y: np.ndarray = np.zeros(0, dtype=np.int64)
+        self._party_of: dict[int, str] = {}
+        self.messages: int = 0
+        self.frames: int = 0
+
+    def enter(self, protocol: GameProtocol) -> None:
+        """
+        Puts a player who has just entered the world in the zone they are in. Call this after they
+        have spawned.
+        """
+        self._move_to_zone(protocol, protocol.slot)
+
+    def leave(self, protocol: GameProtocol) -> None:
+        """
+        Takes a player out of their zone and party, e.g. because they have logged out. Anything
+        whispered to them this tick is dropped.
+        """
+        zone: Optional[str] = self._zone_of.pop(protocol.ident, None)
+        if zone is not None:
+            self._registry.leave(zone, protocol)
+        self.leave_party(protocol)
+        self._whispers.pop(protocol, None)
+
+    def join_party(self, protocol: GameProtocol, name: str) -> None:
+        """
+        Puts a player in the named party, taking them out of any party they were already in.
+        """
+        self.leave_party(protocol)
+        channel: str = f"party:{name}"
+        self._party_of[protocol.ident] = channel
+        self._registry.join(channel, protocol)
+
+    def leave_party(self, protocol: GameProtocol) -> None:
+        """
+        Takes a player out of their party, if they are in one.
+        """
+        channel: Optional[str] = self._party_of.pop(protocol.ident, None)
+        if channel is not None:
+            self._registry.leave(channel, protocol)
+
+    def post(self, sender: GameProtocol, packet: ChatPacket) -> Optional[str]:
+        """
+        Queues a message to be delivered at the end of the tick, to the sender as well as everyone
+        else in its channel, so everyone sees the same messages in the same order.
+
+        Returns:
+            Optional[str]: Why the message could not be sent, e.g. the player whispered to is not
+            online, or None if it was queued.
+        """
+        message: Message = (packet.channel, sender.username or "", packet.msg)
+        if packet.channel == ChatChannel.GLOBAL:
+            self._pending.setdefault(_GLOBAL, []).append(message)
+        elif packet.channel == ChatChannel.ZONE:
+            zone: Optional[str] = self._zone_of.get(sender.ident)
+            if zone is None:
+                return "You are not in the world"
+            self._pending.setdefault(zone, []).append(message)
+        elif packet.channel == ChatChannel.PARTY:
+            party: Optional[str] = self._party_of.get(sender.ident)
+            if party is None:
+                return "You are not in a party"
+            self._pending.setdefault(party, []).append(message)
+        elif packet.channel == ChatChannel.WHISPER:
+            recipient: Optional[GameProtocol] = self._registry.by_username(packet.target)
+            if recipient is None or recipient.ident not in self._zone_of:
+                return f"{packet.target} is not online"
+            self._whispers.setdefault(recipient, []).append(message)
+            if recipient is not sender:
+                self._whispers.setdefault(sender, []).append(message)
+        else:
+            return "Unknown chat channel"
+        return None
+
+    def update_zones(self, slots: np.ndarray) -> None:
+        """
+        Moves the players in some world slots, e.g. the ones that moved this tick, into whichever
+        zone they are now in. Only players who crossed into a new zone cost more than a vectorized
+        comparison.
+        """
+        if len(slots) == 0:
+            return
+        self._ensure_capacity(self._world.capacity)
+        zx: np.ndarray = np.floor_divide(self._world.x[slots], self._zone_size).astype(np.int64)
+        zy: np.ndarray = np.floor_divide(self._world.y[slots], self._zone_size).astype(np.int64)
+        crossed: np.ndarray = (zx != self._zone_x[slots]) | (zy != self._zone_y[slots])
+        for slot in slots[crossed].tolist():
+            owner: GameProtocol = self._world.owners[slot]
+            if owner.ident in self._zone_of:
+                self._move_to_zone(owner, slot)
+
+    def flush(self) -> None:
+        """
+        Delivers every message queued this tick, encoding one frame per channel.
+        """
+        if self._pending:
+            pending: dict[str, list[Message]] = self._pending
+            self._pending = {}
+            for channel, messages in pending.items():
+                for frame in self._encode(messages):
+                    if channel == _GLOBAL:
+                        recipients = self._registry
+                        if self._relay is not None:
+                            self._relay.publish(frame)
+                    else:
+                        recipients = self._registry.members(channel)
+                    for recipient in recipients:
+                        recipient.queue_outbound_packet(recipient, frame)
+
+        if self._whispers:
+            whispers: dict[GameProtocol, list[Message]] = self._whispers
+            self._whispers = {}
+            for recipient, messages in whispers.items():
+                for frame in self._encode(messages):
+                    recipient.queue_outbound_packet(recipient, frame)
+
+    def _encode(self, messages: list[Message]) -> list[packets.Frame]:
+        self.messages += len(messages)
+        frames: list[packets.Frame] = []
+        start: int = 0
+        size: int = 0
+        for i, (_, sender, text) in enumerate(messages):
+            message_size: int = len(sender.encode()) + len(text.encode()) + _MESSAGE_OVERHEAD
+            if i > start and (i - start == self._max_batch
+                              or size + message_size > self._max_batch_bytes):
+                frames.append(packets.chat_batch.frame(messages[start:i]))
+                start, size = i, 0
+            size += message_size
+        if start < len(messages):
+            frames.append(packets.chat_batch.frame(messages[start:]))
+        self.frames += len(frames)
+        return frames
+
+    def _move_to_zone(self, protocol: GameProtocol, slot: int) -> None:
+        self._ensure_capacity(self._world.capacity)
+        x: int = int(self._world.x[slot] // self._zone_size)
+        y: int = int(self._world.y[slot] // self._zone_size)
+        self._zone_x[slot], self._zone_y[slot] = x, y
+
+        zone: str = f"zone:{x},{y}"
+        current: Optional[str] = self._zone_of.get(protocol.ident)
+        if current is not None:
+            self._registry.leave(current, protocol)
+        self._zone_of[protocol.ident] = zone
+        self._registry.join(zone, protocol)
+
+    def _ensure_capacity(self, size: int) -> None:
+        if size <= len(self._zone_x):
+            return
+        zone_x: np.ndarray = np.zeros(size, dtype=np.int64)
+        zone_y: np.ndarray = np.zeros(size, dtype=np.int64)
+        zone_x[:len(self._zone_x)] = self._zone_x
+        zone_y[:len(self._zone_y)] = self._zone_y
+        self._zone_x, self._zone_y = zone_x, zone_y
@@ -3,26 +3,96 @@ This module contains the game protocol used for communication between the server
 """
 from __future__ import annotations
 import logging
-from queue import Queue
 from typing import Optional
+import trio
 from google.protobuf.message import DecodeError
 from trio_websocket import WebSocketConnection, ConnectionClosed
-from server.database import SessionMaker
+from server import metrics
+from server.auth import AuthWorker
 import server.net as packets
-from server.protocol import states
+from server.protocol import states, trace
+from server.protocol.outbound import OutboundQueue, OverflowPolicy
+from server.protocol.ratelimit import RateLimiter
+from server.protocol.registry import ConnectionRegistry
+from server.protocol.snapshot import SnapshotTracker
+from server.protocol.chat import ChatRouter
+from server.shard.relay import ShardRelay
+from server.models import PlayerState
+from server.world import PlayerStore, World
 from server.protocol.logging_adapter import ProtocolLoggerAdapter
 
+# The largest message a client can send. Anything bigger is rejected before it is decoded.
+MAX_INBOUND_MESSAGE_SIZE: int = 4096
+
+# How many seconds a kicked client has to take its disconnect packet and close the connection
+KICK_TIMEOUT: float = 2.0
+
 class GameProtocol:
     """
     Represents the game protocol used for communication between the server and clients.
+
+    Outgoing frames are held in a bounded queue and written to the client by a dedicated sender 
+    task, so sending never waits on the server's tick loop.
+
+    Args:
+        server_stream (WebSocketConnection): 
+            The connection to the client.
+        registry (ConnectionRegistry): 
+            The registry of all connected protocols, shared with the server. The protocol registers 
+            itself on creation and unregisters itself when it stops.
+        ident (int): 
+            A unique identifier for this protocol.
+        auth (AuthWorker): 
+            Runs password hashing and user database queries off the event loop.
+        world (World): 
+            The game world the player's entity is spawned into once they have logged in.
+        high_water_mark (int): 
+            The maximum number of frames that can be waiting to be sent to the client.
+        overflow_policy (OverflowPolicy): 
+            What to do when a frame is queued while the outgoing queue is at its high-water mark.
+        max_packets_per_batch (int): 
+            The maximum number of frames the sender task takes from the queue at once.
+        max_bytes_per_batch (int): 
+            The maximum number of encoded bytes the sender task takes from the queue at once.
+        players (Optional[PlayerStore]): 
+            Loads and saves the player's state. If not given, players always start afresh.
+        relay (Optional[ShardRelay]): 
+            If given, broadcasts to every connected protocol are passed on to the other shards too.
+        chat (Optional[ChatRouter]): 
+            Delivers the player's chat messages to their channel, batched per tick. If not given, 
+            chat messages are broadcast to everyone straight away.
+        snapshots (Optional[SnapshotTracker]):
+            Builds the player's snapshots, shared with the server, which is told about the
+            snapshots the client acknowledges. If not given, acknowledgements are ignored.
     """
-    def __init__(self, server_stream: WebSocketConnection, other_protocols: list[GameProtocol],
-                 ident: int, session_factory: SessionMaker) -> None:
+    def __init__(self, server_stream: WebSocketConnection, registry: ConnectionRegistry,
+                 ident: int, auth: AuthWorker, world: World, high_water_mark: int = 1024,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.MERGE,
+                 max_packets_per_batch: int = 256, max_bytes_per_batch: int = 64 * 1024,
+                 players: Optional[PlayerStore] = None,
+                 relay: Optional[ShardRelay] = None,
+                 chat: Optional[ChatRouter] = None,
+                 snapshots: Optional[SnapshotTracker] = None) -> None:
         self._server_connection: WebSocketConnection = server_stream
-        self._other_protocols: list[GameProtocol] = other_protocols
-        self._outgoing_packets: Queue[tuple[GameProtocol, packets.Packet]] = Queue()
+        self.registry: ConnectionRegistry = registry
+        self._outgoing_packets: OutboundQueue = OutboundQueue(high_water_mark, overflow_policy,
+                                                              self._on_outbound_overflow)
+        self._max_packets_per_batch: int = max_packets_per_batch
+        self._max_bytes_per_batch: int = max_bytes_per_batch
         self._ident: int = ident
-        self.session_factory = session_factory
+        self.auth: AuthWorker = auth
+        self.world: World = world
+        self.players: Optional[PlayerStore] = players
+        self.relay: Optional[ShardRelay] = relay
+        self.chat: Optional[ChatRouter] = chat
+        self.username: Optional[str] = None
+        self.user_id: Optional[int] = None
+        self.saved_state: Optional[PlayerState] = None
+        self.snapshots: Optional[SnapshotTracker] = snapshots
+        self.rate_limiter: RateLimiter = RateLimiter()
+        self.bytes_in: int = 0
+        self.bytes_out: int = 0
+        self._close_reason: Optional[str] = None
         self.state: states.ProtocolState = states.EntryState(self)
 
         # Give this protocol a unique identifier to improve logging
@@ -31,27 +101,38 @@ class GameProtocol:
             'state': self.state
         })
 
+        # The protocol's slot indexes its player's state in the world's arrays
+        self.slot: int = self.registry.add(self)
+
     async def start(self) -> None:
         """
-        Starts the game protocol and handles incoming messages.
+        Starts the game protocol's sender task and handles incoming messages.
 
         This method continuously reads messages from the connection and handles them
-        until the connection is closed or an exception occurs.
-
-        Raises:
-            Exception: If an error occurs while handling a message.
+        until the connection is closed or an exception occurs. An exception is logged and the
+        connection closed, so a bug in handling one client's packets only costs that client.
         """
+        metrics.TIMER.tag_current_task("inbound")
         try:
-            while True:
-                data = await self._read_message()
-                if data is None:
-                    break
-                self._handle_message(data)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self._send_loop)
+                while True:
+                    data = await self._read_message()
+                    if data is None:
+                        break
+                    await self._handle_message(data)
+                nursery.cancel_scope.cancel()
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception("Closing the connection after an unexpected error")
+            with trio.move_on_after(KICK_TIMEOUT):
+                await self._server_connection.aclose(1011, "Internal error")
         finally:
+            self.state.exit()
             self.broadcast_packet(
-                packets.disconnect(f"Client #{self._ident} has disconnected"), include_self=False)
+                packets.disconnect.frame(f"Client #{self._ident} has disconnected"),
+                include_self=False)
             self.logger.info("Stopped")
-            self._other_protocols.remove(self)
+            self.registry.remove(self)
 
     def set_state(self, state_cls: type[states.ProtocolState]) -> None:
         """
@@ -75,61 +156,164 @@ class GameProtocol:
 
         new_state: states.ProtocolState = state_cls(self)
         self.logger.info(f"State changing to {new_state}")
+        self.state.exit()
         self.state = new_state
         self.logger.extra['state'] = new_state
+        new_state.enter()
 
-    def queue_outbound_packet(self, recipient: GameProtocol, packet: packets.Packet) -> None:
+    def queue_outbound_packet(self, recipient: GameProtocol,
+                              packet: packets.Packet | packets.Frame) -> None:
         """
-        Queues up a packet to send to another protocol on the next tick.
+        Queues up a packet to be sent to another protocol's client.
 
         Args:
             recipient (GameProtocol): 
                 The protocol to send the packet to. If this is the same as this protocol, the packet 
                 will be sent directly to the connected client.
-            packet (packets.Packet): 
-                The packet to send.
+            packet (packets.Packet | packets.Frame): 
+                The packet to send. Packets are encoded into a frame straight away, so they should 
+                not be modified after being queued.
+
+        Returns:
+            None
+        """
+        frame: packets.Frame = (packet if isinstance(packet, packets.Frame)
+                                else packets.Frame(packet))
+        recipient.enqueue_frame(frame)
+
+    def enqueue_frame(self, frame: packets.Frame) -> None:
+        """
+        Puts an encoded frame on this protocol's outgoing queue, to be written to its client by the
+        sender task. The queue's overflow policy applies if the client is not keeping up.
+
+        Args:
+            frame (packets.Frame): The frame to send. It may be shared with other protocols.
 
         Returns:
             None
         """
-        self._outgoing_packets.put((recipient, packet))
+        self._outgoing_packets.put(frame)
 
-    def broadcast_packet(self, packet: packets.Packet, include_self: bool = False) -> None:
+    def broadcast_packet(self, packet: packets.Packet | packets.Frame, include_self: bool = False,
+                         channel: Optional[str] = None) -> None:
         """
         Queues a packet on all connected protocols' outgoing packet queues, optionally including 
-        this protocol.
+        this protocol. The packet is encoded once and the resulting frame is shared between all 
+        recipients.
 
         Args:
-            packet (packets.Packet): 
+            packet (packets.Packet | packets.Frame): 
                 The packet to broadcast.
             include_self (bool): 
                 Whether to include this protocol in the broadcast (in turn, meaning the client
                 connected to this protocol will receive the packet directly). Defaults to False.
+            channel (Optional[str]): 
+                If given, only broadcast to the protocols in this registry channel. Otherwise, the 
+                packet also goes to every other shard, if there are any.
 
         Returns:
             None
         """
-        for recipient in self._other_protocols:
+        frame: packets.Frame = (packet if isinstance(packet, packets.Frame)
+                                else packets.Frame(packet))
+        if channel is None and self.relay is not None:
+            self.relay.publish(frame)
+        recipients = self.registry if channel is None else self.registry.members(channel)
+        for recipient in recipients:
             if recipient is self and not include_self:
                 continue
-            recipient.queue_outbound_packet(recipient, packet)
+            recipient.queue_outbound_packet(recipient, frame)
 
-    async def tick(self) -> None:
+    def drain(self, reason: str, reconnect_after: float) -> None:
         """
-        Sends the packet at the front of the outgoing packet queue to its destination.
+        Starts disconnecting the client gracefully, e.g. because the server is restarting.
+        Everything already queued is still sent, followed by a fresh session token if the player is
+        logged in, so they can resume without logging in again, and a disconnect packet saying when
+        to reconnect. The connection is then closed with code 1012 (service restart).
+
+        Args:
+            reason (str): The reason given to the client.
+            reconnect_after (float): How many seconds the client should wait before reconnecting.
+
+        Returns:
+            None
         """
-        if self._outgoing_packets.empty():
+        if self._outgoing_packets.closed:
             return
+        if self.user_id is not None and self.username is not None:
+            token: str = self.auth.sessions.issue(self.user_id, self.username)
+            self.queue_outbound_packet(self, packets.session.frame(token))
+        self.queue_outbound_packet(self, packets.disconnect.frame(reason,
+                                                                  int(reconnect_after * 1000)))
+        self._close_reason = reason
+        self._outgoing_packets.close()
 
-        recipient, packet = self._outgoing_packets.get()
-        if recipient == self:
-            await self._send_packet(packet)
-        else:
-            recipient.queue_outbound_packet(recipient, packet)
+    async def kick(self, reason: str) -> None:
+        """
+        Disconnects the client, sending it a disconnect packet straight away rather than queueing it
+        behind whatever is waiting to be sent. A client that has not taken the packet and closed the
+        connection within `KICK_TIMEOUT` seconds, e.g. because it has stopped reading, is cut off.
 
-    async def _send_packet(self, packet: packets.Packet) -> None:
-        self.logger.info(f"Sending packet: {packet}")
-        await self._send_message(packet.SerializeToString())
+        Args:
+            reason (str): The reason given to the client.
+
+        Returns:
+            None
+        """
+        self.logger.warning(f"Kicking client: {reason}")
+        with trio.move_on_after(KICK_TIMEOUT):
+            await self._send_frame(packets.disconnect.frame(reason))
+            await self._server_connection.aclose(code=1008, reason=reason)
+        await trio.aclose_forcefully(self._server_connection)
+
+    @property
+    def ident(self) -> int:
+        """
+        The unique identifier of this protocol, also used as the ID of the player's entity.
+        """
+        return self._ident
+
+    @property
+    def backlog(self) -> int:
+        """
+        The number of frames currently waiting in this protocol's outgoing queue.
+        """
+        return len(self._outgoing_packets)
+
+    @property
+    def dropped(self) -> int:
+        """
+        The number of outgoing frames dropped or merged away because the client was not keeping up.
+        """
+        return self._outgoing_packets.dropped
+
+    async def _send_loop(self) -> None:
+        metrics.TIMER.tag_current_task("outbound")
+        while True:
+            frames: list[packets.Frame] = await self._outgoing_packets.get_batch(
+                self._max_packets_per_batch, self._max_bytes_per_batch)
+            if not frames:
+                if self._outgoing_packets.overflowed:
+                    await self._server_connection.aclose(code=1008,
+                                                         reason="Too many pending packets")
+                else:
+                    await self._server_connection.aclose(code=1012, reason=self._close_reason)
+                return
+
+            for frame in frames:
+                if self._server_connection.closed:
+                    return
+                await self._send_frame(frame)
+
+    def _on_outbound_overflow(self) -> None:
+        self.logger.warning(f"Outgoing queue overflowed at {self.backlog} frames, disconnecting")
+
+    async def _send_frame(self, frame: packets.Frame) -> None:
+        if trace.TRACER.active:
+            trace.TRACER.record(trace.OUTBOUND, self._ident, frame.data)
+        self.bytes_out += len(frame.data)
+        metrics.OUTBOUND.record(frame.type, len(frame.data))
+        await self._send_message(frame.data)
 
     async def _read_message(self) -> Optional[bytes]:
         try:
@@ -152,18 +336,49 @@ class GameProtocol:
             self.logger.error(f"Send error: {exc}")
             raise exc
 
-    def _handle_message(self, data: bytes) -> None:
+    async def _handle_message(self, data: bytes) -> None:
+        if not isinstance(data, bytes):
+            self.logger.warning("Received text message")
+            return
+
+        self.bytes_in += len(data)
+        if trace.TRACER.active:
+            trace.TRACER.record(trace.INBOUND, self._ident, data)
+
+        if len(data) > MAX_INBOUND_MESSAGE_SIZE:
+            self.logger.warning("Rejected %s byte message", len(data))
+            self.queue_outbound_packet(self, packets.deny.cached("Packet too large"))
+            return
+
+        if not self.rate_limiter.allow_message():
+            self.queue_outbound_packet(self, packets.deny.cached("Slow down"))
+            await self._on_rate_limited()
+            return
+
         try:
             packet: packets.Packet = packets.Packet.FromString(data)
         except DecodeError as exc:
-            self.logger.warning(f"Failed to decode packet: {exc}")
+            self.logger.warning("Failed to decode packet: %s", exc)
+            return
+
+        # A packet only ever has its one oneof field set
+        fields: list = packet.ListFields()
+        if not fields:
+            self.logger.warning("Received packet with no type")
+            return
+
+        field, message = fields[0]
+        metrics.INBOUND.record(field.name, len(data))
+        state: states.ProtocolState = self.state
+        if not self.rate_limiter.allow(type(state), field.number,
+                                       state.rate_limit_table[field.number]):
+            self.queue_outbound_packet(self, packets.deny.cached("Slow down"))
+            await self._on_rate_limited()
+            return
 
         # Dispatch to protocol state handler
-        packet_type: str = packet.WhichOneof("type")
-        handler_name: str = f"handle_{packet_type}_packet"
-        handler: callable = getattr(self.state, handler_name)
+        await state.handlers[field.number](message)
 
-        try:
-            handler(getattr(packet, packet_type))
-        except TypeError:
-            self.logger.warning(f"State {self.state} does not implement {handler_name}")
+    async def _on_rate_limited(self) -> None:
+        if self.rate_limiter.exhausted:
+            await self.kick("Too many requests")
@@ -0,0 +1,174 @@
+"""
+This module contains the outbound frame queue used by each protocol to hold frames waiting to be 
+written to its client.
+
+The whole server runs on a single trio thread, so the queue does no locking. Instead, it is bounded 
+by a high-water mark so a slow or malicious client cannot grow it without limit. What happens when 
+the mark is reached is decided by the queue's `OverflowPolicy`.
+"""
+from collections import deque
+from enum import Enum
+from typing import Callable, Hashable
+import trio
+from server.net import Frame
+
+# Frames of these types can be dropped under pressure without breaking the game for the client
+LOW_PRIORITY_TYPES: frozenset[str] = frozenset({"chat", "position", "snapshot"})
+
+# Frames of these types are superseded by a newer frame with the same merge key
+MERGEABLE_TYPES: frozenset[str] = frozenset({"position", "snapshot"})
+
+
+class OverflowPolicy(Enum):
+    """
+    What an `OutboundQueue` does when a frame is queued while it is at its high-water mark.
+
+    Attributes:
+        DROP_OLDEST: 
+            Drop the oldest low-priority frame to make room. If there are none, the new frame is 
+            dropped if it is itself low-priority, otherwise the client is disconnected.
+        MERGE: 
+            Discard mergeable frames that have been superseded by a newer frame with the same 
+            merge key, then fall back to `DROP_OLDEST` if that did not make room.
+        DISCONNECT: 
+            Disconnect the client.
+    """
+    DROP_OLDEST = "drop_oldest"
+    MERGE = "merge"
+    DISCONNECT = "disconnect"
+
+
+def _merge_key(frame: Frame) -> Hashable:
+    if frame.type == "position":
+        return frame.type, frame.packet.position.id
+    return frame.type
+
+
+class OutboundQueue:
+    """
+    A bounded, single-consumer queue of frames waiting to be sent to a client.
+
+    Args:
+        high_water_mark (int): 
+            The maximum number of frames the queue will hold.
+        policy (OverflowPolicy): 
+            What to do when a frame is queued while the queue is full.
+        on_overflow (Callable[[], None]): 
+            Called once, when the queue gives up on the client because no room could be made. 
+            After this, the queue discards everything put on it.
+
+    Attributes:
+        dropped (int): The number of frames dropped or merged away to make room.
+        overflowed (bool): Whether the queue has given up on the client.
+        closed (bool): Whether the queue has been closed, so takes no more frames.
+    """
+    def __init__(self, high_water_mark: int, policy: OverflowPolicy,
+                 on_overflow: Callable[[], None]) -> None:
+        self._frames: deque[Frame] = deque()
+        self._high_water_mark: int = high_water_mark
+        self._policy: OverflowPolicy = policy
+        self._on_overflow: Callable[[], None] = on_overflow
+        self._wakeup: trio.Event = trio.Event()
+        self.dropped: int = 0
+        self.overflowed: bool = False
+        self.closed: bool = False
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, frame: Frame) -> None:
+        """
+        Queues a frame, applying the overflow policy if the queue is full.
+
+        Args:
+            frame (Frame): The frame to queue.
+
+        Returns:
+            None
+        """
+        if self.overflowed or self.closed:
+            return
+
+        if len(self._frames) >= self._high_water_mark and not self._make_room(frame):
+            if frame.type in LOW_PRIORITY_TYPES and self._policy is not OverflowPolicy.DISCONNECT:
+                self.dropped += 1
+                return
+            self.overflowed = True
+            self._on_overflow()
+            self._frames.clear()
+            self._wakeup.set()
+            return
+
+        self._frames.append(frame)
+        self._wakeup.set()
+
+    async def get_batch(self, max_frames: int, max_bytes: int) -> list[Frame]:
+        """
+        Waits until at least one frame is queued, then takes frames from the front of the queue 
+        until either budget is spent. At least one frame is always taken, so a single oversized 
+        frame cannot wedge the queue.
+
+        Args:
+            max_frames (int): The maximum number of frames to take.
+            max_bytes (int): The maximum number of encoded bytes to take.
+
+        Returns:
+            list[Frame]: The frames taken, or an empty list if the queue has overflowed, or has been 
+            closed and everything queued before that has been taken.
+        """
+        while not self._frames:
+            if self.overflowed or self.closed:
+                return []
+            self._wakeup = trio.Event()
+            await self._wakeup.wait()
+
+        batch: list[Frame] = []
+        num_bytes: int = 0
+        while self._frames and len(batch) < max_frames and num_bytes < max_bytes:
+            frame: Frame = self._frames.popleft()
+            num_bytes += len(frame.data)
+            batch.append(frame)
+        return batch
+
+    def close(self) -> None:
+        """
+        Stops the queue taking any more frames. The frames already queued can still be taken.
+        """
+        self.closed = True
+        self._wakeup.set()
+
+    def _make_room(self, frame: Frame) -> bool:
+        if self._policy is OverflowPolicy.DISCONNECT:
+            return False
+        if self._policy is OverflowPolicy.MERGE and self._merge(frame):
+            return True
+        return self._drop_oldest()
+
+    def _merge(self, frame: Frame) -> bool:
+        # Walk from newest to oldest, keeping only the newest frame for each merge key. The
+        # incoming frame counts as the newest of its key.
+        seen: set[Hashable] = set()
+        if frame.type in MERGEABLE_TYPES:
+            seen.add(_merge_key(frame))
+
+        kept: deque[Frame] = deque()
+        for queued in reversed(self._frames):
+            if queued.type in MERGEABLE_TYPES:
+                key: Hashable = _merge_key(queued)
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.appendleft(queued)
+
+        merged: int = len(self._frames) - len(kept)
+        self._frames = kept
+        self.dropped += merged
+        return merged > 0
+
+    def _drop_oldest(self) -> bool:
+        for i, queued in enumerate(self._frames):
+            if queued.type in LOW_PRIORITY_TYPES:
+                del self._frames[i]
+                self.dropped += 1
+                return True
+        return False
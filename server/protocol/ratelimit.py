@@ -0,0 +1,115 @@
+"""
+This module contains the token-bucket rate limiter used to stop a single client from flooding the 
+server with packets.
+
+Each protocol state declares how fast each packet type may be sent to it. A client that goes over a 
+limit has the packet denied and earns a strike. Strikes wear off over time, but a client that earns 
+too many too quickly is disconnected.
+"""
+import time
+from typing import NamedTuple, Optional
+
+
+class RateLimit(NamedTuple):
+    """
+    How fast something is allowed to happen.
+
+    Attributes:
+        rate (float): How many times per second, on average.
+        burst (float): How many times in quick succession, after a quiet period.
+    """
+    rate: float
+    burst: float
+
+
+class TokenBucket:
+    """
+    A token bucket. It starts full and refills continuously at `rate` tokens per second, up to 
+    `burst` tokens. Each allowed action takes one token.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, limit: RateLimit, now: float) -> None:
+        self.rate: float = limit.rate
+        self.burst: float = limit.burst
+        self.tokens: float = limit.burst
+        self.updated: float = now
+
+    def take(self, now: float) -> bool:
+        """
+        Takes a token if there is one.
+
+        Returns:
+            bool: True if a token was taken, or False if the bucket is empty.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    Rate limits the packets a single client sends. Buckets are created as they are first needed, and 
+    there is at most one per packet type per protocol state, so the limiter's size does not grow 
+    with traffic. Buckets are kept when the protocol changes state, so a client cannot reset its 
+    limits by logging out and back in.
+
+    Args:
+        message_limit (RateLimit): 
+            How fast the client may send messages of any kind, checked before they are decoded.
+        strike_limit (RateLimit): 
+            How many strikes the client may earn in quick succession, and how fast they wear off.
+        enabled (bool): 
+            Whether to limit anything at all. Disabled limiters allow everything, which is useful 
+            for benchmarks and replaying captured traffic.
+    """
+    def __init__(self, message_limit: RateLimit = RateLimit(50, 100),
+                 strike_limit: RateLimit = RateLimit(0.1, 5), enabled: bool = True) -> None:
+        now: float = time.monotonic()
+        self.enabled: bool = enabled
+        self._messages: TokenBucket = TokenBucket(message_limit, now)
+        self._strikes: TokenBucket = TokenBucket(strike_limit, now)
+        self._buckets: dict[tuple[type, int], TokenBucket] = {}
+        self.exhausted: bool = False
+
+    def allow_message(self) -> bool:
+        """
+        Checks whether the client may send another message of any kind, earning a strike if not.
+        """
+        if not self.enabled or self._messages.take(time.monotonic()):
+            return True
+        self._strike()
+        return False
+
+    def allow(self, state_cls: type, packet_number: int, limit: Optional[RateLimit]) -> bool:
+        """
+        Checks whether the client may send another packet of a type, earning a strike if not.
+
+        Args:
+            state_cls (type): The class of the protocol state receiving the packet.
+            packet_number (int): The field number of the packet's type in the `Packet.type` oneof.
+            limit (Optional[RateLimit]):
+                The state's limit for the packet type, or None for no limit.
+
+        Returns:
+            bool: Whether the packet is allowed.
+        """
+        if limit is None or not self.enabled:
+            return True
+
+        now: float = time.monotonic()
+        key: tuple[type, int] = (state_cls, packet_number)
+        bucket: Optional[TokenBucket] = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(limit, now)
+        if bucket.take(now):
+            return True
+        self._strike()
+        return False
+
+    def _strike(self) -> None:
+        if not self._strikes.take(time.monotonic()):
+            self.exhausted = True
@@ -0,0 +1,169 @@
+"""
+This module contains the connection registry, which keeps track of every connected protocol.
+
+Each protocol is given a slot number when it registers. Slots are handed out lowest-first and reused 
+once freed, so they stay dense and can be used to index array-backed per-player state, such as the 
+world's entity arrays.
+"""
+from __future__ import annotations
+import heapq
+from typing import TYPE_CHECKING, Iterator, Optional
+if TYPE_CHECKING:
+    from server.protocol import GameProtocol
+
+
+class ConnectionRegistry:
+    """
+    Keeps track of every connected protocol, with O(1) registration, removal and lookup by ident, 
+    slot or username, and named channels of protocols for targeted broadcasts.
+
+    Iterating over the registry iterates over a snapshot of it, so protocols can register and leave 
+    while it is being iterated over. The snapshot is only rebuilt after the registry changes.
+    """
+    def __init__(self) -> None:
+        self._by_ident: dict[int, GameProtocol] = {}
+        self._by_username: dict[str, GameProtocol] = {}
+        self._username_of: dict[int, str] = {}
+        self._slots: list[Optional[GameProtocol]] = []
+        self._slot_of: dict[int, int] = {}
+        self._free_slots: list[int] = []
+        self._channels: dict[str, set[GameProtocol]] = {}
+        self._channels_of: dict[int, set[str]] = {}
+        self._snapshot: Optional[tuple[GameProtocol, ...]] = None
+
+    def __len__(self) -> int:
+        return len(self._by_ident)
+
+    def __contains__(self, protocol: GameProtocol) -> bool:
+        return self._by_ident.get(protocol.ident) is protocol
+
+    def __iter__(self) -> Iterator[GameProtocol]:
+        return iter(self.snapshot())
+
+    def snapshot(self) -> tuple[GameProtocol, ...]:
+        """
+        Returns every registered protocol, as of now.
+        """
+        if self._snapshot is None:
+            self._snapshot = tuple(self._by_ident.values())
+        return self._snapshot
+
+    def add(self, protocol: GameProtocol) -> int:
+        """
+        Registers a protocol.
+
+        Returns:
+            int: The slot the protocol was given.
+
+        Raises:
+            ValueError: If a protocol with the same ident is already registered.
+        """
+        if protocol.ident in self._by_ident:
+            raise ValueError(f"Protocol #{protocol.ident} is already registered")
+
+        if self._free_slots:
+            slot: int = heapq.heappop(self._free_slots)
+            self._slots[slot] = protocol
+        else:
+            slot = len(self._slots)
+            self._slots.append(protocol)
+
+        self._by_ident[protocol.ident] = protocol
+        self._slot_of[protocol.ident] = slot
+        self._snapshot = None
+        return slot
+
+    def remove(self, protocol: GameProtocol) -> None:
+        """
+        Unregisters a protocol, removing it from every channel and freeing its slot and username. 
+        Does nothing if the protocol is not registered.
+        """
+        if protocol not in self:
+            return
+
+        for channel in self._channels_of.pop(protocol.ident, set()):
+            self._discard_member(channel, protocol)
+        self.clear_username(protocol)
+
+        slot: int = self._slot_of.pop(protocol.ident)
+        self._slots[slot] = None
+        heapq.heappush(self._free_slots, slot)
+        del self._by_ident[protocol.ident]
+        self._snapshot = None
+
+    def get(self, ident: int) -> Optional[GameProtocol]:
+        """
+        Returns the protocol with the given ident, or None if there is none.
+        """
+        return self._by_ident.get(ident)
+
+    def by_slot(self, slot: int) -> Optional[GameProtocol]:
+        """
+        Returns the protocol in the given slot, or None if the slot is free.
+        """
+        return self._slots[slot] if 0 <= slot < len(self._slots) else None
+
+    def by_username(self, username: str) -> Optional[GameProtocol]:
+        """
+        Returns the protocol logged in as the given user, or None if the user is not logged in.
+        """
+        return self._by_username.get(username)
+
+    def set_username(self, protocol: GameProtocol, username: str) -> bool:
+        """
+        Records which user a protocol is logged in as.
+
+        Returns:
+            bool: True if recorded, or False if another protocol is already logged in as that user.
+        """
+        current: Optional[GameProtocol] = self._by_username.get(username)
+        if current is not None and current is not protocol:
+            return False
+        self.clear_username(protocol)
+        self._by_username[username] = protocol
+        self._username_of[protocol.ident] = username
+        return True
+
+    def clear_username(self, protocol: GameProtocol) -> None:
+        """
+        Forgets which user a protocol is logged in as, if any.
+        """
+        username: Optional[str] = self._username_of.pop(protocol.ident, None)
+        if username is not None:
+            del self._by_username[username]
+
+    def join(self, channel: str, protocol: GameProtocol) -> None:
+        """
+        Adds a protocol to a channel, creating the channel if needed.
+        """
+        self._channels.setdefault(channel, set()).add(protocol)
+        self._channels_of.setdefault(protocol.ident, set()).add(channel)
+
+    def leave(self, channel: str, protocol: GameProtocol) -> None:
+        """
+        Removes a protocol from a channel. Empty channels are deleted.
+        """
+        channels: Optional[set[str]] = self._channels_of.get(protocol.ident)
+        if channels is not None:
+            channels.discard(channel)
+        self._discard_member(channel, protocol)
+
+    def members(self, channel: str) -> tuple[GameProtocol, ...]:
+        """
+        Returns every protocol in a channel, as of now.
+        """
+        return tuple(self._channels.get(channel, ()))
+
+    def channels_of(self, protocol: GameProtocol) -> frozenset[str]:
+        """
+        Returns every channel a protocol is in.
+        """
+        return frozenset(self._channels_of.get(protocol.ident, ()))
+
+    def _discard_member(self, channel: str, protocol: GameProtocol) -> None:
+        members: Optional[set[GameProtocol]] = self._channels.get(channel)
+        if members is None:
+            return
+        members.discard(protocol)
+        if not members:
+            del self._channels[channel]
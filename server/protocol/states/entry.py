@@ -2,10 +2,12 @@
 Entry state for the protocol. This state is used for handling packets that are sent/received before 
 the player has logged in.
 """
-import bcrypt
+from typing import Optional
 from sqlalchemy.exc import SQLAlchemyError
+from server.auth import MAX_PASSWORD_BYTES
 from server.models import User
-from server.net import Packet, RegisterPacket, LoginPacket, ok, deny
+from server.net import LoginPacket, RegisterPacket, SessionPacket, deny, ok, session
+from server.protocol.ratelimit import RateLimit
 from server.protocol.states.protocol_state import ProtocolState
 import server.protocol.states as states
 
@@ -13,58 +15,114 @@ class EntryState(ProtocolState):
     """
     Represents the entry state of the protocol.
 
-    This state handles packets that are sent/received before the player has logged in.
+    This state handles packets that are sent/received before the player has logged in. Password 
+    hashing and database queries are handed to the protocol's auth worker, so while they run the 
+    event loop carries on serving every other client.
+
+    Logging in and registering are expensive, so clients are limited to a handful of attempts, and 
+    turned away while the auth worker is too backed up to take on more. Clients that were logged in 
+    recently, e.g. before the server restarted, can send the session token they were given instead 
+    of logging in, which skips checking their password.
     """
-    def handle_login_packet(self, packet: LoginPacket):
-        with self.proto.session_factory() as session:
-            try:
-                # Check if the username exists
-                error_msg: str = "Invalid username or password"
-                user: User = session.query(User).filter_by(username=packet.username).first()
-                if user is None:
-                    deny_packet: Packet = deny(error_msg)
-                    self.proto.queue_outbound_packet(self.proto, deny_packet)
-                    return
-
-                # Check if the password is correct
-                if not bcrypt.checkpw(packet.password.encode(), user.password):
-                    deny_packet: Packet = deny(error_msg)
-                    self.proto.queue_outbound_packet(self.proto, deny_packet)
-                    return
-
-                # Login successful
-                ok_packet: Packet = ok("Successfully logged in")
-                self.proto.queue_outbound_packet(self.proto, ok_packet)
-                self.proto.set_state(states.PlayState)
-
-            except SQLAlchemyError as exc:
-                error_msg: str = "An error occurred while logging in"
-                self.proto.logger.error(f"{error_msg}: {exc!r}")
-                session.rollback()
-                deny_packet: Packet = deny(error_msg)
-                self.proto.queue_outbound_packet(self.proto, deny_packet)
-
-
-    def handle_register_packet(self, packet: RegisterPacket):
-        with self.proto.session_factory() as session:
-            try:
-                # Check if the username is already taken
-                if session.query(User).filter_by(username=packet.username).first() is not None:
-                    deny_packet: Packet = deny("Username already taken")
-                    self.proto.queue_outbound_packet(self.proto, deny_packet)
-                    return
-
-                # Create the user
-                pw_hash: bytes = bcrypt.hashpw(packet.password.encode(), bcrypt.gensalt())
-                user: User = User(username=packet.username, password=pw_hash)
-                session.add(user)
-                session.commit()
-                ok_packet: Packet = ok("Successfully registered")
-                self.proto.queue_outbound_packet(self.proto, ok_packet)
-
-            except SQLAlchemyError as exc:
-                error_msg: str = "An error occurred while registering"
-                self.proto.logger.error(f"{error_msg}: {exc!r}")
-                session.rollback()
-                deny_packet: Packet = deny(error_msg)
-                self.proto.queue_outbound_packet(self.proto, deny_packet)
+    rate_limits = {
+        "login": RateLimit(0.5, 3),
+        "register": RateLimit(0.1, 2),
+        "session": RateLimit(0.5, 3),
+    }
+    default_rate_limit = RateLimit(2, 5)
+
+    async def handle_login_packet(self, packet: LoginPacket):
+        if self.proto.auth.busy:
+            self.proto.queue_outbound_packet(self.proto,
+                                             deny.cached("Server busy, please try again"))
+            return
+
+        try:
+            # Check if the username exists
+            error_msg: str = "Invalid username or password"
+            user: User = await self.proto.auth.find_user(packet.username)
+            if user is None:
+                self.proto.queue_outbound_packet(self.proto, deny.cached(error_msg))
+                return
+
+            # Check if the password is correct
+            if not await self.proto.auth.check_password(packet.password, user.password):
+                self.proto.queue_outbound_packet(self.proto, deny.cached(error_msg))
+                return
+
+            await self._enter_world(user.id, user.username, "Successfully logged in")
+
+        except (SQLAlchemyError, ValueError) as exc:
+            error_msg: str = "An error occurred while logging in"
+            self.proto.logger.error(f"{error_msg}: {exc!r}")
+            self.proto.queue_outbound_packet(self.proto, deny.cached(error_msg))
+
+
+    async def handle_register_packet(self, packet: RegisterPacket):
+        if self.proto.auth.busy:
+            self.proto.queue_outbound_packet(self.proto,
+                                             deny.cached("Server busy, please try again"))
+            return
+
+        # bcrypt cannot hash anything longer
+        if len(packet.password.encode()) > MAX_PASSWORD_BYTES:
+            self.proto.queue_outbound_packet(
+                self.proto, deny.cached(f"Passwords can be at most {MAX_PASSWORD_BYTES} bytes"))
+            return
+
+        try:
+            # Check if the username is already taken
+            if await self.proto.auth.find_user(packet.username) is not None:
+                self.proto.queue_outbound_packet(self.proto, deny.cached("Username already taken"))
+                return
+
+            # Create the user. The name may have been taken while the password was being hashed.
+            pw_hash: bytes = await self.proto.auth.hash_password(packet.password)
+            if not await self.proto.auth.create_user(packet.username, pw_hash):
+                self.proto.queue_outbound_packet(self.proto, deny.cached("Username already taken"))
+                return
+
+            self.proto.queue_outbound_packet(self.proto, ok.cached("Successfully registered"))
+
+        except (SQLAlchemyError, ValueError) as exc:
+            error_msg: str = "An error occurred while registering"
+            self.proto.logger.error(f"{error_msg}: {exc!r}")
+            self.proto.queue_outbound_packet(self.proto, deny.cached(error_msg))
+
+    async def handle_session_packet(self, packet: SessionPacket):
+        try:
+            resumed: Optional[tuple[int, str]] = await self.proto.auth.resume_session(packet.token)
+            if resumed is None:
+                self.proto.queue_outbound_packet(
+                    self.proto, deny.cached("Session expired, please log in again"))
+                return
+
+            user_id, username = resumed
+            await self._enter_world(user_id, username, "Welcome back")
+
+        except SQLAlchemyError as exc:
+            error_msg: str = "An error occurred while resuming your session"
+            self.proto.logger.error(f"{error_msg}: {exc!r}")
+            self.proto.queue_outbound_packet(self.proto, deny.cached(error_msg))
+
+    async def _enter_world(self, user_id: int, username: str, message: str) -> None:
+        # Load where the player was before they enter the world
+        if self.proto.players is not None:
+            self.proto.saved_state = await self.proto.players.load(user_id)
+
+        # Only allow one connection per user at a time, on this shard or any other
+        if not self.proto.registry.set_username(self.proto, username):
+            self.proto.queue_outbound_packet(self.proto, deny.cached("Already logged in"))
+            return
+        if self.proto.relay is not None and not await self.proto.relay.claim(username):
+            self.proto.registry.clear_username(self.proto)
+            self.proto.queue_outbound_packet(self.proto, deny.cached("Already logged in"))
+            return
+        self.proto.username = username
+        self.proto.user_id = user_id
+
+        # Logged in, with a token to get back in with if the connection is lost
+        self.proto.queue_outbound_packet(self.proto, ok.cached(message))
+        token: str = self.proto.auth.sessions.issue(user_id, username)
+        self.proto.queue_outbound_packet(self.proto, session.frame(token))
+        self.proto.set_state(states.PlayState)
@@ -2,20 +2,91 @@
 Play state for the protocol. This state is used for handling packets that are sent/received after 
 the player has entered the game world.
 """
-from server.net import ChatPacket, DisconnectPacket, chat, disconnect
+from typing import Optional
+from sqlalchemy.exc import SQLAlchemyError
+from server.models import PlayerState
+from server.net import AckPacket, ChatPacket, DirectionPacket, DisconnectPacket, PartyPacket, \
+    chat, deny, disconnect
+from server.protocol.ratelimit import RateLimit
 from server.protocol.states.protocol_state import ProtocolState
+from server.world import World
 import server.protocol.states as states
 
 class PlayState(ProtocolState):
     """
     Represents the play state of the protocol. This state is used for handling packets that are 
     sent/received after the player has entered the game world.
+
+    While in this state, the player has an entity in the world, which lives in the protocol's slot. 
+    It spawns wherever the player was last saved, and is saved periodically until it leaves. The 
+    player also takes part in chat, in the global channel, their zone's channel and their party's.
     """
-    def handle_chat_packet(self, packet: ChatPacket):
-        self.proto.logger.info(f"Received chat message: {packet.msg}")
-        self.proto.broadcast_packet(chat(packet.msg))
+    rate_limits = {
+        "ack": RateLimit(60, 60),
+        "chat": RateLimit(2, 5),
+        "direction": RateLimit(30, 30),
+        "party": RateLimit(0.5, 3),
+    }
+    default_rate_limit = RateLimit(5, 10)
+
+    def enter(self) -> None:
+        saved: Optional[PlayerState] = self.proto.saved_state
+        x, y = (saved.x, saved.y) if saved is not None else (0.0, 0.0)
+        self.proto.world.spawn(self.proto.slot, self.proto.ident, self.proto, x, y)
+        if self.proto.players is not None and self.proto.user_id is not None:
+            self.proto.players.track(self.proto.slot, self.proto.user_id)
+        if self.proto.chat is not None:
+            self.proto.chat.enter(self.proto)
+
+    def exit(self) -> None:
+        if self.proto.chat is not None:
+            self.proto.chat.leave(self.proto)
+        # The slot may already hold someone else's entity if this player has left before
+        world: World = self.proto.world
+        if self.proto.slot in world and world.owners[self.proto.slot] is self.proto:
+            if self.proto.players is not None:
+                self.proto.players.untrack(self.proto.slot, world)
+            world.despawn(self.proto.slot)
+        if self.proto.relay is not None and self.proto.username is not None:
+            self.proto.relay.release(self.proto.username)
+        self.proto.registry.clear_username(self.proto)
+        self.proto.username = None
+        self.proto.user_id = None
+        self.proto.saved_state = None
+
+    async def handle_ack_packet(self, packet: AckPacket):
+        if self.proto.snapshots is not None:
+            self.proto.snapshots.ack(self.proto.slot, packet.seq)
 
-    def handle_disconnect_packet(self, packet: DisconnectPacket):
-        self.proto.logger.info(f"Received disconnect packet: {packet.reason}")
-        self.proto.broadcast_packet(disconnect(packet.reason))
+    async def handle_chat_packet(self, packet: ChatPacket):
+        self.proto.logger.debug("Received chat message: %s", packet.msg)
+        if self.proto.chat is None:
+            self.proto.broadcast_packet(chat.frame(packet.msg, sender=self.proto.username or ""))
+            return
+        error: Optional[str] = self.proto.chat.post(self.proto, packet)
+        if error is not None:
+            self.proto.queue_outbound_packet(self.proto, deny(error))
+
+    async def handle_direction_packet(self, packet: DirectionPacket):
+        self.proto.world.set_direction(self.proto.slot, packet.dx, packet.dy)
+
+    async def handle_disconnect_packet(self, packet: DisconnectPacket):
+        self.proto.logger.info("Received disconnect packet: %s", packet.reason)
+        self.proto.broadcast_packet(disconnect.frame(packet.reason))
+        user_id: Optional[int] = self.proto.user_id
         self.proto.set_state(states.EntryState)
+
+        # Logging out ends the session, so the token the client was given no longer gets it back in
+        if user_id is not None:
+            try:
+                await self.proto.auth.revoke_sessions(user_id)
+            except SQLAlchemyError as exc:
+                self.proto.logger.error(f"Could not revoke the logged out user's sessions: {exc!r}")
+
+    async def handle_party_packet(self, packet: PartyPacket):
+        if self.proto.chat is None:
+            self.proto.queue_outbound_packet(self.proto, deny.cached("Parties are not available"))
+        elif packet.name:
+            self.proto.chat.join_party(self.proto, packet.name)
+        else:
+            self.proto.chat.leave_party(self.proto)
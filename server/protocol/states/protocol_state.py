@@ -4,54 +4,123 @@ handling packets that are sent/received in a specific context. For example, the
 for handling packets that are sent/received before the player has logged in. This way, we can 
 separate the logic for handling packets into different states, which makes it easier to manage and 
 maintain the code.
+
+Each state class has a dispatch table, built once when the class is created, mapping the field 
+number of each packet type in the `Packet.type` oneof to that packet type's handler. Every packet 
+type must have a handler, so forgetting to add the default one below fails as soon as the server 
+starts rather than when the packet first arrives. A second table holds how fast clients may send 
+each packet type while in the state, taken from the class's `rate_limits`.
 """
 from __future__ import annotations
 from abc import ABC
-from typing import TYPE_CHECKING
+from types import MethodType
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Coroutine, Optional
+from google.protobuf.descriptor import FieldDescriptor
 from server.net import Packet, deny
+from server.protocol.ratelimit import RateLimit
 if TYPE_CHECKING:
     from server.protocol import GameProtocol
 
+Handler = Callable[[Any], Coroutine[Any, Any, None]]
+
+_PACKET_TYPE_FIELDS: tuple[FieldDescriptor, ...] = tuple(
+    Packet.DESCRIPTOR.oneofs_by_name["type"].fields)
+
 class ProtocolState(ABC):
     """
     Abstract protocol state class. This class is used for handling packets that are sent/received in 
     a specific context. Implementations of this class should override the handle_*_packet methods.
+
+    Implementations can also set `rate_limits` to limit how fast each packet type can be sent while 
+    in the state, keyed by packet type name (e.g. "chat"). Packet types not listed there are limited 
+    by `default_rate_limit`, or not at all if that is None.
+
+    Attributes:
+        handlers (dict[int, Handler]): 
+            This state's handlers, bound to it, keyed by the field number of their packet type.
+        rate_limit_table (dict[int, Optional[RateLimit]]): 
+            This state's rate limits, keyed by the field number of their packet type.
     """
+    rate_limits: ClassVar[dict[str, RateLimit]] = {}
+    default_rate_limit: ClassVar[Optional[RateLimit]] = None
+    rate_limit_table: ClassVar[dict[int, Optional[RateLimit]]] = {}
+    _dispatch_table: ClassVar[dict[int, Callable]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._dispatch_table = {
+            field.number: getattr(cls, f"handle_{field.name}_packet")
+            for field in _PACKET_TYPE_FIELDS
+        }
+        cls.rate_limit_table = {
+            field.number: cls.rate_limits.get(field.name, cls.default_rate_limit)
+            for field in _PACKET_TYPE_FIELDS
+        }
+
     def __init__(self, protocol: GameProtocol):
         self.proto = protocol
+        self.handlers: dict[int, Handler] = {
+            number: MethodType(func, self) for number, func in self._dispatch_table.items()
+        }
+
+    def enter(self) -> None:
+        """
+        Called when the protocol changes to this state. Override to set up anything the state needs.
+        """
+
+    def exit(self) -> None:
+        """
+        Called when the protocol leaves this state, either by changing state or by disconnecting. 
+        Override to clean up anything set up in `enter`.
+        """
 
     def _log_unregistered_packet(self, packet: Packet):
-        self.proto.logger.warning(f"Received {packet.DESCRIPTOR.name} packet in unregistered state")
-        d: Packet = deny("You cannot perform this action")
-        self.proto.queue_outbound_packet(self.proto, d)
+        self.proto.logger.warning("Received %s packet in unregistered state",
+                                  packet.DESCRIPTOR.name)
+        self.proto.queue_outbound_packet(self.proto, deny.cached("You cannot perform this action"))
 
     # Maintain all handle_*_packet methods in alphabetical order. This means classes that inherit
     # from this class will have the deny packet handler by default, unless they specifically
     # override it.
 
     # pylint: disable=missing-function-docstring
-    def handle_chat_packet(self, packet: Packet):
+    async def handle_ack_packet(self, packet: Packet):
+        self._log_unregistered_packet(packet)
+
+    async def handle_chat_packet(self, packet: Packet):
+        self._log_unregistered_packet(packet)
+
+    async def handle_chat_batch_packet(self, packet: Packet):
+        self._log_unregistered_packet(packet)
+
+    async def handle_deny_packet(self, packet: Packet):
+        self._log_unregistered_packet(packet)
+
+    async def handle_direction_packet(self, packet: Packet):
+        self._log_unregistered_packet(packet)
+
+    async def handle_disconnect_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_deny_packet(self, packet: Packet):
+    async def handle_login_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_direction_packet(self, packet: Packet):
+    async def handle_ok_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_disconnect_packet(self, packet: Packet):
+    async def handle_party_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_login_packet(self, packet: Packet):
+    async def handle_position_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_ok_packet(self, packet: Packet):
+    async def handle_register_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_position_packet(self, packet: Packet):
+    async def handle_session_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
 
-    def handle_register_packet(self, packet: Packet):
+    async def handle_snapshot_packet(self, packet: Packet):
         self._log_unregistered_packet(packet)
     # pylint: enable=missing-function-docstring
 
@@ -0,0 +1,228 @@
+"""
+This module contains the packet tracer, which records the packets each protocol sends and receives
+without slowing the hot path down when it is switched off.
+
+Tracing has two outputs, which can be used separately or together:
+    * Text traces, logged at DEBUG to the `server.protocol.trace` logger. Formatting a packet as
+      text is expensive, so it is deferred until a log handler actually emits the record, and can
+      be sampled so only one packet in every N is traced.
+    * A binary capture of every raw frame, written to a file that is rotated once it grows too
+      large, so a session can be analyzed or replayed offline with `read_capture`. Captures include
+      login and register packets, passwords and all, so they should be handled like credentials.
+
+Every capture file starts with `CAPTURE_MAGIC`, followed by one record per frame: a `RECORD` header
+holding the time the frame was seen (seconds since the epoch), its direction (`INBOUND` or
+`OUTBOUND`), the identifier of the protocol that saw it and the frame's length, then the frame's
+bytes.
+
+Example usage:
+    trace.TRACER.configure(sample_rate=0.01, capture=PacketCapture("packets.cap"))
+    if trace.TRACER.active:
+        trace.TRACER.record(trace.OUTBOUND, protocol.ident, frame.data)
+"""
+import logging
+import os
+import struct
+import time
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+from google.protobuf import text_format
+from server.net import Packet
+
+CAPTURE_MAGIC: bytes = b"PKTCAP\x01\n"
+RECORD: struct.Struct = struct.Struct("<dBII")
+INBOUND: int = 0
+OUTBOUND: int = 1
+_DIRECTION_NAMES: tuple[str, str] = ("Received", "Sending")
+
+
+class CaptureRecord(NamedTuple):
+    """
+    A frame read back from a capture file.
+    """
+    time: float
+    direction: int
+    ident: int
+    data: bytes
+
+
+class _PacketText:
+    """
+    Formats a raw frame as text, but only when a log handler asks for it.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data: bytes) -> None:
+        self._data: bytes = data
+
+    def __str__(self) -> str:
+        try:
+            packet: Packet = Packet.FromString(self._data)
+        except Exception:  # pylint: disable=broad-except
+            return f"<{len(self._data)} undecodable bytes>"
+        return text_format.MessageToString(packet, as_one_line=True)
+
+
+class PacketCapture:
+    """
+    Writes raw frames to a binary capture file, rotating it once it reaches a maximum size in the
+    same way as `logging.handlers.RotatingFileHandler`: "packets.cap" becomes "packets.cap.1",
+    "packets.cap.1" becomes "packets.cap.2", and so on, up to the number of backups to keep.
+
+    Writes are buffered, so they cost no more than a memory copy until the buffer fills.
+
+    Args:
+        path (str): The path of the capture file.
+        max_bytes (int): How large the file can grow before it is rotated.
+        backup_count (int): How many rotated files to keep.
+    """
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, backup_count: int = 5) -> None:
+        self.path: str = path
+        self._max_bytes: int = max_bytes
+        self._backup_count: int = backup_count
+        self._file: BinaryIO = self._open()
+        self._size: int = len(CAPTURE_MAGIC)
+
+    def write(self, direction: int, ident: int, data: bytes) -> None:
+        """
+        Appends a frame to the capture.
+
+        Args:
+            direction (int): `INBOUND` or `OUTBOUND`.
+            ident (int): The identifier of the protocol the frame was received or sent by.
+            data (bytes): The raw frame.
+        """
+        record_size: int = RECORD.size + len(data)
+        if self._size + record_size > self._max_bytes and self._size > len(CAPTURE_MAGIC):
+            self._rotate()
+        self._file.write(RECORD.pack(time.time(), direction, ident, len(data)))
+        self._file.write(data)
+        self._size += record_size
+
+    def close(self) -> None:
+        """
+        Flushes and closes the capture file.
+        """
+        self._file.close()
+
+    def _open(self) -> BinaryIO:
+        file: BinaryIO = open(self.path, 'wb', buffering=64 * 1024)  # pylint: disable=consider-using-with
+        file.write(CAPTURE_MAGIC)
+        return file
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for i in range(self._backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self._backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = self._open()
+        self._size = len(CAPTURE_MAGIC)
+
+
+def capture_files(path: str) -> list[str]:
+    """
+    Finds a capture file and the files it has been rotated into.
+
+    Args:
+        path (str): The path the capture was written to.
+
+    Returns:
+        list[str]: The paths of the capture's files that exist, oldest first.
+    """
+    rotated: list[str] = []
+    i: int = 1
+    while os.path.exists(f"{path}.{i}"):
+        rotated.append(f"{path}.{i}")
+        i += 1
+    rotated.reverse()
+    if os.path.exists(path):
+        rotated.append(path)
+    return rotated
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """
+    Reads the frames in a capture file, in the order they were written. A record cut short by the 
+    server stopping mid-write ends the capture.
+
+    Args:
+        path (str): The path of a single capture file.
+
+    Raises:
+        ValueError: If the file is not a capture file.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a packet capture")
+        while True:
+            header: bytes = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, ident, length = RECORD.unpack(header)
+            data: bytes = file.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(timestamp, direction, ident, data)
+
+
+class PacketTracer:
+    """
+    Traces the frames protocols send and receive, to the trace log and to a capture file.
+
+    Call sites should check `active` before calling `record`, so a disabled tracer costs a single
+    attribute lookup per frame.
+
+    Attributes:
+        active (bool): Whether there is anywhere to record frames to.
+    """
+    def __init__(self) -> None:
+        self._logger: logging.Logger = logging.getLogger(__name__)
+        self._capture: Optional[PacketCapture] = None
+        self._sample_every: int = 1
+        self._num_seen: int = 0
+        self._logging: bool = False
+        self.active: bool = False
+
+    def configure(self, sample_rate: float = 1.0, capture: Optional[PacketCapture] = None) -> None:
+        """
+        Sets up the tracer. Whether text traces are logged is decided by the trace logger's level
+        at the time this is called.
+
+        Args:
+            sample_rate (float): The fraction of frames to log text traces for, from 0 to 1.
+            capture (Optional[PacketCapture]): Where to capture every frame to, if anywhere.
+        """
+        self._capture = capture
+        self._sample_every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self._logging = self._sample_every > 0 and self._logger.isEnabledFor(logging.DEBUG)
+        self.active = self._logging or capture is not None
+
+    def record(self, direction: int, ident: int, data: bytes) -> None:
+        """
+        Records a raw frame.
+
+        Args:
+            direction (int): `INBOUND` or `OUTBOUND`.
+            ident (int): The identifier of the protocol the frame was received or sent by.
+            data (bytes): The raw frame.
+        """
+        if self._capture is not None:
+            self._capture.write(direction, ident, data)
+
+        if self._logging:
+            self._num_seen += 1
+            if self._num_seen % self._sample_every == 0:
+                self._logger.debug("[#%04d] %s packet: %s", ident, _DIRECTION_NAMES[direction],
+                                   _PacketText(data))
+
+    def close(self) -> None:
+        """
+        Stops tracing, closing the capture file if there is one.
+        """
+        if self._capture is not None:
+            self._capture.close()
+        self.configure(sample_rate=0)
+
+
+TRACER: PacketTracer = PacketTracer()
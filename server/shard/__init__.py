@@ -0,0 +1,10 @@
+"""
+This package runs the server as several processes, so it can use more than one CPU core. A gateway 
+process accepts websocket connections and passes each one through to one of N worker processes, 
+each running its own `GameServer` with its own world. The workers talk to the gateway over Unix 
+sockets, and broadcasts, like chat, are relayed between them through the gateway.
+
+Start it with `python -m server --shards N`.
+"""
+from server.shard.relay import ShardRelay
+from server.shard.transport import FramedStream, StreamConnection
@@ -0,0 +1,309 @@
+"""
+This module contains the gateway of a sharded server. The gateway starts N worker processes (see 
+`server.shard.worker`), each running its own `GameServer`, and accepts every websocket connection 
+itself, passing each one through to the worker with the fewest clients. It never decodes a packet, 
+so it stays cheap however busy the workers are.
+
+On SIGTERM or SIGINT, the gateway stops accepting connections and has every worker drain its 
+clients, passing the workers' disconnect packets and close codes on until every worker has exited.
+
+The gateway also runs the bus the workers' relays connect to. Whatever one worker publishes, e.g. a 
+chat message, is passed on to every other worker. A worker whose bus connection falls too far behind 
+misses broadcasts rather than holding up the others. The bus also keeps track of which worker each
+logged in username is on, so the same user cannot be logged in on two shards at once.
+
+A worker that exits while the gateway is not draining is no longer sent clients, and is restarted
+after `WORKER_RESTART_DELAY` seconds. Its clients are disconnected and its usernames released.
+
+Example usage:
+    gateway = Gateway(4)
+    await serve_until_signalled(partial(gateway.serve, 'localhost', 8081), gateway.drain)
+"""
+import logging
+import os
+import sys
+import tempfile
+from functools import partial
+from typing import Optional
+import trio
+from trio_websocket import (ConnectionClosed, WebSocketConnection, WebSocketRequest,  # type: ignore
+                            serve_websocket)
+from server.database.engine import DATABASE_URL, init_engine
+from server.protocol.game_protocol import MAX_INBOUND_MESSAGE_SIZE
+from server.shard.transport import (CLAIM, CLAIMED, CLOSE, MESSAGE, RELEASE, FramedStream,
+                                    decode_close, encode_claimed, encode_close, open_unix_listener)
+from server.shutdown import serve_until_signalled
+
+# How long workers are given to save their players after draining, before they are killed
+WORKER_EXIT_GRACE: float = 5.0
+
+# How long to wait before restarting a worker that exited, so one that keeps crashing does not spin
+WORKER_RESTART_DELAY: float = 1.0
+
+
+class _Shard:
+    """
+    A worker process, as far as the gateway is concerned.
+    """
+    def __init__(self, index: int, socket_path: str) -> None:
+        self.index: int = index
+        self.socket_path: str = socket_path
+        self.clients: int = 0
+        self.process: Optional[trio.Process] = None
+        # Whether the worker is running and listening, so clients can be routed to it
+        self.ready: bool = False
+
+
+class Gateway:
+    """
+    Starts the workers, routes each client to one of them, and relays broadcasts between them.
+
+    Args:
+        num_shards (int): 
+            How many worker processes to start.
+        database_url (str): 
+            The URL of the database the workers share.
+        metrics_port (Optional[int]): 
+            If given, each worker serves its metrics on this port plus its index.
+        max_bus_backlog (int): 
+            How many broadcasts can be waiting to be sent to each worker before more are dropped.
+        startup_timeout (float): 
+            How many seconds to wait for the workers to start listening.
+
+    Attributes:
+        relayed (int): The number of broadcasts passed on to other workers.
+        dropped (int): The number of broadcasts dropped because a worker fell behind.
+    """
+    def __init__(self, num_shards: int, database_url: str = DATABASE_URL,
+                 metrics_port: Optional[int] = None, max_bus_backlog: int = 4096,
+                 startup_timeout: float = 30) -> None:
+        if num_shards < 1:
+            raise ValueError("A sharded server needs at least one shard")
+        self._num_shards: int = num_shards
+        self._database_url: str = database_url
+        self._metrics_port: Optional[int] = metrics_port
+        self._max_bus_backlog: int = max_bus_backlog
+        self._startup_timeout: float = startup_timeout
+        self._shards: list[_Shard] = []
+        self._bus_peers: list[trio.MemorySendChannel] = []
+        self._claims: dict[str, trio.MemorySendChannel] = {}
+        self._accepting: trio.CancelScope = trio.CancelScope()
+        self._draining: bool = False
+        self.relayed: int = 0
+        self.dropped: int = 0
+
+    async def serve(self, host: str = 'localhost', port: int = 8081,
+                    task_status=trio.TASK_STATUS_IGNORED) -> None:
+        """
+        Starts the workers and serves websocket connections until cancelled, at which point any 
+        workers still running are sent SIGTERM, so they save their players before exiting.
+
+        Args:
+            host (str): The host to listen on.
+            port (int): The port to listen on.
+        """
+        # Create the tables once, rather than having every worker race to do it
+        init_engine(self._database_url).dispose()
+
+        with tempfile.TemporaryDirectory(prefix="game-shards-") as workdir:
+            bus_path: str = os.path.join(workdir, "bus.sock")
+            self._shards = [_Shard(i, os.path.join(workdir, f"shard-{i}.sock"))
+                            for i in range(self._num_shards)]
+            async with trio.open_nursery() as nursery:
+                await nursery.start(self._serve_bus, bus_path)
+                for shard in self._shards:
+                    nursery.start_soon(self._run_worker, shard, bus_path)
+                with trio.fail_after(self._startup_timeout):
+                    while not all(shard.ready for shard in self._shards):
+                        await trio.sleep(0.05)
+
+                # Connections are handled in this nursery, so they outlive the listener when
+                # draining
+                self._accepting = trio.CancelScope()
+                await nursery.start(self._listen, host, port, nursery)
+                logging.info("Gateway serving on %s:%s with %s shards", host, port,
+                             self._num_shards)
+                task_status.started()
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Stops accepting connections and sends every worker SIGTERM, so they drain their clients, 
+        then waits for the workers to exit.
+
+        Args:
+            timeout (float): How many seconds the workers have to drain their clients.
+        """
+        self._draining = True
+        self._accepting.cancel()
+        for shard in self._shards:
+            if shard.process is not None and shard.process.returncode is None:
+                shard.process.terminate()
+        with trio.move_on_after(timeout + WORKER_EXIT_GRACE):
+            for shard in self._shards:
+                if shard.process is not None:
+                    await shard.process.wait()
+
+    async def _listen(self, host: str, port: int, handler_nursery: trio.Nursery,
+                      task_status=trio.TASK_STATUS_IGNORED) -> None:
+        with self._accepting:
+            await serve_websocket(self.handle_connection, host, port, None,
+                                  handler_nursery=handler_nursery,
+                                  max_message_size=MAX_INBOUND_MESSAGE_SIZE,
+                                  task_status=task_status)
+
+    async def handle_connection(self, request: WebSocketRequest) -> None:
+        """
+        Accepts a websocket connection and passes it through to the least busy worker until either 
+        side closes it. The connection is closed straight away if no worker is running.
+        """
+        connection: WebSocketConnection = await request.accept()
+        ready: list[_Shard] = [shard for shard in self._shards if shard.ready]
+        if not ready:
+            logging.error("No shard is running to take a new client")
+            await connection.aclose(1011, "Server unavailable")
+            return
+        shard: _Shard = min(ready, key=lambda shard: shard.clients)
+        shard.clients += 1
+        try:
+            try:
+                stream: trio.SocketStream = await trio.open_unix_socket(shard.socket_path)
+            except OSError as exc:
+                logging.error("Could not reach shard %s: %r", shard.index, exc)
+                await connection.aclose(1011, "Server unavailable")
+                return
+            framed: FramedStream = FramedStream(stream)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self._client_to_shard, connection, framed, nursery.cancel_scope)
+                await self._shard_to_client(framed, connection)
+                nursery.cancel_scope.cancel()
+            await framed.aclose()
+        finally:
+            shard.clients -= 1
+
+    async def _client_to_shard(self, connection: WebSocketConnection, framed: FramedStream,
+                               cancel_scope: trio.CancelScope) -> None:
+        try:
+            while True:
+                message: bytes | str = await connection.get_message()
+                # The protocol only speaks binary
+                if isinstance(message, bytes):
+                    await framed.send(MESSAGE, message)
+        except ConnectionClosed as exc:
+            reason = exc.reason
+            try:
+                await framed.send(CLOSE, encode_close(reason.code, reason.reason))
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                cancel_scope.cancel()
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            await connection.aclose(1011, "Server unavailable")
+            cancel_scope.cancel()
+
+    async def _shard_to_client(self, framed: FramedStream, connection: WebSocketConnection) -> None:
+        while True:
+            frame: Optional[tuple[int, bytes]] = await framed.receive()
+            if frame is None:
+                await connection.aclose(1011, "Server unavailable")
+                return
+            kind, payload = frame
+            if kind == CLOSE:
+                reason = decode_close(payload)
+                await connection.aclose(reason.code, reason.reason)
+                return
+            try:
+                await connection.send_message(payload)
+            except ConnectionClosed:
+                # The client's side sends the close on to the worker
+                pass
+
+    async def _run_worker(self, shard: _Shard, bus_path: str) -> None:
+        command: list[str] = [sys.executable, "-m", "server.shard.worker", "--shard",
+                              str(shard.index), "--socket", shard.socket_path, "--bus", bus_path,
+                              "--database-url", self._database_url]
+        if self._metrics_port is not None:
+            command += ["--metrics-port", str(self._metrics_port + shard.index)]
+        # Workers get their own session, so a Ctrl+C meant for the gateway does not reach them too.
+        # The gateway tells them when to stop.
+        run = partial(trio.run_process, command, stdin=None, check=False, start_new_session=True)
+        while not self._draining:
+            # A worker that died leaves its socket behind, which would pass for it listening
+            if os.path.exists(shard.socket_path):
+                os.unlink(shard.socket_path)
+            async with trio.open_nursery() as nursery:
+                process: trio.Process = await nursery.start(run)
+                shard.process = process
+                while process.returncode is None and not os.path.exists(shard.socket_path):
+                    await trio.sleep(0.05)
+                shard.ready = process.returncode is None
+            shard.ready = False
+            if self._draining:
+                logging.info("Shard %s stopped", shard.index)
+                return
+            logging.error("Shard %s exited with code %s, restarting it in %s seconds",
+                          shard.index, process.returncode, WORKER_RESTART_DELAY)
+            await trio.sleep(WORKER_RESTART_DELAY)
+
+    async def _serve_bus(self, path: str, task_status=trio.TASK_STATUS_IGNORED) -> None:
+        listener: trio.SocketListener = await open_unix_listener(path)
+        await trio.serve_listeners(self._handle_bus_peer, [listener], task_status=task_status)
+
+    async def _handle_bus_peer(self, stream: trio.SocketStream) -> None:
+        framed: FramedStream = FramedStream(stream)
+        send_channel, receive_channel = trio.open_memory_channel(self._max_bus_backlog)
+        self._bus_peers.append(send_channel)
+        try:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self._forward_to_peer, framed, receive_channel)
+                while (frame := await framed.receive()) is not None:
+                    kind, payload = frame
+                    if kind == MESSAGE:
+                        self._relay(send_channel, payload)
+                    elif kind == CLAIM:
+                        username: str = payload.decode(errors='replace')
+                        granted: bool = self._claim(send_channel, username)
+                        await send_channel.send((CLAIMED, encode_claimed(username, granted)))
+                    elif kind == RELEASE:
+                        username: str = payload.decode(errors='replace')
+                        if self._claims.get(username) is send_channel:
+                            del self._claims[username]
+                nursery.cancel_scope.cancel()
+        finally:
+            self._bus_peers.remove(send_channel)
+            # The worker has gone, and its players with it
+            self._claims = {username: peer for username, peer in self._claims.items()
+                            if peer is not send_channel}
+            await framed.aclose()
+
+    def _claim(self, peer: trio.MemorySendChannel, username: str) -> bool:
+        return self._claims.setdefault(username, peer) is peer
+
+    def _relay(self, sender: trio.MemorySendChannel, payload: bytes) -> None:
+        for peer in self._bus_peers:
+            if peer is sender:
+                continue
+            try:
+                peer.send_nowait((MESSAGE, payload))
+                self.relayed += 1
+            except trio.WouldBlock:
+                self.dropped += 1
+
+    @staticmethod
+    async def _forward_to_peer(framed: FramedStream,
+                               receive_channel: trio.MemoryReceiveChannel) -> None:
+        async for kind, payload in receive_channel:
+            await framed.send(kind, payload)
+
+
+async def main(num_shards: int, host: str = 'localhost', port: int = 8081,
+               metrics_port: Optional[int] = None) -> None:
+    """
+    Serves a sharded server until SIGTERM or SIGINT, then drains it.
+
+    Args:
+        num_shards (int): How many worker processes to start.
+        host (str): The host to listen on.
+        port (int): The port to listen on.
+        metrics_port (Optional[int]): If given, each worker serves its metrics on this port plus 
+            its index.
+    """
+    gateway: Gateway = Gateway(num_shards, metrics_port=metrics_port)
+    await serve_until_signalled(partial(gateway.serve, host, port), gateway.drain)
@@ -0,0 +1,135 @@
+"""
+This module contains the shard relay, which passes broadcasts between a worker and the other 
+workers, by way of the gateway, and claims usernames from the gateway so the same user cannot be
+logged in on two shards at once.
+"""
+from __future__ import annotations
+import logging
+from collections import deque
+from typing import Optional, TYPE_CHECKING
+import trio
+from google.protobuf.message import DecodeError
+from server.net import Frame
+from server.shard.transport import CLAIM, CLAIMED, MESSAGE, RELEASE, FramedStream, decode_claimed
+
+if TYPE_CHECKING:
+    from server.protocol.registry import ConnectionRegistry
+
+# How many seconds to wait for the gateway to answer a claim before turning the player away
+CLAIM_TIMEOUT: float = 5.0
+
+
+class ShardRelay:
+    """
+    Publishes this shard's broadcasts to the other shards, and delivers theirs to every protocol 
+    connected to this shard.
+
+    Publishing never blocks, so it is safe to do from anywhere. If the gateway falls too far behind, 
+    the newest broadcasts are dropped rather than queued without limit. Claims and releases are
+    never dropped.
+
+    Args:
+        stream (FramedStream): The stream to the gateway's bus.
+        max_backlog (int): How many broadcasts can be waiting to be published.
+
+    Attributes:
+        published (int): The number of broadcasts published.
+        delivered (int): The number of broadcasts received from other shards.
+        dropped (int): The number of broadcasts dropped because the backlog was full.
+    """
+    def __init__(self, stream: FramedStream, max_backlog: int = 4096) -> None:
+        self._stream: FramedStream = stream
+        self._max_backlog: int = max_backlog
+        self._outgoing: deque[tuple[int, bytes]] = deque()
+        self._claims: dict[str, trio.MemorySendChannel] = {}
+        self._wakeup: trio.Event = trio.Event()
+        self.published: int = 0
+        self.delivered: int = 0
+        self.dropped: int = 0
+
+    def publish(self, frame: Frame) -> None:
+        """
+        Queues a broadcast to be passed on to the other shards.
+        """
+        if len(self._outgoing) >= self._max_backlog:
+            self.dropped += 1
+            return
+        self._outgoing.append((MESSAGE, frame.data))
+        self._wakeup.set()
+
+    async def claim(self, username: str) -> bool:
+        """
+        Asks the gateway for a username, which is refused while another shard holds it.
+
+        Returns:
+            bool: Whether the username is now held by this shard. False if the gateway did not
+            answer in time.
+        """
+        send_channel, receive_channel = trio.open_memory_channel(1)
+        self._claims[username] = send_channel
+        self._outgoing.append((CLAIM, username.encode()))
+        self._wakeup.set()
+        granted: Optional[bool] = None
+        try:
+            with trio.move_on_after(CLAIM_TIMEOUT):
+                granted = await receive_channel.receive()
+        finally:
+            del self._claims[username]
+            # Without an answer, e.g. because this timed out or was cancelled, the gateway may
+            # still grant the claim, so give the name back straight away
+            if granted is None:
+                self.release(username)
+        if granted is None:
+            logging.warning("The gateway did not answer a claim for %s in time", username)
+            return False
+        return granted
+
+    def release(self, username: str) -> None:
+        """
+        Gives a username claimed with `claim` back to the gateway, e.g. when the player leaves.
+        """
+        self._outgoing.append((RELEASE, username.encode()))
+        self._wakeup.set()
+
+    async def run(self, registry: ConnectionRegistry) -> None:
+        """
+        Publishes and delivers broadcasts until cancelled, or until the gateway goes away.
+
+        Args:
+            registry (ConnectionRegistry): The protocols to deliver other shards' broadcasts to.
+        """
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self._publish_loop)
+            await self._deliver_loop(registry)
+            nursery.cancel_scope.cancel()
+
+    async def _publish_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup = trio.Event()
+            while self._outgoing:
+                kind, payload = self._outgoing.popleft()
+                await self._stream.send(kind, payload)
+                if kind == MESSAGE:
+                    self.published += 1
+
+    async def _deliver_loop(self, registry: ConnectionRegistry) -> None:
+        while True:
+            frame_data: Optional[tuple[int, bytes]] = await self._stream.receive()
+            if frame_data is None:
+                logging.warning("Lost connection to the gateway's bus")
+                return
+            kind, payload = frame_data
+            if kind == CLAIMED:
+                username, granted = decode_claimed(payload)
+                if username in self._claims:
+                    self._claims[username].send_nowait(granted)
+                continue
+            try:
+                frame: Frame = Frame.decode(payload)
+            except DecodeError:
+                logging.warning("Dropped undecodable broadcast from another shard")
+                continue
+            self.delivered += 1
+            for protocol in registry:
+                protocol.queue_outbound_packet(protocol, frame)
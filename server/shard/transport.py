@@ -0,0 +1,196 @@
+"""
+This module contains the framing used between the gateway and the workers. Every frame is a 
+`HEADER` holding the frame's kind and length, followed by that many bytes. A `MESSAGE` frame 
+carries a packet exactly as the client sent it or will receive it. A `CLOSE` frame asks the other 
+side to close the client's websocket with a status code and reason.
+
+On the bus between the gateway and the workers' relays, a `CLAIM` frame asks the gateway for a
+username, so the same user cannot be logged in on two shards at once, and is answered with a
+`CLAIMED` frame saying whether the name was free. A `RELEASE` frame gives a name back.
+"""
+import os
+import socket
+import struct
+from typing import Optional
+import trio
+from trio_websocket import CloseReason, ConnectionClosed
+
+HEADER: struct.Struct = struct.Struct(">BI")
+MESSAGE: int = 0
+CLOSE: int = 1
+CLAIM: int = 2
+RELEASE: int = 3
+CLAIMED: int = 4
+_CLOSE_CODE: struct.Struct = struct.Struct(">H")
+
+
+async def open_unix_listener(path: str, backlog: int = 128) -> trio.SocketListener:
+    """
+    Listens on a Unix socket, replacing any socket file left behind at the path.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = trio.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        await sock.bind(path)
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return trio.SocketListener(sock)
+
+
+class FramedStream:
+    """
+    Sends and receives frames over a byte stream, e.g. a Unix socket.
+
+    Args:
+        stream (trio.abc.Stream): The stream to frame.
+        max_frame_size (int): The largest frame that will be accepted from the other side.
+    """
+    def __init__(self, stream: trio.abc.Stream, max_frame_size: int = 16 * 1024 * 1024) -> None:
+        self._stream: trio.abc.Stream = stream
+        self._max_frame_size: int = max_frame_size
+        self._buffer: bytearray = bytearray()
+        self._send_lock: trio.Lock = trio.Lock()
+
+    async def send(self, kind: int, payload: bytes) -> None:
+        """
+        Sends a frame.
+
+        Raises:
+            trio.BrokenResourceError: If the stream has broken.
+            trio.ClosedResourceError: If the stream has been closed.
+        """
+        async with self._send_lock:
+            await self._stream.send_all(HEADER.pack(kind, len(payload)) + payload)
+
+    async def receive(self) -> Optional[tuple[int, bytes]]:
+        """
+        Receives the next frame.
+
+        Returns:
+            Optional[tuple[int, bytes]]: The frame's kind and payload, or None if the other side 
+            has closed the stream.
+
+        Raises:
+            ValueError: If the other side sends a frame that is too large.
+        """
+        while True:
+            if len(self._buffer) >= HEADER.size:
+                kind, length = HEADER.unpack_from(self._buffer)
+                if length > self._max_frame_size:
+                    raise ValueError(f"Frame of {length} bytes is too large")
+                end: int = HEADER.size + length
+                if len(self._buffer) >= end:
+                    payload: bytes = bytes(self._buffer[HEADER.size:end])
+                    del self._buffer[:end]
+                    return kind, payload
+
+            try:
+                data: bytes = await self._stream.receive_some(65536)
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                return None
+            if not data:
+                return None
+            self._buffer += data
+
+    async def aclose(self) -> None:
+        """
+        Closes the stream.
+        """
+        await self._stream.aclose()
+
+
+def encode_close(code: int, reason: Optional[str]) -> bytes:
+    """
+    Encodes the payload of a `CLOSE` frame.
+    """
+    return _CLOSE_CODE.pack(code) + (reason or "").encode()
+
+
+def decode_close(payload: bytes) -> CloseReason:
+    """
+    Decodes the payload of a `CLOSE` frame.
+    """
+    code, = _CLOSE_CODE.unpack_from(payload)
+    return CloseReason(code, payload[_CLOSE_CODE.size:].decode(errors='replace') or None)
+
+
+def encode_claimed(username: str, granted: bool) -> bytes:
+    """
+    Encodes the payload of a `CLAIMED` frame.
+    """
+    return bytes([granted]) + username.encode()
+
+
+def decode_claimed(payload: bytes) -> tuple[str, bool]:
+    """
+    Decodes the payload of a `CLAIMED` frame.
+
+    Returns:
+        tuple[str, bool]: The username that was claimed, and whether the claim was granted.
+    """
+    return payload[1:].decode(errors='replace'), bool(payload[0])
+
+
+class StreamConnection:
+    """
+    Stands in for a `WebSocketConnection` on a worker, so a `GameProtocol` can talk to a client 
+    whose websocket is held by the gateway.
+
+    Args:
+        stream (FramedStream): The stream to the gateway for this one client.
+
+    Attributes:
+        closed (Optional[CloseReason]): Why the connection was closed, or None if it is still open.
+    """
+    def __init__(self, stream: FramedStream) -> None:
+        self._stream: FramedStream = stream
+        self.closed: Optional[CloseReason] = None
+
+    async def get_message(self) -> bytes:
+        """
+        Returns the next message from the client.
+
+        Raises:
+            ConnectionClosed: If the connection has been closed.
+        """
+        while self.closed is None:
+            frame: Optional[tuple[int, bytes]] = await self._stream.receive()
+            if frame is None:
+                self.closed = CloseReason(1001, "Gateway went away")
+            elif frame[0] == CLOSE:
+                self.closed = decode_close(frame[1])
+            else:
+                return frame[1]
+        raise ConnectionClosed(self.closed)
+
+    async def send_message(self, message: bytes) -> None:
+        """
+        Sends a message to the client.
+
+        Raises:
+            ConnectionClosed: If the connection has been closed.
+        """
+        if self.closed is not None:
+            raise ConnectionClosed(self.closed)
+        try:
+            await self._stream.send(MESSAGE, message)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            self.closed = CloseReason(1001, "Gateway went away")
+            raise ConnectionClosed(self.closed) from None
+
+    async def aclose(self, code: int = 1000, reason: Optional[str] = None) -> None:
+        """
+        Closes the connection, asking the gateway to close the client's websocket with the given 
+        code and reason.
+        """
+        if self.closed is not None:
+            return
+        self.closed = CloseReason(code, reason)
+        try:
+            await self._stream.send(CLOSE, encode_close(code, reason))
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+        await self._stream.aclose()
@@ -0,0 +1,62 @@
+"""
+Runs one shard of a sharded server: a `GameServer` with its own world and tick loop, taking the 
+clients the gateway routes to it over a Unix socket. Workers are started by the gateway, see 
+`server.shard.gateway`, and on SIGTERM or SIGINT, drain their clients and save every player before 
+exiting.
+
+Usage:
+    python -m server.shard.worker --shard 0 --socket shard-0.sock --bus bus.sock
+"""
+import argparse
+import logging
+from functools import partial
+from typing import Optional
+import trio
+from server.__main__ import GameServer
+from server.database.engine import DATABASE_URL
+from server.protocol import GameProtocol
+from server.protocol.game_protocol import MAX_INBOUND_MESSAGE_SIZE
+from server.shard.relay import ShardRelay
+from server.shard.transport import FramedStream, HEADER, StreamConnection, open_unix_listener
+from server.shutdown import serve_until_signalled
+
+
+async def run_worker(socket_path: str, bus_path: str, database_url: str = DATABASE_URL,
+                     metrics_port: Optional[int] = None, tick_rate: float = 1/20) -> None:
+    """
+    Connects to the gateway's bus and serves the clients routed to this shard, until cancelled or 
+    sent SIGTERM or SIGINT.
+
+    Args:
+        socket_path (str): The Unix socket to take clients on.
+        bus_path (str): The Unix socket of the gateway's bus.
+        database_url (str): The URL of the database, which every shard shares.
+        metrics_port (Optional[int]): If given, also serve this shard's metrics on this port.
+        tick_rate (float): The number of seconds between each tick.
+    """
+    bus: FramedStream = FramedStream(await trio.open_unix_socket(bus_path))
+    server: GameServer = GameServer(tick_rate, database_url=database_url, relay=ShardRelay(bus))
+
+    async def handle_client(stream: trio.SocketStream) -> None:
+        framed: FramedStream = FramedStream(stream, HEADER.size + MAX_INBOUND_MESSAGE_SIZE)
+        protocol: GameProtocol = server.create_protocol(StreamConnection(framed))
+        await protocol.start()
+
+    listeners: list[trio.SocketListener] = [await open_unix_listener(socket_path)]
+    listen = partial(trio.serve_listeners, handle_client, listeners)
+    await serve_until_signalled(partial(server.serve_with, listen, metrics_port), server.drain)
+    await bus.aclose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n", maxsplit=1)[0])
+    parser.add_argument('--shard', type=int, required=True, help="This shard's index, for logs")
+    parser.add_argument('--socket', required=True, help="The Unix socket to take clients on")
+    parser.add_argument('--bus', required=True, help="The Unix socket of the gateway's bus")
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--metrics-port', type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format=f"[shard {args.shard}] %(levelname)s:%(message)s")
+    trio.run(run_worker, args.socket, args.bus, args.database_url, args.metrics_port)
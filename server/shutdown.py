@@ -0,0 +1,51 @@
+"""
+This module runs a server until it is asked to stop with SIGTERM or SIGINT (Ctrl+C), and then stops
+it gracefully: the server is drained first, so its clients are told to reconnect and what they were
+waiting to be sent is sent, and only then cancelled. A second signal stops it straight away.
+
+Example usage:
+    server = GameServer(1/20)
+    await serve_until_signalled(partial(server.serve, 'localhost', 8081), server.drain)
+"""
+import logging
+import signal
+from typing import Awaitable, Callable
+import trio
+
+# How long to wait for clients to be drained before stopping anyway
+DRAIN_TIMEOUT: float = 10.0
+
+
+async def serve_until_signalled(serve: Callable[..., Awaitable[None]],
+                                drain: Callable[[float], Awaitable[None]],
+                                drain_timeout: float = DRAIN_TIMEOUT) -> None:
+    """
+    Runs a server until SIGTERM or SIGINT, then drains and stops it.
+
+    Args:
+        serve (Callable[..., Awaitable[None]]):
+            Started with `nursery.start`, and cancelled once the server has been drained.
+        drain (Callable[[float], Awaitable[None]]):
+            Called with `drain_timeout` to drain the server. It should return once the server has
+            been drained, or the timeout has passed.
+        drain_timeout (float):
+            How many seconds draining may take.
+    """
+    with trio.open_signal_receiver(signal.SIGTERM, signal.SIGINT) as signals:
+        async with trio.open_nursery() as nursery:
+            await nursery.start(serve)
+            async for signum in signals:
+                logging.info("Received signal %s, draining for up to %ss", signum, drain_timeout)
+                break
+
+            with trio.CancelScope() as drain_scope:
+                nursery.start_soon(_cancel_on_signal, signals, drain_scope)
+                await drain(drain_timeout)
+            nursery.cancel_scope.cancel()
+
+
+async def _cancel_on_signal(signals, cancel_scope: trio.CancelScope) -> None:
+    async for signum in signals:
+        logging.warning("Received signal %s while draining, stopping now", signum)
+        cancel_scope.cancel()
+        return
@@ -0,0 +1,8 @@
+"""
+This package contains the authoritative game world simulation. The server owns every player's 
+position and moves them each tick according to the direction their client last asked for, saving 
+where they are every so often.
+"""
+from server.world.interest import SpatialHash
+from server.world.persistence import PlayerStore
+from server.world.simulation import World
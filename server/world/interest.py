@@ -0,0 +1,115 @@
+"""
+This module contains the spatial hash used for area-of-interest management. The world is divided
+into a uniform grid of square cells, and each entity is filed under the cell it is in. An entity can
+see every other entity within `view_range` cells of its own, so finding who is near an entity only
+means looking in a handful of cells instead of scanning the whole world.
+
+The hash is kept as two NumPy arrays rather than a dictionary of sets: the key of each filed
+entity's cell, sorted, and the entities' slots in the same order. Every column of cells an entity
+can see is then one contiguous run of the arrays, found with a binary search, so the cells near any
+number of entities can be searched at once. Filing is a sort, so it is done in bulk rather than one
+entity at a time.
+
+Example usage:
+    interest = SpatialHash(cell_size=500.0)
+    interest.file(slots, *interest.cells_of(xs, ys))
+    observers, seen = interest.gather(cell_x, cell_y)
+"""
+import numpy as np
+
+Cell = tuple[int, int]
+
+# Added to a cell's row so every row packs into the low 32 bits of its key as a non-negative number
+_ROW_OFFSET: int = 1 << 31
+
+
+def cell_keys(cell_x: np.ndarray, cell_y: np.ndarray) -> np.ndarray:
+    """
+    Packs cells into one integer key each. Keys sort by column, then by row, so the cells of a
+    column between two rows have a contiguous range of keys.
+    """
+    return (np.asarray(cell_x, dtype=np.int64) << 32) + (np.asarray(cell_y, dtype=np.int64)
+                                                         + _ROW_OFFSET)
+
+
+class SpatialHash:
+    """
+    A uniform grid of cells, holding the slots of the entities filed in each, sorted by cell.
+
+    Args:
+        cell_size (float):
+            The width and height of each cell, in world units.
+        view_range (int):
+            How many cells away from its own cell an entity can see, in each direction.
+
+    Attributes:
+        keys (np.ndarray): The cell key of every filed entity, in ascending order.
+        slots (np.ndarray): The slot of every filed entity, in the same order as `keys`.
+    """
+    def __init__(self, cell_size: float, view_range: int = 1) -> None:
+        self.cell_size: float = cell_size
+        self.view_range: int = view_range
+        self.keys: np.ndarray = np.empty(0, dtype=np.int64)
+        self.slots: np.ndarray = np.empty(0, dtype=np.int64)
+
+    def cell_of(self, x: float, y: float) -> Cell:
+        """
+        Returns the cell a point lies in.
+        """
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def cells_of(self, xs: np.ndarray, ys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the columns and rows of the cells many points lie in.
+        """
+        return (np.floor_divide(xs, self.cell_size).astype(np.int64),
+                np.floor_divide(ys, self.cell_size).astype(np.int64))
+
+    def file(self, slots: np.ndarray, cell_x: np.ndarray, cell_y: np.ndarray) -> None:
+        """
+        Files every given slot under its cell, replacing whatever was filed before. The arrays are
+        replaced rather than changed in place, so a `copy` taken earlier is left as it was.
+        """
+        keys: np.ndarray = cell_keys(cell_x, cell_y)
+        order: np.ndarray = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.slots = np.asarray(slots, dtype=np.int64)[order]
+
+    def copy(self) -> 'SpatialHash':
+        """
+        Returns a copy of the hash as it is now, which later filing does not affect. The arrays are
+        shared, not copied.
+        """
+        other: SpatialHash = SpatialHash(self.cell_size, self.view_range)
+        other.keys, other.slots = self.keys, self.slots
+        return other
+
+    def gather(self, cell_x: np.ndarray, cell_y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds every slot visible from each of many cells.
+
+        Args:
+            cell_x, cell_y (np.ndarray): The columns and rows of the cells to look from.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]:
+                For every slot found, the index of the cell it was found from, and the slot itself.
+                The slots found from each cell come together, in the order the cells were given.
+        """
+        r: int = self.view_range
+        columns: np.ndarray = (np.asarray(cell_x, dtype=np.int64)[:, None]
+                               + np.arange(-r, r + 1)).ravel()
+        rows: np.ndarray = np.repeat(np.asarray(cell_y, dtype=np.int64), 2 * r + 1)
+        return self._collect(columns, rows - r, rows + r, 2 * r + 1)
+
+    def _collect(self, columns: np.ndarray, first_rows: np.ndarray, last_rows: np.ndarray,
+                 per_query: int) -> tuple[np.ndarray, np.ndarray]:
+        # Each column's cells between its two rows are one run of the sorted keys
+        starts: np.ndarray = np.searchsorted(self.keys, cell_keys(columns, first_rows), 'left')
+        stops: np.ndarray = np.searchsorted(self.keys, cell_keys(columns, last_rows), 'right')
+        counts: np.ndarray = stops - starts
+        total: int = int(counts.sum())
+        queries: np.ndarray = np.repeat(np.arange(len(columns)) // per_query, counts)
+        run_starts: np.ndarray = np.cumsum(counts) - counts
+        positions: np.ndarray = np.arange(total) + np.repeat(starts - run_starts, counts)
+        return queries, self.slots[positions]
@@ -0,0 +1,216 @@
+"""
+This module contains the player store, which saves the state of players in the world to the
+database without the tick loop ever waiting on it.
+
+Each tick, the slots the world reports as changed are marked dirty, which is a single vectorized
+assignment. Every few ticks, the dirty players' rows are copied out of the world's arrays and handed
+to a background task, which saves them all in one transaction through the write-behind queue. If
+saving falls behind, rows waiting to be saved are simply overwritten by newer ones, so the backlog
+can never grow beyond one row per player.
+
+Example usage:
+    store = PlayerStore(session_factory, auth.database, auth.writes)
+    nursery.start_soon(store.run)
+    saved = await store.load(user.id)
+    world.spawn(slot, entity_id, owner, saved.x, saved.y)
+    store.track(slot, user.id)
+    ...
+    store.mark_dirty(world.step(dt))
+    store.tick(world)
+"""
+from __future__ import annotations
+import logging
+import time
+from typing import Optional, TYPE_CHECKING
+import numpy as np
+import trio
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm import Session
+from server.database import SessionMaker
+from server.database.writer import WriteBehindQueue
+from server.models import PlayerState
+
+if TYPE_CHECKING:
+    from server.auth import WorkLane
+    from server.world.simulation import World
+
+# A saved position, keyed by user ID
+Row = tuple[float, float]
+
+
+class PlayerStore:
+    """
+    Loads players' saved state when they log in, and saves it while they play and when they leave.
+
+    Args:
+        session_factory (SessionMaker):
+            The factory used to create database sessions.
+        lane (WorkLane):
+            The lane loads run on.
+        writes (WriteBehindQueue):
+            The queue saves are written through.
+        flush_interval (int):
+            How many ticks to wait between each save of the dirty players.
+
+    Attributes:
+        saves (int): The number of rows saved.
+        flushes (int): The number of batches saved.
+    """
+    def __init__(self, session_factory: SessionMaker, lane: WorkLane, writes: WriteBehindQueue,
+                 flush_interval: int = 100) -> None:
+        self._session_factory: SessionMaker = session_factory
+        self._lane: WorkLane = lane
+        self._writes: WriteBehindQueue = writes
+        self._flush_interval: int = flush_interval
+        self._num_ticks: int = 0
+        self._user_ids: np.ndarray = np.full(0, -1, dtype=np.int64)
+        self._dirty: np.ndarray = np.zeros(0, dtype=np.bool_)
+        self._pending: dict[int, Row] = {}
+        self._saving: dict[int, Row] = {}
+        self._wakeup: trio.Event = trio.Event()
+        self.saves: int = 0
+        self.flushes: int = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of rows waiting to be saved.
+        """
+        return len(self._pending)
+
+    async def load(self, user_id: int) -> Optional[PlayerState]:
+        """
+        Loads a user's saved player state. If the user has a save that has not been written yet, 
+        e.g. because they have just logged out and back in again, that is returned instead.
+
+        Returns:
+            Optional[PlayerState]: The saved state, or None if the user has never been saved.
+
+        Raises:
+            SQLAlchemyError: If the query fails.
+        """
+        row: Optional[Row] = self._pending.get(user_id) or self._saving.get(user_id)
+        if row is not None:
+            return PlayerState(user_id=user_id, x=row[0], y=row[1], saved_at=time.time())
+        return await self._lane.run(self._load, user_id)
+
+    def track(self, slot: int, user_id: int) -> None:
+        """
+        Starts saving the player in a world slot.
+        """
+        self._ensure_capacity(slot + 1)
+        self._user_ids[slot] = user_id
+        self._dirty[slot] = False
+
+    def untrack(self, slot: int, world: World) -> None:
+        """
+        Stops saving the player in a world slot, queueing one last save of where they are now. Call
+        this before the player is despawned. Does nothing if the slot is not being saved.
+        """
+        if slot >= len(self._user_ids) or self._user_ids[slot] < 0:
+            return
+        user_id: int = int(self._user_ids[slot])
+        self._pending[user_id] = (float(world.x[slot]), float(world.y[slot]))
+        self._user_ids[slot] = -1
+        self._dirty[slot] = False
+        self._wakeup.set()
+
+    def mark_dirty(self, slots: np.ndarray) -> None:
+        """
+        Marks the players in some world slots as needing to be saved.
+        """
+        if len(slots):
+            self._ensure_capacity(int(slots.max()) + 1)
+            self._dirty[slots] = True
+
+    def tick(self, world: World) -> None:
+        """
+        Counts a tick, and every `flush_interval` ticks, hands the dirty players' rows to the
+        background task to save.
+        """
+        self._num_ticks += 1
+        if self._num_ticks % self._flush_interval == 0:
+            self._collect(world, self._dirty)
+
+    async def run(self) -> None:
+        """
+        Saves the rows handed over by `tick` and `untrack`, until cancelled.
+        """
+        while True:
+            await self._wakeup.wait()
+            self._wakeup = trio.Event()
+            await self._save_pending()
+
+    async def flush(self, world: World) -> None:
+        """
+        Saves every tracked player straight away, e.g. before shutting down.
+        """
+        self._collect(world, self._user_ids >= 0)
+        await self._save_pending()
+
+    def _collect(self, world: World, mask: np.ndarray) -> None:
+        slots: np.ndarray = np.flatnonzero(mask & (self._user_ids >= 0))
+        self._dirty[:] = False
+        if len(slots) == 0:
+            return
+        rows = zip(self._user_ids[slots].tolist(), world.x[slots].tolist(), world.y[slots].tolist())
+        for user_id, x, y in rows:
+            self._pending[user_id] = (x, y)
+        self._wakeup.set()
+
+    async def _save_pending(self) -> None:
+        if not self._pending:
+            return
+        rows: dict[int, Row] = self._pending
+        self._pending = {}
+        self._saving = rows
+        try:
+            await self._writes.write(lambda session: _save(session, rows))
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.error("Failed to save %s players: %r", len(rows), exc)
+            self._restore(rows)
+            return
+        except BaseException:
+            # Cancelled, e.g. when the server stops, so the rows are left for the final flush
+            self._restore(rows)
+            raise
+        finally:
+            self._saving = {}
+        self.saves += len(rows)
+        self.flushes += 1
+
+    def _restore(self, rows: dict[int, Row]) -> None:
+        # Rows that failed to save are tried again next time, unless there is something newer to
+        # save by then
+        for user_id, row in rows.items():
+            self._pending.setdefault(user_id, row)
+
+    def _ensure_capacity(self, size: int) -> None:
+        if size <= len(self._user_ids):
+            return
+        capacity: int = max(size, 2 * len(self._user_ids), 64)
+        user_ids: np.ndarray = np.full(capacity, -1, dtype=np.int64)
+        user_ids[:len(self._user_ids)] = self._user_ids
+        dirty: np.ndarray = np.zeros(capacity, dtype=np.bool_)
+        dirty[:len(self._dirty)] = self._dirty
+        self._user_ids, self._dirty = user_ids, dirty
+
+    def _load(self, user_id: int) -> Optional[PlayerState]:
+        with self._session_factory() as session:
+            return session.get(PlayerState, user_id)
+
+
+def _save(session: Session, rows: dict[int, Row]) -> None:
+    # Rows that already exist are updated in bulk by primary key, and the rest inserted in bulk
+    saved_at: float = time.time()
+    existing: set[int] = set(session.scalars(
+        select(PlayerState.user_id).where(PlayerState.user_id.in_(list(rows)))))
+    updates: list[dict] = []
+    inserts: list[dict] = []
+    for user_id, (x, y) in rows.items():
+        values: dict = {"user_id": user_id, "x": x, "y": y, "saved_at": saved_at}
+        (updates if user_id in existing else inserts).append(values)
+    if updates:
+        session.execute(update(PlayerState), updates)
+    if inserts:
+        session.execute(insert(PlayerState), inserts)
@@ -0,0 +1,237 @@
+"""
+This module contains the world simulation. Per-entity state is kept as a struct of NumPy arrays, 
+indexed by a dense slot number, so each tick's integration step is a handful of vectorized 
+operations no matter how many entities there are.
+
+Entities are also filed in a spatial hash by the cell they are in. Each step works out which
+entities crossed into a new cell with the same vectorized operations, and the hash is refiled in
+bulk the next time it is searched. The cells entities have left, spawned in or despawned from are
+remembered, so whoever could see them can be told their view has changed.
+
+Example usage:
+    world = World()
+    world.spawn(slot=0, entity_id=1, owner=protocol)
+    world.set_direction(0, 1, 0)
+    changed = world.step(1/20)
+    watchers = np.union1d(world.near_any(changed), world.drain_disturbed())
+"""
+import math
+from typing import Any, Optional
+import numpy as np
+from server.world.interest import Cell, SpatialHash, cell_keys
+
+
+class World:
+    """
+    The game world, holding the position and velocity of every entity in it.
+
+    Slots are chosen by the caller, usually the slot the owner was given by the connection registry. 
+    Those are handed out lowest-first and reused once freed, so the live entities stay packed at the 
+    front of the arrays and each step only has to look at `[:high_water]`.
+
+    Args:
+        capacity (int): 
+            The number of slots to allocate up front. The arrays double in size when they run out.
+        speed (float): 
+            How many world units an entity moves per second at full speed.
+        cell_size (float): 
+            The size of each cell of the spatial hash, in world units.
+        view_range (int): 
+            How many cells away an entity can see, in each direction.
+
+    Attributes:
+        x, y (np.ndarray): The position of the entity in each slot.
+        vx, vy (np.ndarray): The velocity of the entity in each slot, in units per second.
+        cell_x, cell_y (np.ndarray): The spatial hash cell the entity in each slot is filed under.
+        entity_ids (np.ndarray): The ID of the entity in each slot, as sent to clients.
+        active (np.ndarray): Whether each slot is in use.
+        owners (list): The object that owns the entity in each slot, e.g. its GameProtocol.
+        high_water (int): One past the highest slot that has ever been in use.
+        interest (SpatialHash):
+            The spatial hash the entities are filed in, refiled first if any have changed cell since
+            it was last searched.
+    """
+    _ARRAYS: tuple[str, ...] = ('x', 'y', 'vx', 'vy', 'cell_x', 'cell_y', 'entity_ids', 'active')
+
+    def __init__(self, capacity: int = 1024, speed: float = 100.0, cell_size: float = 500.0,
+                 view_range: int = 1) -> None:
+        self.speed: float = speed
+        self.x: np.ndarray = np.zeros(capacity, dtype=np.float32)
+        self.y: np.ndarray = np.zeros(capacity, dtype=np.float32)
+        self.vx: np.ndarray = np.zeros(capacity, dtype=np.float32)
+        self.vy: np.ndarray = np.zeros(capacity, dtype=np.float32)
+        self.cell_x: np.ndarray = np.zeros(capacity, dtype=np.int64)
+        self.cell_y: np.ndarray = np.zeros(capacity, dtype=np.int64)
+        self.entity_ids: np.ndarray = np.zeros(capacity, dtype=np.uint32)
+        self.active: np.ndarray = np.zeros(capacity, dtype=np.bool_)
+        self.owners: list[Optional[Any]] = [None] * capacity
+        self.high_water: int = 0
+        self._interest: SpatialHash = SpatialHash(cell_size, view_range)
+        self._filed: bool = True
+        self._num_active: int = 0
+        self._disturbed_x: list[int] = []
+        self._disturbed_y: list[int] = []
+
+    def __len__(self) -> int:
+        return self._num_active
+
+    def __contains__(self, slot: int) -> bool:
+        return 0 <= slot < self.high_water and bool(self.active[slot])
+
+    @property
+    def capacity(self) -> int:
+        """
+        The number of slots currently allocated.
+        """
+        return len(self.x)
+
+    @property
+    def interest(self) -> SpatialHash:
+        """
+        The spatial hash the entities are filed in, refiled first if any have changed cell.
+        """
+        if not self._filed:
+            slots: np.ndarray = np.flatnonzero(self.active[:self.high_water])
+            self._interest.file(slots, self.cell_x[slots], self.cell_y[slots])
+            self._filed = True
+        return self._interest
+
+    def spawn(self, slot: int, entity_id: int, owner: Any, x: float = 0.0, y: float = 0.0) -> None:
+        """
+        Adds a stationary entity to the world.
+
+        Args:
+            slot (int): The slot to put the entity in.
+            entity_id (int): The ID of the entity, as sent to clients.
+            owner (Any): The object that owns the entity, e.g. its GameProtocol.
+            x, y (float): Where to spawn the entity.
+
+        Raises:
+            ValueError: If the slot is already in use.
+        """
+        if slot in self:
+            raise ValueError(f"Slot {slot} is already in use")
+        while slot >= self.capacity:
+            self._grow()
+        self.high_water = max(self.high_water, slot + 1)
+        self._num_active += 1
+
+        cell: Cell = self._interest.cell_of(x, y)
+        self.x[slot] = x
+        self.y[slot] = y
+        self.vx[slot] = 0
+        self.vy[slot] = 0
+        self.cell_x[slot], self.cell_y[slot] = cell
+        self.entity_ids[slot] = entity_id
+        self.active[slot] = True
+        self.owners[slot] = owner
+        self._disturb(cell)
+
+    def despawn(self, slot: int) -> None:
+        """
+        Removes the entity in a slot from the world, freeing the slot for reuse. Does nothing if the
+        slot is empty, so removing the same entity twice cannot throw off the count of entities.
+        """
+        if slot not in self:
+            return
+        self._num_active -= 1
+        self._disturb(self._cell(slot))
+        self.vx[slot] = 0
+        self.vy[slot] = 0
+        self.active[slot] = False
+        self.owners[slot] = None
+
+    def set_direction(self, slot: int, dx: float, dy: float) -> None:
+        """
+        Sets the direction the entity in a slot is moving in. Directions longer than 1 are 
+        normalized so clients cannot move faster than `speed`, and non-finite directions stop the 
+        entity.
+        """
+        length: float = math.hypot(dx, dy)
+        if not math.isfinite(length) or length == 0:
+            dx = dy = 0.0
+        elif length > 1:
+            dx /= length
+            dy /= length
+        self.vx[slot] = dx * self.speed
+        self.vy[slot] = dy * self.speed
+
+    def step(self, dt: float) -> np.ndarray:
+        """
+        Moves every entity along its velocity for `dt` seconds, then moves the entities that
+        crossed into a new cell of the spatial hash to that cell.
+
+        Returns:
+            np.ndarray: The slots of the entities that moved.
+        """
+        n: int = self.high_water
+        vx: np.ndarray = self.vx[:n]
+        vy: np.ndarray = self.vy[:n]
+        self.x[:n] += vx * dt
+        self.y[:n] += vy * dt
+        moved: np.ndarray = np.flatnonzero((vx != 0) | (vy != 0))
+        if moved.size:
+            self._refile(moved)
+        return moved
+
+    def near_any(self, slots: np.ndarray) -> np.ndarray:
+        """
+        Finds every entity in view of at least one of the entities in the given slots. Each cell is
+        only looked from once, however many of the given entities are in it.
+
+        Returns:
+            np.ndarray: The slots of the entities found, in ascending order.
+        """
+        return self._near_cells(self.cell_x[slots], self.cell_y[slots])
+
+    def drain_disturbed(self) -> np.ndarray:
+        """
+        Finds every entity that can see a cell another entity has left, spawned in or despawned
+        from since the last call, so something has gone out of or come into its view.
+
+        Returns:
+            np.ndarray: The slots of the entities found, in ascending order.
+        """
+        cell_x: np.ndarray = np.array(self._disturbed_x, dtype=np.int64)
+        cell_y: np.ndarray = np.array(self._disturbed_y, dtype=np.int64)
+        self._disturbed_x, self._disturbed_y = [], []
+        return self._near_cells(cell_x, cell_y)
+
+    def _cell(self, slot: int) -> Cell:
+        return int(self.cell_x[slot]), int(self.cell_y[slot])
+
+    def _refile(self, slots: np.ndarray) -> None:
+        cx, cy = self._interest.cells_of(self.x[slots], self.y[slots])
+        crossed: np.ndarray = (cx != self.cell_x[slots]) | (cy != self.cell_y[slots])
+        if not crossed.any():
+            return
+
+        crossers: np.ndarray = slots[crossed]
+        self._disturbed_x.extend(self.cell_x[crossers].tolist())
+        self._disturbed_y.extend(self.cell_y[crossers].tolist())
+        self.cell_x[crossers] = cx[crossed]
+        self.cell_y[crossers] = cy[crossed]
+        self._filed = False
+
+    def _disturb(self, cell: Cell) -> None:
+        self._disturbed_x.append(cell[0])
+        self._disturbed_y.append(cell[1])
+        self._filed = False
+
+    def _near_cells(self, cell_x: np.ndarray, cell_y: np.ndarray) -> np.ndarray:
+        if len(cell_x) == 0:
+            return np.empty(0, dtype=np.int64)
+        _, first = np.unique(cell_keys(cell_x, cell_y), return_index=True)
+        _, seen = self.interest.gather(cell_x[first], cell_y[first])
+        found: np.ndarray = np.zeros(self.high_water, dtype=np.bool_)
+        found[seen] = True
+        return np.flatnonzero(found)
+
+    def _grow(self) -> None:
+        new_capacity: int = self.capacity * 2
+        for name in self._ARRAYS:
+            old: np.ndarray = getattr(self, name)
+            new: np.ndarray = np.zeros(new_capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.owners.extend([None] * (new_capacity - len(self.owners)))